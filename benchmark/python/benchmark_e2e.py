@@ -127,6 +127,14 @@ def save_results(args, results, filename, print_memory_usage=False):
     "Wall Clock Time (s)",
     ]
 
+    if args.draft_input_folder or args.prompt_lookup_num_tokens:
+        columns.extend([
+            "Speculative Token Generation Throughput (tps)",
+            "Speculative Acceptance Rate",
+            "Speculative Tokens Per Step",
+            "Speculative Speedup",
+        ])
+
     if print_memory_usage:
         if IS_NVIDIA_SYSTEM:
             columns.append("peak_gpu_memory (GiB)")
@@ -159,6 +167,16 @@ def save_results(args, results, filename, print_memory_usage=False):
         record.metrics.customized["wall_clock_throughput_tps"] = row["Wall Clock Throughput (tps)"]
         record.metrics.customized["wall_clock_time_s"] = row["Wall Clock Time (s)"]
 
+        if args.draft_input_folder or args.prompt_lookup_num_tokens:
+            if args.draft_input_folder:
+                record.config.customized["num_draft_tokens"] = args.num_draft_tokens
+            else:
+                record.config.customized["prompt_lookup_num_tokens"] = args.prompt_lookup_num_tokens
+            record.metrics.customized["speculative_token_generation_throughput_tps"] = row["Speculative Token Generation Throughput (tps)"]
+            record.metrics.customized["speculative_acceptance_rate"] = row["Speculative Acceptance Rate"]
+            record.metrics.customized["speculative_tokens_per_step"] = row["Speculative Tokens Per Step"]
+            record.metrics.customized["speculative_speedup"] = row["Speculative Speedup"]
+
         if print_memory_usage:
             if IS_NVIDIA_SYSTEM:
                 record.metrics.customized["peak_gpu_memory_gb"] = row["peak_gpu_memory (GiB)"]
@@ -203,15 +221,9 @@ def run_benchmark_memory(args, batch_size, prompt_length, generation_length, max
     
     return metrics
 
-def run_benchmark(args, batch_size, prompt_length, generation_length, max_length):
-
-    # Get user arguments
-    num_repetitions = args.repetitions
-    temperature = 1.0
-
-    # Get tokenizer, and model
+def load_model(args, model_folder, batch_size):
     if args.verbose: print("Getting config")
-    config = og.Config(f'{args.input_folder}')
+    config = og.Config(f'{model_folder}')
     config.overlay(f'{{"search": {{"batch_size": {batch_size}}}}}')
     if args.execution_provider != "follow_config":
         config.clear_providers()
@@ -221,6 +233,16 @@ def run_benchmark(args, batch_size, prompt_length, generation_length, max_length
     if args.verbose: print("Loading model... ")
     model = og.Model(config)
     if args.verbose: print("Model loaded")
+    return model
+
+def run_benchmark(args, batch_size, prompt_length, generation_length, max_length):
+
+    # Get user arguments
+    num_repetitions = args.repetitions
+    temperature = 1.0
+
+    # Get tokenizer, and model
+    model = load_model(args, args.input_folder, batch_size)
     tokenizer = og.Tokenizer(model)
 
     # Get model type
@@ -335,6 +357,40 @@ def run_benchmark(args, batch_size, prompt_length, generation_length, max_length
         # Delete the generator to free the captured graph for the next generator, if graph capture is enabled
         del generator
 
+    # Measure token generation with speculative decoding, where a draft model or prompt lookup proposes the tokens the
+    # model verifies
+    speculative_times = []
+    speculative_token_counts = []
+    speculative_steps = speculative_draft_tokens = speculative_accepted_tokens = 0
+    if args.draft_input_folder or args.prompt_lookup_num_tokens:
+        if batch_size != 1:
+            raise ValueError("Speculative decoding requires a batch size of 1")
+        draft_model = load_model(args, args.draft_input_folder, batch_size) if args.draft_input_folder else None
+        if not draft_model:
+            params.set_search_options(prompt_lookup_num_tokens=args.prompt_lookup_num_tokens)
+        if args.verbose: print("Running speculative decoding benchmark")
+        for _ in tqdm(range(num_repetitions)):
+            generator = og.Generator(model, params)
+            if draft_model:
+                generator.set_draft_model(draft_model, args.num_draft_tokens)
+            generator.append_tokens(tokens)
+
+            # The first token is picked from the logits of the prompt, so like above it isn't counted as generated
+            speculative_start_time = time.perf_counter()
+            generated = len(generator.speculate_next_tokens()) - 1
+            while not generator.is_done() and generated < generation_length - 1:
+                generated += len(generator.speculate_next_tokens())
+            speculative_end_time = time.perf_counter()
+            speculative_times.append(speculative_end_time - speculative_start_time)
+            speculative_token_counts.append(generated)
+
+            stats = generator.get_speculative_stats()
+            speculative_steps += stats["steps"]
+            speculative_draft_tokens += stats["draft_tokens"]
+            speculative_accepted_tokens += stats["accepted_tokens"]
+            if args.print_model_output: print(tokenizer.decode(generator.get_sequence(0)))
+            del generator
+
     # Calculate tokenization metrics
     avg_tokenization_latency_s = sum(tokenize_times) / len(tokenize_times)
     avg_tokenization_latency_ms = avg_tokenization_latency_s * 1000
@@ -371,6 +427,18 @@ def run_benchmark(args, batch_size, prompt_length, generation_length, max_length
     print(f"Average Wall Clock Time: {avg_wall_clock_time} s")
     print(f"Average Wall Clock Throughput: {avg_wall_clock_thrpt} tps")
 
+    # Calculate speculative decoding metrics
+    if args.draft_input_folder or args.prompt_lookup_num_tokens:
+        avg_speculative_thrpt = sum(speculative_token_counts) / sum(speculative_times)
+        speculative_acceptance_rate = speculative_accepted_tokens / max(speculative_draft_tokens, 1)
+        # Every step appends the accepted tokens and the token the model picks after them
+        speculative_tokens_per_step = (speculative_accepted_tokens + speculative_steps) / max(speculative_steps, 1)
+        speculative_speedup = avg_speculative_thrpt / avg_token_gen_thrpt
+        print(f"Average Speculative Token Generation Throughput (per token): {avg_speculative_thrpt} tps")
+        print(f"Speculative Acceptance Rate: {speculative_acceptance_rate}")
+        print(f"Speculative Tokens Per Step: {speculative_tokens_per_step}")
+        print(f"Speculative Speedup: {speculative_speedup}x")
+
     if args.print_memory_usage:
         if IS_NVIDIA_SYSTEM:
             print(f"Peak GPU Memory Usage: {peak_gpu_memory} GiB ")
@@ -393,6 +461,13 @@ def run_benchmark(args, batch_size, prompt_length, generation_length, max_length
         avg_wall_clock_thrpt,
         avg_wall_clock_time,
     ]
+    if args.draft_input_folder or args.prompt_lookup_num_tokens:
+        metrics.extend([
+            avg_speculative_thrpt,
+            speculative_acceptance_rate,
+            speculative_tokens_per_step,
+            speculative_speedup,
+        ])
     return metrics
 
 
@@ -448,6 +523,9 @@ if __name__ == "__main__":
     parser.add_argument('--use_random_tokens', action='store_true', help='Use random tokens instead of generating a prompt')
     parser.add_argument('--use_prompt_set', action='store_true', help='Use pre-generated prompt set instead of generating a prompt')
     parser.add_argument('--chat_template', type=str, default='', help='Chat template to use for the prompt. User input will be injected into {input}')
+    parser.add_argument('-d', '--draft_input_folder', type=str, default='', help='Onnx draft model folder path. If set, token generation is also measured with speculative decoding using this draft model (requires a batch size of 1)')
+    parser.add_argument('-nd', '--num_draft_tokens', type=int, default=4, help='Number of tokens the draft model proposes per step of speculative decoding')
+    parser.add_argument('-pl', '--prompt_lookup_num_tokens', type=int, default=0, help='If set and no draft model is given, token generation is also measured with speculative decoding that proposes this many tokens per step by prompt lookup (requires a batch size of 1)')
     parser.add_argument('-e', '--execution_provider', type=str, required=False, default='follow_config', choices=["cpu", "cuda", "dml", "follow_config"], help="Execution provider to run the ONNX Runtime session with. Defaults to follow_config that uses the execution provider listed in the genai_config.json instead.")
     args = parser.parse_args()
 
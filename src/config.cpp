@@ -227,6 +227,10 @@ struct DecoderInputs_Element : JSON::Element {
       v_.past_value_names = JSON::Get<std::string_view>(value);
     } else if (name == "past_names") {
       v_.past_names = JSON::Get<std::string_view>(value);
+    } else if (name == "past_key_scale_names") {
+      v_.past_key_scale_names = JSON::Get<std::string_view>(value);
+    } else if (name == "past_value_scale_names") {
+      v_.past_value_scale_names = JSON::Get<std::string_view>(value);
     } else if (name == "cross_past_key_names") {
       v_.cross_past_key_names = JSON::Get<std::string_view>(value);
     } else if (name == "cross_past_value_names") {
@@ -247,6 +251,8 @@ struct DecoderInputs_Element : JSON::Element {
       v_.past_key_values_length = JSON::Get<std::string_view>(value);
     } else if (name == "cache_indirection") {
       v_.cache_indirection = JSON::Get<std::string_view>(value);
+    } else if (name == "last_token_indices") {
+      v_.last_token_indices = JSON::Get<std::string_view>(value);
     } else {
       throw JSON::unknown_value_error{};
     }
@@ -262,12 +268,20 @@ struct DecoderOutputs_Element : JSON::Element {
   void OnValue(std::string_view name, JSON::Value value) override {
     if (name == "logits") {
       v_.logits = JSON::Get<std::string_view>(value);
+    } else if (name == "top_k_logits") {
+      v_.top_k_logits = JSON::Get<std::string_view>(value);
+    } else if (name == "top_k_indices") {
+      v_.top_k_indices = JSON::Get<std::string_view>(value);
     } else if (name == "present_key_names") {
       v_.present_key_names = JSON::Get<std::string_view>(value);
     } else if (name == "present_value_names") {
       v_.present_value_names = JSON::Get<std::string_view>(value);
     } else if (name == "present_names") {
       v_.present_names = JSON::Get<std::string_view>(value);
+    } else if (name == "present_key_scale_names") {
+      v_.present_key_scale_names = JSON::Get<std::string_view>(value);
+    } else if (name == "present_value_scale_names") {
+      v_.present_value_scale_names = JSON::Get<std::string_view>(value);
     } else if (name == "output_cross_qk_names") {
       v_.output_cross_qk_names = JSON::Get<std::string_view>(value);
     } else if (name == "rnn_states") {
@@ -398,6 +412,21 @@ struct SlidingWindow_Element : JSON::Element {
   std::optional<Config::Model::Decoder::SlidingWindow>& v_;
 };
 
+struct PagedKeyValueCache_Element : JSON::Element {
+  explicit PagedKeyValueCache_Element(std::optional<Config::Model::Decoder::PagedKeyValueCache>& v) : v_{v} {}
+
+  void OnValue(std::string_view name, JSON::Value value) override {
+    if (name == "block_size") {
+      v_->block_size = static_cast<int>(JSON::Get<double>(value));
+    } else {
+      throw JSON::unknown_value_error{};
+    }
+  }
+
+ private:
+  std::optional<Config::Model::Decoder::PagedKeyValueCache>& v_;
+};
+
 struct Encoder_Element : JSON::Element {
   explicit Encoder_Element(Config::Model::Encoder& v) : v_{v} {}
 
@@ -474,6 +503,10 @@ struct Decoder_Element : JSON::Element {
       v_.sliding_window = Config::Model::Decoder::SlidingWindow{};
       return sliding_window_;
     }
+    if (name == "paged_key_value_cache") {
+      v_.paged_key_value_cache = Config::Model::Decoder::PagedKeyValueCache{};
+      return paged_key_value_cache_;
+    }
     throw JSON::unknown_value_error{};
   }
 
@@ -491,6 +524,7 @@ struct Decoder_Element : JSON::Element {
   DecoderOutputs_Element outputs_{v_.outputs};
   Pipeline_Element pipeline_{v_.pipeline};
   SlidingWindow_Element sliding_window_{v_.sliding_window};
+  PagedKeyValueCache_Element paged_key_value_cache_{v_.paged_key_value_cache};
 };
 
 struct VisionInputs_Element : JSON::Element {
@@ -696,6 +730,8 @@ struct Model_Element : JSON::Element {
       v_.vocab_size = static_cast<int>(JSON::Get<double>(value));
     } else if (name == "context_length") {
       v_.context_length = static_cast<int>(JSON::Get<double>(value));
+    } else if (name == "thread_pool_size") {
+      v_.thread_pool_size = static_cast<int>(JSON::Get<double>(value));
     } else if (name == "pad_token_id") {
       v_.pad_token_id = static_cast<int>(JSON::Get<double>(value));
     } else if (name == "eos_token_id") {
@@ -768,6 +804,10 @@ struct Search_Element : JSON::Element {
       v_.temperature = static_cast<float>(JSON::Get<double>(value));
     } else if (name == "repetition_penalty") {
       v_.repetition_penalty = static_cast<float>(JSON::Get<double>(value));
+    } else if (name == "presence_penalty") {
+      v_.presence_penalty = static_cast<float>(JSON::Get<double>(value));
+    } else if (name == "frequency_penalty") {
+      v_.frequency_penalty = static_cast<float>(JSON::Get<double>(value));
     } else if (name == "length_penalty") {
       v_.length_penalty = static_cast<float>(JSON::Get<double>(value));
     } else if (name == "no_repeat_ngram_size") {
@@ -778,6 +818,10 @@ struct Search_Element : JSON::Element {
       v_.length_penalty = static_cast<float>(JSON::Get<double>(value));
     } else if (name == "random_seed") {
       v_.random_seed = static_cast<int>(JSON::Get<double>(value));
+    } else if (name == "prompt_lookup_num_tokens") {
+      v_.prompt_lookup_num_tokens = static_cast<int>(JSON::Get<double>(value));
+    } else if (name == "prompt_lookup_max_ngram_size") {
+      v_.prompt_lookup_max_ngram_size = static_cast<int>(JSON::Get<double>(value));
     } else if (name == "do_sample") {
       v_.do_sample = JSON::Get<bool>(value);
     } else if (name == "past_present_share_buffer") {
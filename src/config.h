@@ -19,10 +19,13 @@ struct Config {
     static constexpr std::string_view PastKeyName = "past_key_values.%d.key";
     static constexpr std::string_view PastValueName = "past_key_values.%d.value";
     static constexpr std::string_view LogitsName = "logits";
+    static constexpr std::string_view TopKLogitsName = "top_k_logits";
+    static constexpr std::string_view TopKIndicesName = "top_k_indices";
     static constexpr std::string_view PresentKeyName = "present.%d.key";
     static constexpr std::string_view PresentValueName = "present.%d.value";
     static constexpr std::string_view RnnStatesName = "rnn_states";
     static constexpr std::string_view RnnStatesPrevName = "rnn_states_prev";
+    static constexpr std::string_view LastTokenIndicesName = "last_token_indices";
 
     // Speech encoder names
     static constexpr std::string_view AudioAttentionMaskName = "audio_attention_mask";
@@ -100,6 +103,7 @@ struct Config {
     int decoder_start_token_id{};   // If an encoder-decoder model starts decoding with a different token than bos, the id of that token.
     int vocab_size{};
     int context_length{};
+    int thread_pool_size{-1};  // Threads of the worker pool shared by the model (see Model::GetThreadPool), -1 uses one less than the hardware threads
 
     struct Encoder {
       std::string filename;
@@ -192,6 +196,14 @@ struct Config {
       };
       std::optional<SlidingWindow> sliding_window;
 
+      // Store the key-value cache in fixed size blocks from a pool shared by all generators of the model. Blocks are shared
+      // copy-on-write by beams and PrefixCache entries, but every decode step gathers the whole past from the blocks, so
+      // long generations run slower than with the default cache and past_present_share_buffer
+      struct PagedKeyValueCache {
+        int block_size{16};  // Number of token positions per block
+      };
+      std::optional<PagedKeyValueCache> paged_key_value_cache;
+
       struct Inputs {
         std::string input_ids{Defaults::InputIdsName};
         std::string embeddings{Defaults::InputsEmbedsName};
@@ -200,6 +212,7 @@ struct Config {
         std::string past_key_names{Defaults::PastKeyName};
         std::string past_value_names{Defaults::PastValueName};
         std::string past_names;  // When key/value pairs are combined
+        std::string past_key_scale_names, past_value_scale_names;  // For an int8 key-value cache with a float scale per position of each head
         std::string cross_past_key_names, cross_past_value_names;
 
         std::string past_key_values_length{Defaults::PastKeyValuesLengthName};
@@ -207,6 +220,7 @@ struct Config {
         std::string current_sequence_length{Defaults::CurrentSequenceLengthName};
         std::string total_sequence_length{Defaults::TotalSequenceLengthName};
         std::string cache_indirection{Defaults::CacheIndirectionName};
+        std::string last_token_indices{Defaults::LastTokenIndicesName};  // Index of the last token of each sequence for models that only return its logits
         std::string encoder_hidden_states{Defaults::EncoderHiddenStatesName};
         std::string rnn_prev_states{Defaults::RnnStatesPrevName};
         std::string encoder_attention_mask{Defaults::EncoderAttentionMaskName};
@@ -214,9 +228,12 @@ struct Config {
 
       struct Outputs {
         std::string logits{Defaults::LogitsName};
+        std::string top_k_logits{Defaults::TopKLogitsName};    // For models with an in-graph TopK head instead of the logits output
+        std::string top_k_indices{Defaults::TopKIndicesName};  // For models with an in-graph TopK or ArgMax head instead of the logits output
         std::string present_key_names{Defaults::PresentKeyName};
         std::string present_value_names{Defaults::PresentValueName};
         std::string present_names;  // When key/value pairs are combined
+        std::string present_key_scale_names, present_value_scale_names;  // For an int8 key-value cache with a float scale per position of each head
         std::string output_cross_qk_names{"output_cross_qk_%d"};
         std::string rnn_states{Defaults::RnnStatesName};
       } outputs;
@@ -251,15 +268,20 @@ struct Config {
     int num_beams{1};                  // 1 means no beam search.
     int num_return_sequences{1};       // Number of sequences to return after search. Default is 1.
     float repetition_penalty{1.0f};    // 1.0 means no penalty.
+    float presence_penalty{};          // Subtracted from the logit of each token that is in the sequence (OpenAI style). 0 means no penalty.
+    float frequency_penalty{};         // Times the count of a token in the sequence, subtracted from its logit (OpenAI style). 0 means no penalty.
     int top_k{};                       // Number of highest probability vocabulary tokens to keep for top-k-filtering that will be used by default in the generate method of the model.
     float top_p{};                     // If set to float >0 and <1, only the most probable tokens with probabilities that add up to top_p or higher are kept for generation.
     float temperature{1.0f};           // Temperature to control during generation. Default is 1.0.
     bool early_stopping{true};         //  Whether to stop the beam search when at least num_beams sentences are finished per batch or not.
-    int no_repeat_ngram_size{};        // Unused param
+    int no_repeat_ngram_size{};        // If > 0, an n-gram of this size can only occur once in the sequence. 0 means no restriction.
     float diversity_penalty{};         // Unused param
     float length_penalty{1.0f};        // Exponential penalty to the length that is used with beam-based generation. length_penalty > 0.0 promotes longer sequences, while length_penalty < 0.0 encourages shorter sequences.
     bool past_present_share_buffer{};  // The past/present kv tensors are shared and allocated once to max_length (cuda only)
     int random_seed{-1};               // -1 = Seed with random device, otherwise use value to seed RNG
+
+    int prompt_lookup_num_tokens{};       // Speculative decoding by prompt lookup: tokens proposed per step from earlier n-gram matches, 0 = off
+    int prompt_lookup_max_ngram_size{3};  // Longest n-gram at the end of the sequence that prompt lookup matches
   } search;
 
   void AddMapping(const std::string& nominal_name, const std::string& graph_name);
@@ -334,7 +334,12 @@ public sealed partial class OnnxRuntimeGenAIChatClient : IChatClient
 
         if (options.PresencePenalty.HasValue)
         {
-            generatorParams.SetSearchOption("repetition_penalty", options.PresencePenalty.Value);
+            generatorParams.SetSearchOption("presence_penalty", options.PresencePenalty.Value);
+        }
+
+        if (options.FrequencyPenalty.HasValue)
+        {
+            generatorParams.SetSearchOption("frequency_penalty", options.FrequencyPenalty.Value);
         }
 
         if (options.TopP.HasValue || options.TopK.HasValue)
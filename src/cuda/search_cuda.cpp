@@ -266,4 +266,22 @@ void Search_Cuda::ApplyRepetitionPenalty(float penalty) {
                                          params_->search.max_length, GetSequenceLength(), penalty, GetStream());
 }
 
+void Search_Cuda::ApplyPresenceAndFrequencyPenalties(float presence_penalty, float frequency_penalty) {
+  if (presence_penalty == 0.0f && frequency_penalty == 0.0f)
+    return;
+
+  cuda::LaunchPresenceAndFrequencyPenaltyProcessor(sequences_.GetSequences().Span().data(),
+                                                   GetScores().data(), params_->search.batch_size, params_->search.num_beams, params_->config.model.vocab_size,
+                                                   params_->search.max_length, GetSequenceLength(), presence_penalty, frequency_penalty, GetStream());
+}
+
+void Search_Cuda::ApplyNoRepeatNgram(int no_repeat_ngram_size) {
+  if (no_repeat_ngram_size <= 0)
+    return;
+
+  cuda::LaunchNoRepeatNgramProcessor(sequences_.GetSequences().Span().data(), GetScores().data(), params_->BatchBeamSize(),
+                                     params_->config.model.vocab_size, params_->search.max_length, GetSequenceLength(),
+                                     no_repeat_ngram_size, GetStream());
+}
+
 }  // namespace Generators
\ No newline at end of file
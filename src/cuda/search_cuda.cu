@@ -4,6 +4,7 @@
 #include <cuda_runtime.h>
 #include <cub/cub.cuh>
 #include <algorithm>
+#include <cfloat>
 #include "../generators.h"
 #include "cuda_common.h"
 #include "interface.h"
@@ -181,5 +182,62 @@ void LaunchRepetitionPenaltyProcessor(const int32_t* sequences, float* next_toke
   RepetitionPenaltyProcessor<<<gridSize, blockSize, 0, stream>>>(sequences, next_token_scores, max_sequence_length, vocab_size, total_elements, current_sequence_length, repetition_penalty);
 }
 
+__global__ void PresenceAndFrequencyPenaltyProcessor(const int32_t* sequences, float* next_token_scores, int max_sequence_length, int vocab_size, int total_elements, int current_sequence_length, float presence_penalty, float frequency_penalty) {
+  int index = blockIdx.x * blockDim.x + threadIdx.x;
+  if (index >= total_elements)
+    return;
+
+  int batch_beam_index = index / vocab_size;
+  int word_id = index % vocab_size;
+
+  const int32_t* current_sequence = sequences + batch_beam_index * max_sequence_length;
+  int count = 0;
+  for (int i = 0; i < current_sequence_length; i++) {
+    if (current_sequence[i] == word_id)
+      count++;
+  }
+  if (count > 0)
+    next_token_scores[index] -= presence_penalty + frequency_penalty * count;
+}
+
+void LaunchPresenceAndFrequencyPenaltyProcessor(const int32_t* sequences, float* next_token_scores, int batch_size, int num_beams, int vocab_size, int max_sequence_length, int current_sequence_length, float presence_penalty, float frequency_penalty, cudaStream_t stream) {
+  int total_elements = batch_size * num_beams * vocab_size;
+  constexpr int blockSize = 256;
+  const int gridSize = (total_elements + blockSize - 1) / blockSize;
+
+  PresenceAndFrequencyPenaltyProcessor<<<gridSize, blockSize, 0, stream>>>(sequences, next_token_scores, max_sequence_length, vocab_size, total_elements, current_sequence_length, presence_penalty, frequency_penalty);
+}
+
+// One thread per position of each sequence: when the n-1 tokens before the position match the last n-1 tokens of the
+// sequence, the token at the position is banned
+__global__ void NoRepeatNgramProcessor(const int32_t* sequences, float* next_token_scores, int vocab_size, int max_sequence_length, int total_elements, int current_sequence_length, int no_repeat_ngram_size) {
+  int index = blockIdx.x * blockDim.x + threadIdx.x;
+  if (index >= total_elements)
+    return;
+
+  int batch_beam_index = index / current_sequence_length;
+  int position = index % current_sequence_length;
+  int prefix_size = no_repeat_ngram_size - 1;
+  if (position < prefix_size)
+    return;
+
+  const int32_t* current_sequence = sequences + batch_beam_index * max_sequence_length;
+  for (int i = 1; i <= prefix_size; i++) {
+    if (current_sequence[position - i] != current_sequence[current_sequence_length - i])
+      return;
+  }
+  next_token_scores[batch_beam_index * vocab_size + current_sequence[position]] = -FLT_MAX;
+}
+
+void LaunchNoRepeatNgramProcessor(const int32_t* sequences, float* next_token_scores, int batch_beam_size, int vocab_size, int max_sequence_length, int current_sequence_length, int no_repeat_ngram_size, cudaStream_t stream) {
+  int total_elements = batch_beam_size * current_sequence_length;
+  if (total_elements == 0)
+    return;
+  constexpr int blockSize = 256;
+  const int gridSize = (total_elements + blockSize - 1) / blockSize;
+
+  NoRepeatNgramProcessor<<<gridSize, blockSize, 0, stream>>>(sequences, next_token_scores, vocab_size, max_sequence_length, total_elements, current_sequence_length, no_repeat_ngram_size);
+}
+
 }  // namespace cuda
 }  // namespace Generators
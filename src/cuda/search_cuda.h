@@ -25,6 +25,8 @@ struct Search_Cuda : Search {
 
   void ApplyMinLength(int min_length) override;
   void ApplyRepetitionPenalty(float penalty) override;
+  void ApplyPresenceAndFrequencyPenalties(float presence_penalty, float frequency_penalty) override;
+  void ApplyNoRepeatNgram(int no_repeat_ngram_size) override;
 
   std::span<float> GetScores(int batch_beam_index);
   std::span<float> GetScores();
@@ -0,0 +1,316 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+
+#include "generators.h"
+#include "search.h"
+#include "engine.h"
+#include "models/decoder_only.h"
+
+namespace Generators {
+
+namespace {
+
+// Copies int64 values into a tensor of int32 or int64
+void CopyToTensor(std::span<const int64_t> values, OrtValue& tensor) {
+  if (tensor.GetTensorTypeAndShapeInfo()->GetElementType() == Ort::TypeToTensorType<int64_t>)
+    std::copy(values.begin(), values.end(), tensor.GetTensorMutableData<int64_t>());
+  else
+    std::transform(values.begin(), values.end(), tensor.GetTensorMutableData<int32_t>(), [](int64_t v) { return static_cast<int32_t>(v); });
+}
+
+}  // namespace
+
+// The decoder inputs & outputs for a run over part of the engine's batch
+struct Engine_State : State {
+  Engine_State(const DecoderOnly_Model& model, const GeneratorParams& params);
+
+  DeviceSpan<float> Run(int /*total_length*/, DeviceSpan<int32_t>& /*next_tokens*/, DeviceSpan<int32_t> /*next_indices*/) override {
+    throw std::runtime_error("Engine_State can only be run through the Engine");
+  }
+
+  // Runs the batch entries [begin, begin + tokens.size()). Entry i appends tokens[i] after its past_lengths[i] cached
+  // positions, and every entry must append the same number of tokens. Returns the logits of the last token of each entry.
+  DeviceSpan<float> Run(size_t begin, std::span<const std::span<const int32_t>> tokens, std::span<const int> past_lengths);
+
+  DefaultKeyValueCache& GetKeyValueCache() { return *default_kv_cache_; }
+
+ private:
+  const DecoderOnly_Model& model_;
+  const int vocab_size_{model_.config_->model.vocab_size};
+
+  std::unique_ptr<KeyValueCache> kv_cache_;
+  DefaultKeyValueCache* default_kv_cache_{};  // kv_cache_, the only kind that can run part of the batch
+
+  // The inputs are allocated once, for batch_size entries of max_length tokens, and reused by every Run. The logits are
+  // allocated once for the last token of each entry, only a prefill without last_token_indices needs more
+  std::unique_ptr<Tensor> input_ids_, attention_mask_, position_ids_, last_token_indices_, logits_;
+  size_t input_ids_index_{}, attention_mask_index_{}, position_ids_index_{~0U}, last_token_indices_index_{~0U};
+  std::vector<int64_t> input_ids_values_, attention_mask_values_, position_ids_values_;
+
+  DeviceSpan<float> last_logits_;  // shape (batch_size, vocab_size)
+};
+
+Engine_State::Engine_State(const DecoderOnly_Model& model, const GeneratorParams& params)
+    : State{params, model},
+      model_{model} {
+  auto& inputs = model_.config_->model.decoder.inputs;
+  auto* device = GetDeviceInterface(DeviceType::CPU);
+  const int64_t batch_size = params.search.batch_size;
+  const std::array<int64_t, 2> max_input_shape{batch_size, params.search.max_length};
+
+  input_ids_index_ = inputs_.size();
+  inputs_.push_back(nullptr);
+  input_names_.push_back(inputs.input_ids.c_str());
+  input_ids_ = std::make_unique<Tensor>(device, model_.session_info_.GetInputDataType(inputs.input_ids));
+  input_ids_->CreateTensor(max_input_shape, true);
+
+  attention_mask_index_ = inputs_.size();
+  inputs_.push_back(nullptr);
+  input_names_.push_back(inputs.attention_mask.c_str());
+  attention_mask_ = std::make_unique<Tensor>(device, model_.session_info_.GetInputDataType(inputs.attention_mask));
+  attention_mask_->CreateTensor(max_input_shape, true);
+
+  if (model_.session_info_.HasInput(inputs.position_ids)) {
+    position_ids_index_ = inputs_.size();
+    inputs_.push_back(nullptr);
+    input_names_.push_back(inputs.position_ids.c_str());
+    position_ids_ = std::make_unique<Tensor>(device, model_.session_info_.GetInputDataType(inputs.position_ids));
+    position_ids_->CreateTensor(max_input_shape, true);
+  }
+
+  if (model_.session_info_.HasInput(inputs.last_token_indices)) {
+    last_token_indices_index_ = inputs_.size();
+    inputs_.push_back(nullptr);
+    input_names_.push_back(inputs.last_token_indices.c_str());
+    last_token_indices_ = std::make_unique<Tensor>(device, model_.session_info_.GetInputDataType(inputs.last_token_indices));
+    last_token_indices_->CreateTensor(std::array<int64_t, 1>{batch_size}, true);
+  }
+
+  outputs_.push_back(nullptr);
+  output_names_.push_back(model_.config_->model.decoder.outputs.logits.c_str());
+  logits_ = std::make_unique<Tensor>(device, model_.session_info_.GetOutputDataType(model_.config_->model.decoder.outputs.logits));
+  logits_->CreateTensor(std::array<int64_t, 3>{batch_size, 1, vocab_size_}, true);
+
+  kv_cache_ = CreateKeyValueCache(*this);
+  default_kv_cache_ = dynamic_cast<DefaultKeyValueCache*>(kv_cache_.get());
+  if (!default_kv_cache_)
+    throw std::runtime_error("Engine only supports models with the default key-value cache");
+  kv_cache_->Add();
+
+  last_logits_ = GetDeviceInterface(DeviceType::CPU)->Allocate<float>(static_cast<size_t>(params.search.batch_size) * vocab_size_);
+}
+
+DeviceSpan<float> Engine_State::Run(size_t begin, std::span<const std::span<const int32_t>> tokens, std::span<const int> past_lengths) {
+  const int64_t batch_size = static_cast<int64_t>(tokens.size());
+  const int64_t sequence_length = static_cast<int64_t>(tokens[0].size());
+  const int64_t total_length = sequence_length + *std::max_element(past_lengths.begin(), past_lengths.end());
+
+  // Entries shorter than the longest one are padded on the right, so each one's cached positions stay where they are
+  auto& input_ids = input_ids_values_;
+  auto& attention_mask = attention_mask_values_;
+  auto& position_ids = position_ids_values_;
+  input_ids.clear();
+  attention_mask.clear();
+  position_ids.clear();
+  for (int64_t i = 0; i < batch_size; i++) {
+    assert(static_cast<int64_t>(tokens[i].size()) == sequence_length);
+    input_ids.insert(input_ids.end(), tokens[i].begin(), tokens[i].end());
+    for (int64_t j = 0; j < sequence_length; j++)
+      position_ids.push_back(past_lengths[i] + j);
+    for (int64_t j = 0; j < total_length; j++)
+      attention_mask.push_back(j < past_lengths[i] + sequence_length ? 1 : 0);
+  }
+
+  // Only the shapes change between runs, the tensors are views of the same buffers
+  const std::array<int64_t, 2> input_shape{batch_size, sequence_length};
+  const std::array<int64_t, 2> attention_mask_shape{batch_size, total_length};
+
+  input_ids_->CreateTensor(input_shape, true);
+  CopyToTensor(input_ids, *input_ids_->GetOrtTensor());
+  inputs_[input_ids_index_] = input_ids_->GetOrtTensor();
+
+  attention_mask_->CreateTensor(attention_mask_shape, true);
+  CopyToTensor(attention_mask, *attention_mask_->GetOrtTensor());
+  inputs_[attention_mask_index_] = attention_mask_->GetOrtTensor();
+
+  if (position_ids_index_ != ~0U) {
+    position_ids_->CreateTensor(input_shape, true);
+    CopyToTensor(position_ids, *position_ids_->GetOrtTensor());
+    inputs_[position_ids_index_] = position_ids_->GetOrtTensor();
+  }
+
+  int64_t logits_length = sequence_length;
+  if (last_token_indices_index_ != ~0U) {
+    last_token_indices_->CreateTensor(std::array<int64_t, 1>{batch_size}, true);
+    auto last_token_indices = last_token_indices_->GetOrtTensor();
+    if (last_token_indices->GetTensorTypeAndShapeInfo()->GetElementType() == Ort::TypeToTensorType<int64_t>)
+      std::fill_n(last_token_indices->GetTensorMutableData<int64_t>(), batch_size, sequence_length - 1);
+    else
+      std::fill_n(last_token_indices->GetTensorMutableData<int32_t>(), batch_size, static_cast<int32_t>(sequence_length - 1));
+    inputs_[last_token_indices_index_] = last_token_indices;
+    logits_length = 1;
+  }
+
+  // A prefill of more than one token without last_token_indices gets logits of its own
+  const std::array<int64_t, 3> logits_shape{batch_size, logits_length, vocab_size_};
+  logits_->CreateTensor(logits_shape, logits_length == 1);
+  outputs_[0] = logits_->GetOrtTensor();
+  const auto logits_type = logits_->GetType();
+
+  default_kv_cache_->SetBatchRange(begin, static_cast<size_t>(batch_size));
+
+  State::Run(*model_.session_decoder_);
+
+  // Keep the logits of the last token of each entry, as float
+  auto last_logits = last_logits_.subspan(0, static_cast<size_t>(batch_size) * vocab_size_);
+  auto last_logits_cpu = last_logits.CpuSpan();
+  for (int64_t i = 0; i < batch_size; i++) {
+    const size_t offset = static_cast<size_t>((i * logits_length + logits_length - 1) * vocab_size_);
+    auto destination = last_logits_cpu.begin() + i * vocab_size_;
+    if (logits_type == Ort::TypeToTensorType<float>) {
+      const float* source = logits_->GetData<float>() + offset;
+      std::copy(source, source + vocab_size_, destination);
+    } else {
+      const uint16_t* source = reinterpret_cast<const uint16_t*>(logits_->GetData<Ort::Float16_t>()) + offset;
+      std::transform(source, source + vocab_size_, destination, Float16ToFloat32);
+    }
+  }
+  return last_logits;
+}
+
+Engine::Engine(const Model& model, const GeneratorParams& params)
+    : model_{model.shared_from_this()},
+      params_{params.shared_from_this()} {
+  auto* decoder_only_model = dynamic_cast<const DecoderOnly_Model*>(&model);
+  if (!decoder_only_model)
+    throw std::runtime_error("Engine is not supported for " + model.config_->model.type + " models, only decoder-only models");
+  if (model.p_device_kvcache_->GetType() != DeviceType::CPU)
+    throw std::runtime_error("Engine currently only supports the CPU provider");
+  // The Engine runs part of the batch through views of the default cache's shared buffers, which the others don't have
+  if (!model.config_->model.decoder.inputs.past_key_scale_names.empty())
+    throw std::runtime_error("Engine does not support the int8 key-value cache (kv_cache_int8)");
+  if (model.config_->model.decoder.paged_key_value_cache)
+    throw std::runtime_error("Engine does not support paged_key_value_cache");
+  if (!params.search.past_present_share_buffer)
+    throw std::runtime_error("Engine requires past_present_share_buffer to be true, so the sequences in the batch can have different lengths");
+  if (params.search.num_beams != 1)
+    throw std::runtime_error("Engine does not support beam search");
+  if (params.search.max_length > model.config_->model.context_length)
+    throw std::runtime_error("max_length (" + std::to_string(params.search.max_length) + ") cannot be greater than model context_length (" + std::to_string(model.config_->model.context_length) + ")");
+  if (model.config_->model.decoder.sliding_window)
+    throw std::runtime_error("Engine does not support models with a sliding window");
+  if (model.session_info_.HasOutput(model.config_->model.decoder.outputs.top_k_indices))
+    throw std::runtime_error("Engine does not support models with a TopK or ArgMax head");
+
+  state_ = std::make_unique<Engine_State>(*decoder_only_model, params);
+}
+
+Engine::~Engine() = default;
+
+int64_t Engine::Submit(const GeneratorParams& params, cpu_span<const int32_t> input_ids) {
+  if (&params.config != model_->config_.get())
+    throw std::runtime_error("The GeneratorParams were created for a different model than the Engine");
+  if (params.search.batch_size != 1 || params.search.num_beams != 1)
+    throw std::runtime_error("Each Engine request must have a batch_size and num_beams of 1");
+  if (!params.guidance_type.empty())
+    throw std::runtime_error("Guidance is not supported by the Engine");
+  if (params.search.max_length > params_->search.max_length)
+    throw std::runtime_error("max_length (" + std::to_string(params.search.max_length) + ") cannot be greater than the Engine's max_length (" + std::to_string(params_->search.max_length) + ")");
+  if (input_ids.empty())
+    throw std::runtime_error("input_ids is empty");
+  if (input_ids.size() >= static_cast<size_t>(params.search.max_length))
+    throw std::runtime_error("input_ids size (" + std::to_string(input_ids.size()) + ") must be less than max_length (" + std::to_string(params.search.max_length) + ")");
+
+  auto request = std::make_unique<Request>();
+  request->id = next_request_id_++;
+  request->search = GetDeviceInterface(DeviceType::CPU)->CreateGreedy(params);
+  request->input_ids.assign(input_ids.begin(), input_ids.end());
+  waiting_.push_back(std::move(request));
+  return waiting_.back()->id;
+}
+
+void Engine::Cancel(int64_t request_id) {
+  auto matches = [request_id](const std::unique_ptr<Request>& request) { return request->id == request_id; };
+  if (auto it = std::find_if(waiting_.begin(), waiting_.end(), matches); it != waiting_.end())
+    waiting_.erase(it);
+  else if (auto it = std::find_if(running_.begin(), running_.end(), matches); it != running_.end())
+    (*it)->cancelled = true;  // Retired at the start of the next Step
+}
+
+bool Engine::HasPendingRequests() const {
+  return !waiting_.empty() || !running_.empty();
+}
+
+std::span<const Engine::Token> Engine::Step() {
+  DurationTrace trace{"Engine::Step"};
+  tokens_.clear();
+
+  for (size_t index = running_.size(); index-- > 0;) {
+    if (running_[index]->cancelled)
+      Retire(index);
+  }
+
+  // Only the requests already running decode this step, the admitted ones get their first token from the prefill
+  const size_t decode_count = running_.size();
+  while (!waiting_.empty() && running_.size() < static_cast<size_t>(params_->search.batch_size)) {
+    running_.push_back(std::move(waiting_.front()));
+    waiting_.pop_front();
+    Prefill(running_.size() - 1);
+  }
+
+  if (decode_count > 0)
+    Decode(decode_count);
+
+  for (size_t index = running_.size(); index-- > 0;) {
+    if (running_[index]->search->IsDone())
+      Retire(index);
+  }
+
+  return tokens_;
+}
+
+void Engine::Prefill(size_t index) {
+  auto& request = *running_[index];
+  auto input_ids = GetDeviceInterface(DeviceType::CPU)->Allocate<int32_t>(request.input_ids.size());
+  std::copy(request.input_ids.begin(), request.input_ids.end(), input_ids.CpuSpan().begin());
+  request.search->AppendTokens(input_ids);
+
+  const std::array<std::span<const int32_t>, 1> tokens{request.input_ids};
+  const std::array<int, 1> past_lengths{0};
+  GenerateNextToken(request, state_->Run(index, tokens, past_lengths));
+  request.input_ids = {};
+}
+
+void Engine::Decode(size_t count) {
+  std::vector<std::span<const int32_t>> tokens(count);
+  std::vector<int> past_lengths(count);
+  for (size_t index = 0; index < count; index++) {
+    auto& search = *running_[index]->search;
+    tokens[index] = search.GetNextTokens().CpuSpan();
+    past_lengths[index] = search.GetSequenceLength() - 1;  // The last token isn't in the cache yet
+  }
+
+  auto logits = state_->Run(0, tokens, past_lengths);
+  const size_t vocab_size = model_->config_->model.vocab_size;
+  for (size_t index = 0; index < count; index++)
+    GenerateNextToken(*running_[index], logits.subspan(index * vocab_size, vocab_size));
+}
+
+void Engine::GenerateNextToken(Request& request, DeviceSpan<float> logits) {
+  auto& search = *request.search;
+  search.SetLogits(logits);
+  GenerateNextTokens(search);
+  tokens_.push_back({request.id, search.GetNextTokens().CpuSpan()[0], search.IsDone()});
+}
+
+void Engine::Retire(size_t index) {
+  // Keep the running requests at the front of the batch by moving the last one into the freed entry
+  const size_t last = running_.size() - 1;
+  if (index != last) {
+    state_->GetKeyValueCache().CopyBatchEntry(last, index, running_[last]->search->GetSequenceLength());
+    running_[index] = std::move(running_[last]);
+  }
+  running_.pop_back();
+}
+
+}  // namespace Generators
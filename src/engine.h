@@ -0,0 +1,64 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+#pragma once
+
+#include <deque>
+
+namespace Generators {
+
+struct Engine_State;
+
+// Serves many requests from one live batch (continuous batching). Between decode steps, waiting requests are admitted
+// into free batch entries and finished ones are retired, without restarting the others. Each request has its own
+// Search, so it picks the same tokens a Generator with the same GeneratorParams would.
+//
+// The engine's GeneratorParams set the number of batch entries (batch_size) and the KV cache length of each (max_length).
+// It runs on the default key-value cache, which reserves max_length for every batch entry but only writes the new
+// positions at each step. It doesn't support paged_key_value_cache (and so the PrefixCache), whose decode steps gather
+// the whole past of every sequence.
+struct Engine : LeakChecked<Engine> {
+  Engine(const Model& model, const GeneratorParams& params);
+  ~Engine();
+
+  struct Token {
+    int64_t request_id;
+    int32_t token;
+    bool is_done;  // True for the last token of the request
+  };
+
+  // Queues a request to generate from input_ids with the given params (batch_size 1). Returns its request id
+  int64_t Submit(const GeneratorParams& params, cpu_span<const int32_t> input_ids);
+  // Drops a request. Does nothing if the request already finished
+  void Cancel(int64_t request_id);
+
+  bool HasPendingRequests() const;
+
+  // Admits waiting requests, runs one decode step over the batch and retires finished requests.
+  // Returns one token per request that ran, valid until the next call
+  std::span<const Token> Step();
+  std::span<const Token> GetTokens() const { return tokens_; }  // The tokens returned by the last Step
+
+ private:
+  struct Request {
+    int64_t id;
+    std::unique_ptr<Search> search;
+    std::vector<int32_t> input_ids;  // Cleared once the request is admitted
+    bool cancelled{};
+  };
+
+  void Prefill(size_t index);
+  void Decode(size_t count);
+  void GenerateNextToken(Request& request, DeviceSpan<float> logits);
+  void Retire(size_t index);
+
+  std::shared_ptr<const Model> model_;
+  std::shared_ptr<const GeneratorParams> params_;
+  std::unique_ptr<Engine_State> state_;
+
+  std::deque<std::unique_ptr<Request>> waiting_;
+  std::vector<std::unique_ptr<Request>> running_;  // Indexed by batch entry
+  std::vector<Token> tokens_;
+  int64_t next_request_id_{};
+};
+
+}  // namespace Generators
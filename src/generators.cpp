@@ -8,6 +8,7 @@
 #include "models/decoder_only.h"
 #include "constrained_logits_processor.h"
 #include "search.h"
+#include "speculative.h"
 #include "tracing.h"
 #include "cpu/interface.h"
 #include "cuda/interface.h"
@@ -254,7 +255,8 @@ GeneratorParams::GeneratorParams(const Model& model)
     : config{*model.config_.get()},
       use_graph_capture{IsGraphCaptureEnabled(model.config_->model.decoder.session_options)},
       use_multi_profile{IsMultiProfileEnabled(model.config_->model.decoder.session_options)},
-      p_device{model.p_device_inputs_} {
+      p_device{model.p_device_inputs_},
+      model{&model} {
   if (use_graph_capture) {
     max_batch_size = 1;  // set it to 1 by default
   }
@@ -290,6 +292,8 @@ Generator::Generator(const Model& model, const GeneratorParams& params) : model_
   guidance_logits_processor_ = CreateGuidanceLogitsProcessor(*state_);  // Could be nullptr if use_guidance (constrained decoding) is not used
 }
 
+Generator::~Generator() = default;
+
 DeviceSpan<int32_t> Generator::AllocateInputIdsOnDevice(cpu_span<const int32_t> input_ids) {
   size_t padded_input_ids_size = input_ids.size();
   if (model_->config_->model.decoder.sliding_window.has_value()) {
@@ -351,6 +355,20 @@ void Generator::AppendTokens(cpu_span<const int32_t> input_ids) {
   ComputeLogits(input_ids_device);
 }
 
+void Generator::AppendCachedTokens(cpu_span<const int32_t> input_ids) {
+  if (search_->GetSequenceLength() != 0)
+    throw std::runtime_error("Cached tokens can only be appended to a generator that has no tokens yet");
+  if (input_ids.size() >= static_cast<size_t>(state_->params_->search.max_length))
+    throw std::runtime_error("input_ids size (" + std::to_string(input_ids.size()) + ") must be less than max length (" + std::to_string(state_->params_->search.max_length) + ")");
+
+  auto input_ids_device = AllocateInputIdsOnDevice(input_ids);
+  search_->AppendTokens(input_ids_device);
+  // The state continues after the cached tokens just as it does after a rewind
+  state_->RewindTo(input_ids.size());
+  computed_logits_ = false;
+  last_action_ = Action::rewound;
+}
+
 void Generator::SetInputs(const NamedTensors& named_tensors) {
   if (ModelType::IsLLM(model_->config_->model.type) || ModelType::IsPipe(model_->config_->model.type)) {
     throw std::runtime_error("Please use generator.AppendTokens for " + model_->config_->model.type + ". SetInputs is not supported for this model type.");
@@ -389,6 +407,16 @@ void Generator::ComputeLogits(DeviceSpan<int32_t> next_tokens) {
     guidance_logits_processor_->CommitTokens(next_tokens_span);
   }
   auto logits = state_->Run(search_->GetSequenceLength(), next_tokens, search_->GetNextIndices());
+  if (auto top_k_indices = state_->GetTopKIndices(); !top_k_indices.empty()) {
+    // The model already selected the top k tokens, so the search samples from them instead of the logits
+    if (guidance_logits_processor_)
+      throw std::runtime_error("Guidance is not supported for models with a TopK or ArgMax head");
+    search_->SetTopK(logits, top_k_indices);
+    top_k_head_ = true;
+    last_action_ = Action::standard;
+    computed_logits_ = true;
+    return;
+  }
   if (g_log.enabled && g_log.model_logits) {
     auto& stream = Log("model_logits");
     DumpValues(stream, Ort::TypeToTensorType<float>, logits.CopyDeviceToCpu().data(), logits.size());
@@ -436,6 +464,7 @@ bool Generator::IsSessionTerminated() const {
 
 void Generator::SetLogits(DeviceSpan<float> logits) {
   search_->SetLogits(logits);
+  top_k_head_ = false;
   computed_logits_ = true;
 }
 
@@ -471,43 +500,18 @@ void Generator::GenerateNextToken() {
   }
   computed_logits_ = false;
   auto& search = search_->params_->search;
-  search_->ApplyMinLength(search.min_length);
-  search_->ApplyRepetitionPenalty(search.repetition_penalty);
-
-  if (g_log.enabled && g_log.generate_next_token) {
-    auto& stream = Log("generate_next_token");
-    stream << SGR::Fg_Green << "do_sample: " << SGR::Reset << search.do_sample << ' '
-           << SGR::Fg_Green << "top_k: " << SGR::Reset << search.top_k << ' '
-           << SGR::Fg_Green << "top_p: " << SGR::Reset << search.top_p << ' '
-           << SGR::Fg_Green << "temperature: " << SGR::Reset << search.temperature << ' '
-           << SGR::Fg_Cyan << "sequence length: " << SGR::Reset << search_->GetSequenceLength()
-           << std::endl;
-  }
-
-  last_action_ = Action::generated;
-  if (!search.do_sample || search.top_k == 1 || search.temperature == 0) {
-    search_->SelectTop();
+  if (top_k_head_) {
+    if (search_->GetSequenceLength() < search.min_length || search.repetition_penalty != 1.0f ||
+        search.presence_penalty != 0.0f || search.frequency_penalty != 0.0f || search.no_repeat_ngram_size > 0)
+      throw std::runtime_error("min_length, repetition_penalty, presence_penalty, frequency_penalty and no_repeat_ngram_size are not supported for models with a TopK or ArgMax head");
+
+    last_action_ = Action::generated;
+    const bool greedy = !search.do_sample || search.top_k == 1 || search.temperature == 0;
+    search_->SampleFromTopK(greedy ? 1 : search.top_k, search.top_p, search.temperature);
     return;
   }
-
-  // The user explicitly called TopK_TopP on a beam search
-  if (search.num_beams != 1)
-    throw std::runtime_error("TopK and TopP cannot be used with a beam search");
-
-  // Sanity checks
-  if (search.top_p < 0.0f || search.top_p > 1.0f)
-    throw std::runtime_error("top_p must be between 0.0 and 1.0");
-  if (search.top_k < 0)
-    throw std::runtime_error("top_k must be 0 or greater");
-
-  if (search.top_p > 0.0f && search.top_p < 1.0f && search.top_k > 1) {
-    search_->SampleTopKTopP(search.top_k, search.top_p, search.temperature);
-  } else if (search.top_k > 1) {
-    search_->SampleTopK(search.top_k, search.temperature);
-  } else {
-    assert(search.top_k == 0);
-    search_->SampleTopP(search.top_p, search.temperature);
-  }
+  last_action_ = Action::generated;
+  GenerateNextTokens(*search_);
 }
 
 void Generator::RewindToLength(size_t new_length) {
@@ -529,10 +533,34 @@ void Generator::RewindToLength(size_t new_length) {
   last_action_ = Action::rewound;
 }
 
+void Generator::SetDraftModel(const Model& draft_model, int draft_token_count) {
+  speculator_ = std::make_unique<Speculator>(*this, std::make_unique<DraftModelProposer>(draft_model, *state_->params_), draft_token_count);
+}
+
+std::span<const int32_t> Generator::SpeculateNextTokens() {
+  DurationTrace trace{"Generator::SpeculateNextTokens"};
+
+  ThrowErrorIfSessionTerminated(state_->session_terminated_);
+  if (!speculator_) {
+    auto& search = state_->params_->search;
+    if (search.prompt_lookup_num_tokens <= 0)
+      throw std::runtime_error("SpeculateNextTokens requires a draft model (see SetDraftModel) or the prompt_lookup_num_tokens search option");
+    speculator_ = std::make_unique<Speculator>(*this, std::make_unique<PromptLookupProposer>(search.prompt_lookup_max_ngram_size), search.prompt_lookup_num_tokens);
+  }
+  return speculator_->GenerateNextTokens();
+}
+
+const SpeculativeStats& Generator::GetSpeculativeStats() const {
+  static const SpeculativeStats no_stats;
+  return speculator_ ? speculator_->GetStats() : no_stats;
+}
+
 DeviceSpan<float> Generator::GetLogits() {
   if (!computed_logits_) {
     ComputeLogits(search_->GetNextTokens());
   }
+  if (top_k_head_)
+    throw std::runtime_error("GetLogits is not supported for models with a TopK or ArgMax head, which only output the top k tokens. Use GetOutput(\"top_k_logits\") and GetOutput(\"top_k_indices\") instead.");
   return search_->GetLogits();
 }
 
@@ -42,6 +42,8 @@ struct State;
 struct Search;
 struct Tokenizer;
 struct ConstrainedLogitsProcessor;
+struct Speculator;
+struct SpeculativeStats;
 struct ExtraInput {  // Extra inputs provided via SetInputs()
   std::string name;
   std::shared_ptr<Tensor> tensor;
@@ -80,6 +82,7 @@ struct GeneratorParams : std::enable_shared_from_this<GeneratorParams>, LeakChec
   int BatchBeamSize() const { return search.num_beams * search.batch_size; }
 
   DeviceInterface* p_device{};  // Scoring device (usually CPU, but can be CUDA)
+  const Model* model{};          // The model the parameters are for, null when created from a Config
 
   std::string guidance_type;  // e.g. json_schema or regex
   std::string guidance_data;  // e.g. rules data in json_schema or regex
@@ -88,11 +91,19 @@ struct GeneratorParams : std::enable_shared_from_this<GeneratorParams>, LeakChec
 
 struct Generator : LeakChecked<Generator> {
   Generator(const Model& model, const GeneratorParams& params);
+  ~Generator();
 
   bool IsDone() const;
   void AppendTokens(cpu_span<const int32_t> input_ids);
+  // Appends tokens whose key-value cache was already loaded into the state (see PrefixCache), without running the model
+  void AppendCachedTokens(cpu_span<const int32_t> input_ids);
   void GenerateNextToken();
   void RewindToLength(size_t new_length);  // Rewind state to new_length
+  // Speculative decoding (see speculative.h), the draft model proposes up to draft_token_count tokens per run of the model.
+  // Without a draft model, SpeculateNextTokens proposes tokens by prompt lookup if search.prompt_lookup_num_tokens is set
+  void SetDraftModel(const Model& draft_model, int draft_token_count);
+  std::span<const int32_t> SpeculateNextTokens();  // Appends one or more tokens and returns them
+  const SpeculativeStats& GetSpeculativeStats() const;
   DeviceSpan<float> GetLogits();
   void SetLogits(DeviceSpan<float> logits);
   void SetRuntimeOption(const char* key, const char* value);
@@ -108,6 +119,7 @@ struct Generator : LeakChecked<Generator> {
   std::unique_ptr<State> state_;
   std::unique_ptr<Search> search_;
   std::unique_ptr<ConstrainedLogitsProcessor> guidance_logits_processor_;
+  std::unique_ptr<Speculator> speculator_;
 
   bool computed_logits_{};       // Set to true in ComputeLogits() and false after appending a token to ensure a 1 to 1 call ratio
   bool set_extra_inputs_{true};  // Set to false once SetExtraInputs() is called once
@@ -119,6 +131,9 @@ struct Generator : LeakChecked<Generator> {
                 generated,  // Set after GenerateNextToken
                 rewound };  // Set after RewindToLength
   Action last_action_{standard};
+  bool top_k_head_{};  // Set to true when the model returned the top k tokens of an in-graph TopK or ArgMax head instead of the logits
+
+  friend struct Speculator;
 };
 
 struct OrtGlobals {
@@ -8,9 +8,11 @@
 // On process exit, ValidateShutdown() will call LeakTypeList::Dump() and print out any types that have leaked.
 
 namespace Generators {
+struct Engine;
 struct GeneratorParams;
 struct Generator;
 struct Model;
+struct PrefixCache;
 struct Search;
 struct Tensor;
 struct Tokenizer;
@@ -23,7 +25,7 @@ struct LeakTypeList {
   static bool Dump();
 };
 
-using LeakTypes = LeakTypeList<GeneratorParams, Generator, Model, Search, Tensor, Tokenizer, TokenizerStream>;
+using LeakTypes = LeakTypeList<Engine, GeneratorParams, Generator, Model, PrefixCache, Search, Tensor, Tokenizer, TokenizerStream>;
 
 template <typename T>
 struct LeakChecked {
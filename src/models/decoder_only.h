@@ -22,8 +22,10 @@ struct DecoderOnly_State : State {
   void SetExtraInputs(const std::vector<ExtraInput>& extra_inputs) override;
 
   DeviceSpan<float> Run(int total_length, DeviceSpan<int32_t>& next_tokens, DeviceSpan<int32_t> next_indices) override;
+  DeviceSpan<int64_t> GetTopKIndices() override { return logits_.GetTopKIndices(); }
 
   void RewindTo(size_t index) override;
+  KeyValueCache* GetKeyValueCache() override { return kv_cache_.get(); }
 
  private:
   void UpdateInputsOutputs(DeviceSpan<int32_t>& next_tokens, DeviceSpan<int32_t> beam_indices, int total_length);
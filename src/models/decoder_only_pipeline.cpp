@@ -5,6 +5,7 @@
 #include "../logging.h"
 #include "../tracing.h"
 #include "decoder_only_pipeline.h"
+#include "threadpool.h"
 #include "windowed_kv_cache.h"
 
 namespace Generators {
@@ -180,7 +181,16 @@ DecoderOnlyPipelineState::DecoderOnlyPipelineState(const DecoderOnlyPipelineMode
     }
 
     if (!partial_kv_cache_update_records_.empty()) {
-      key_value_cache_update_worker_thread_.emplace();
+      key_value_cache_update_thread_pool_ = model_.GetThreadPool();
+    }
+  }
+}
+
+DecoderOnlyPipelineState::~DecoderOnlyPipelineState() {
+  // The updates use the KV cache, which is destroyed before the records holding their futures
+  for (auto& record : partial_kv_cache_update_records_) {
+    if (record.outstanding_update.valid()) {
+      record.outstanding_update.wait();
     }
   }
 }
@@ -310,13 +320,13 @@ void DecoderOnlyPipelineState::RunPipeline(int total_length, DeviceSpan<int32_t>
 
     // If there is any partial KV cache update to start, enqueue it.
     if (partial_kv_cache_update_record) {
-      assert(key_value_cache_update_worker_thread_.has_value());
+      assert(key_value_cache_update_thread_pool_);
       auto update_fn = [&key_value_cache = *key_value_cache_.get(),
                         layer_indices = partial_kv_cache_update_record->layer_indices,
                         next_indices, total_length]() {
         key_value_cache.PartialUpdate(next_indices, total_length, layer_indices);
       };
-      partial_kv_cache_update_record->outstanding_update = key_value_cache_update_worker_thread_->Enqueue(update_fn);
+      partial_kv_cache_update_record->outstanding_update = key_value_cache_update_thread_pool_->Submit(update_fn);
     }
 
     // Transfer ownership of all the non-managed outputs from the current pipeline state to the ortvalue store.
@@ -4,9 +4,7 @@
 #pragma once
 
 #include <future>
-#include <optional>
 
-#include "../worker_thread.h"
 #include "model.h"
 #include "input_ids.h"
 #include "logits.h"
@@ -56,6 +54,8 @@ struct DecoderOnlyPipelineState : State {
   DecoderOnlyPipelineState(const DecoderOnlyPipelineModel& model, DeviceSpan<int32_t> sequence_lengths,
                            const GeneratorParams& params);
 
+  ~DecoderOnlyPipelineState();
+
   DecoderOnlyPipelineState(const DecoderOnlyPipelineState&) = delete;
   DecoderOnlyPipelineState& operator=(const DecoderOnlyPipelineState&) = delete;
 
@@ -94,7 +94,7 @@ struct DecoderOnlyPipelineState : State {
 
   std::unique_ptr<KeyValueCache> key_value_cache_;
   const bool do_key_value_cache_partial_update_;
-  std::optional<WorkerThread> key_value_cache_update_worker_thread_{};
+  std::shared_ptr<ThreadPool> key_value_cache_update_thread_pool_;  // The model's pool, runs the partial updates
 
   std::unique_ptr<PositionInputs> position_inputs_;
   ExtraInputs extra_inputs_{*this};
@@ -269,6 +269,40 @@ void DefaultKeyValueCache::RewindTo(size_t index) {
   }
 }
 
+void DefaultKeyValueCache::SetBatchRange(size_t begin, size_t count) {
+  if (!past_present_share_buffer_)
+    throw std::runtime_error("Running part of the batch requires past_present_share_buffer to be true");
+  if (begin + count > static_cast<size_t>(shape_[0]))
+    throw std::runtime_error("Batch range [" + std::to_string(begin) + ", " + std::to_string(begin + count) + ") exceeds the batch size " + std::to_string(shape_[0]));
+
+  std::array<int64_t, 4> view_shape = shape_;
+  view_shape[0] = static_cast<int64_t>(count);
+  const size_t entry_bytes = Ort::SizeOf(type_) * shape_[1] * shape_[2] * shape_[3];
+
+  batch_views_.resize(layer_count_ * 2);
+  for (int i = 0; i < layer_count_ * 2; ++i) {
+    auto* data = static_cast<uint8_t*>(presents_[i]->GetTensorMutableRawData()) + begin * entry_bytes;
+    batch_views_[i] = OrtValue::CreateTensor(presents_[i]->GetTensorMemoryInfo(), data, count * entry_bytes, view_shape, type_);
+    state_.inputs_[input_index_ + i] = batch_views_[i].get();
+    state_.outputs_[output_index_ + i] = batch_views_[i].get();
+  }
+}
+
+void DefaultKeyValueCache::CopyBatchEntry(size_t source, size_t dest, size_t length) {
+  assert(past_present_share_buffer_ && length <= static_cast<size_t>(shape_[2]));
+  const size_t element_size = Ort::SizeOf(type_);
+  const size_t head_bytes = element_size * shape_[2] * shape_[3];
+  const size_t length_bytes = element_size * length * shape_[3];
+
+  for (int i = 0; i < layer_count_ * 2; ++i) {
+    auto present = ByteWrapTensor(Device(), *presents_[i]);
+    for (int64_t head = 0; head < shape_[1]; head++) {
+      auto source_data = present.subspan((source * shape_[1] + head) * head_bytes, length_bytes);
+      present.subspan((dest * shape_[1] + head) * head_bytes, length_bytes).CopyFrom(source_data);
+    }
+  }
+}
+
 template <typename T>
 void DefaultKeyValueCache::RewindPastTensorsTo(size_t index) {
   assert(index > 0 && shape_[2] >= static_cast<int64_t>(index) && !past_present_share_buffer_);
@@ -326,6 +360,445 @@ void DefaultKeyValueCache::PickPastState(DeviceSpan<int32_t> beam_indices, int i
   }
 }
 
+QuantizedKeyValueCache::QuantizedKeyValueCache(State& state)
+    : state_{state},
+      layer_count_{model_.config_->model.decoder.num_hidden_layers},
+      shape_{state_.params_->BatchBeamSize(), model_.config_->model.decoder.num_key_value_heads, 0, model_.config_->model.decoder.head_size} {
+  if (g_log.enabled && g_log.warning && state_.params_->search.past_present_share_buffer)
+    Log("warning", "past_present_share_buffer search option set to true, but has been disabled due to the quantized key-value cache. See https://aka.ms/generate_config for details");
+  if (state_.params_->use_graph_capture)
+    throw std::runtime_error("Graph capture is not supported with the quantized key-value cache.");
+
+  const auto& inputs = model_.config_->model.decoder.inputs;
+  const auto& outputs = model_.config_->model.decoder.outputs;
+  if (inputs.past_value_scale_names.empty() || outputs.present_key_scale_names.empty() || outputs.present_value_scale_names.empty())
+    throw std::runtime_error("The quantized key-value cache requires past_key_scale_names, past_value_scale_names, present_key_scale_names, and present_value_scale_names to be set in the genai_config");
+
+  pasts_.resize(layer_count_ * TensorsPerLayer);
+  presents_.reserve(layer_count_ * TensorsPerLayer);
+
+  for (int i = 0; i < layer_count_; ++i) {
+    input_name_strings_.emplace_back(ComposeKeyValueName(inputs.past_key_names, i));
+    input_name_strings_.emplace_back(ComposeKeyValueName(inputs.past_value_names, i));
+    input_name_strings_.emplace_back(ComposeKeyValueName(inputs.past_key_scale_names, i));
+    input_name_strings_.emplace_back(ComposeKeyValueName(inputs.past_value_scale_names, i));
+
+    output_name_strings_.emplace_back(ComposeKeyValueName(outputs.present_key_names, i));
+    output_name_strings_.emplace_back(ComposeKeyValueName(outputs.present_value_names, i));
+    output_name_strings_.emplace_back(ComposeKeyValueName(outputs.present_key_scale_names, i));
+    output_name_strings_.emplace_back(ComposeKeyValueName(outputs.present_value_scale_names, i));
+  }
+
+  // Derive the KV and scale data types from the inputs of layer 0
+  type_ = model_.session_info_.GetInputDataType(input_name_strings_[0]);
+  scale_type_ = model_.session_info_.GetInputDataType(input_name_strings_[2]);
+  empty_past_ = OrtValue::CreateTensor(Allocator(), GetShape(0), type_);
+  empty_past_scale_ = OrtValue::CreateTensor(Allocator(), GetShape(2), scale_type_);
+
+  for (int i = 0; i < layer_count_ * TensorsPerLayer; ++i)
+    presents_.push_back(OrtValue::CreateTensor(Allocator(), GetShape(i), GetType(i)));
+}
+
+std::array<int64_t, 4> QuantizedKeyValueCache::GetShape(int index) const {
+  auto shape = shape_;
+  if (IsScale(index))
+    shape[3] = 1;
+  return shape;
+}
+
+void QuantizedKeyValueCache::Add() {
+  input_index_ = state_.inputs_.size();
+  output_index_ = state_.outputs_.size();
+
+  for (int i = 0; i < layer_count_ * TensorsPerLayer; ++i) {
+    state_.inputs_.push_back(IsScale(i) ? empty_past_scale_.get() : empty_past_.get());  // Set empty past here, Update() takes care of the rest
+    state_.input_names_.push_back(input_name_strings_[i].c_str());
+    state_.outputs_.push_back(presents_[i].get());
+    state_.output_names_.push_back(output_name_strings_[i].c_str());
+  }
+}
+
+void QuantizedKeyValueCache::Update(DeviceSpan<int32_t> beam_indices, int total_length) {
+  if (!is_first_update_) {
+    std::span<int32_t> beam_indices_cpu;
+    if (!beam_indices.empty())
+      beam_indices_cpu = beam_indices.CopyDeviceToCpu();
+
+    for (int i = 0; i < layer_count_ * TensorsPerLayer; i++) {
+      if (beam_indices_cpu.empty()) {
+        pasts_[i] = std::move(presents_[i]);
+      } else {
+        PickPastState(beam_indices_cpu, i);
+      }
+      state_.inputs_[input_index_ + i] = pasts_[i].get();
+    }
+  }
+
+  shape_[2] = total_length;
+  for (int i = 0; i < layer_count_ * TensorsPerLayer; i++) {
+    presents_[i] = OrtValue::CreateTensor(Allocator(), GetShape(i), GetType(i));
+    state_.outputs_[output_index_ + i] = presents_[i].get();
+  }
+
+  is_first_update_ = false;
+}
+
+void QuantizedKeyValueCache::RewindTo(size_t index) {
+  if (shape_[2] <= static_cast<int>(index))
+    throw std::runtime_error("Requested length of rewind is greater than the current length.");
+
+  is_first_update_ = true;
+  if (index == 0) {
+    for (int i = 0; i < layer_count_ * TensorsPerLayer; i++) {
+      pasts_[i] = nullptr;
+      state_.inputs_[input_index_ + i] = IsScale(i) ? empty_past_scale_.get() : empty_past_.get();
+    }
+  } else {
+    RewindPastTensorsTo(index);
+  }
+}
+
+// Copies the first 'index' positions of each present to the pasts. Done on bytes, as the tensors are int8 and float
+void QuantizedKeyValueCache::RewindPastTensorsTo(size_t index) {
+  assert(index > 0 && shape_[2] >= static_cast<int64_t>(index));
+  const auto old_length = static_cast<size_t>(shape_[2]);
+  shape_[2] = static_cast<int64_t>(index);
+  const auto batch_x_num_heads = static_cast<size_t>(shape_[0] * shape_[1]);
+
+  for (int i = 0; i < layer_count_ * TensorsPerLayer; i++) {
+    auto shape = GetShape(i);
+    const size_t position_bytes = Ort::SizeOf(GetType(i)) * shape[3];
+    std::unique_ptr<OrtValue> past = OrtValue::CreateTensor(Allocator(), shape, GetType(i));
+
+    auto past_bytes = ByteWrapTensor(Device(), *past);
+    auto present_bytes = ByteWrapTensor(Device(), *presents_[i]);
+
+    for (size_t j = 0; j < batch_x_num_heads; j++) {
+      auto present_data = present_bytes.subspan(j * old_length * position_bytes, index * position_bytes);
+      past_bytes.subspan(j * index * position_bytes, index * position_bytes).CopyFrom(present_data);
+    }
+    pasts_[i] = std::move(past);
+    state_.inputs_[input_index_ + i] = pasts_[i].get();
+  }
+}
+
+// Copy present state to past state reordered by the beam_indices
+void QuantizedKeyValueCache::PickPastState(std::span<const int32_t> beam_indices, int index) {
+  auto shape = GetShape(index);
+  const size_t beam_bytes = Ort::SizeOf(GetType(index)) * shape[1] * shape[2] * shape[3];
+  std::unique_ptr<OrtValue> past_value = OrtValue::CreateTensor(Allocator(), shape, GetType(index));
+
+  auto past_bytes = ByteWrapTensor(Device(), *past_value);
+  auto present_bytes = ByteWrapTensor(Device(), *presents_[index]);
+
+  for (size_t j = 0; j < beam_indices.size(); j++) {
+    auto present = present_bytes.subspan(beam_indices[j] * beam_bytes, beam_bytes);
+    past_bytes.subspan(j * beam_bytes, beam_bytes).CopyFrom(present);
+  }
+
+  pasts_[index] = std::move(past_value);
+}
+
+KeyValueBlockPool::KeyValueBlockPool(DeviceInterface& device, int layer_count, int num_key_value_heads, int head_size, int block_size, ONNXTensorElementDataType type)
+    : device_{device},
+      layer_count_{layer_count},
+      num_key_value_heads_{num_key_value_heads},
+      head_size_{head_size},
+      block_size_{block_size},
+      type_{type},
+      position_bytes_{Ort::SizeOf(type) * head_size},
+      block_bytes_{position_bytes_ * block_size * num_key_value_heads * layer_count * 2} {
+  if (block_size_ <= 0)
+    throw std::runtime_error("paged_key_value_cache block_size must be greater than 0");
+}
+
+int KeyValueBlockPool::Allocate() {
+  std::lock_guard<std::mutex> lock{mutex_};
+  if (free_blocks_.empty()) {
+    const int first_block = static_cast<int>(ref_counts_.size());
+    ref_counts_.resize(ref_counts_.size() + BlocksPerChunk);
+    chunks_.emplace_back();
+    chunk_blocks_in_use_.push_back(0);
+    for (int i = 0; i < BlocksPerChunk; i++)
+      free_blocks_.insert(free_blocks_.end(), first_block + i);
+  }
+
+  const int block = *free_blocks_.begin();
+  free_blocks_.erase(free_blocks_.begin());
+  const int chunk = block / BlocksPerChunk;
+  if (chunk_blocks_in_use_[chunk]++ == 0)
+    chunks_[chunk] = device_.Allocate<uint8_t>(block_bytes_ * BlocksPerChunk);
+  ref_counts_[block] = 1;
+  max_blocks_in_use_ = std::max(max_blocks_in_use_, ++blocks_in_use_);
+  return block;
+}
+
+void KeyValueBlockPool::AddRef(int block) {
+  std::lock_guard<std::mutex> lock{mutex_};
+  assert(ref_counts_[block] > 0);
+  ref_counts_[block]++;
+}
+
+void KeyValueBlockPool::Release(int block) {
+  std::lock_guard<std::mutex> lock{mutex_};
+  assert(ref_counts_[block] > 0);
+  if (--ref_counts_[block] > 0)
+    return;
+
+  free_blocks_.insert(block);
+  blocks_in_use_--;
+  const int chunk = block / BlocksPerChunk;
+  if (--chunk_blocks_in_use_[chunk] == 0)
+    chunks_[chunk] = {};
+}
+
+int KeyValueBlockPool::CopyOnWrite(int block, int begin) {
+  {
+    std::lock_guard<std::mutex> lock{mutex_};
+    if (ref_counts_[block] == 1)
+      return block;
+    blocks_copied_++;
+  }
+
+  // Keep the positions before the ones being written
+  const int copy = Allocate();
+  if (begin > 0) {
+    for (int layer_kv = 0; layer_kv < layer_count_ * 2; layer_kv++) {
+      for (int head = 0; head < num_key_value_heads_; head++)
+        Span(copy, layer_kv, head, 0, begin).CopyFrom(Span(block, layer_kv, head, 0, begin));
+    }
+  }
+  Release(block);
+  return copy;
+}
+
+DeviceSpan<uint8_t> KeyValueBlockPool::Span(int block, int layer_kv, int head, int begin, int count) {
+  assert(begin + count <= block_size_);
+  size_t offset = (block % BlocksPerChunk) * block_bytes_ +
+                  ((static_cast<size_t>(layer_kv) * num_key_value_heads_ + head) * block_size_ + begin) * position_bytes_;
+  std::lock_guard<std::mutex> lock{mutex_};
+  assert(ref_counts_[block] > 0);
+  return chunks_[block / BlocksPerChunk].subspan(offset, count * position_bytes_);
+}
+
+KeyValueBlockPoolStats KeyValueBlockPool::GetStats() {
+  std::lock_guard<std::mutex> lock{mutex_};
+  KeyValueBlockPoolStats stats;
+  stats.block_bytes = block_bytes_;
+  stats.blocks_in_use = blocks_in_use_;
+  stats.max_blocks_in_use = max_blocks_in_use_;
+  const auto chunks_allocated = std::count_if(chunks_.begin(), chunks_.end(), [](const auto& chunk) { return !chunk.empty(); });
+  stats.bytes_allocated = static_cast<size_t>(chunks_allocated) * BlocksPerChunk * block_bytes_;
+  stats.blocks_copied = blocks_copied_;
+  return stats;
+}
+
+PagedKeyValueCache::PagedKeyValueCache(State& state)
+    : state_{state},
+      layer_count_{model_.config_->model.decoder.num_hidden_layers},
+      shape_{state_.params_->BatchBeamSize(), model_.config_->model.decoder.num_key_value_heads, 0, model_.config_->model.decoder.head_size} {
+  if (state_.params_->use_graph_capture)
+    throw std::runtime_error("Graph capture is not supported with paged_key_value_cache.");
+  if (g_log.enabled && g_log.warning && state_.params_->search.past_present_share_buffer)
+    Log("warning", "past_present_share_buffer search option set to true, but has been disabled since paged_key_value_cache is set.");
+
+  pasts_.resize(layer_count_ * 2);
+  presents_.resize(layer_count_ * 2);
+
+  for (int i = 0; i < layer_count_; ++i) {
+    input_name_strings_.emplace_back(ComposeKeyValueName(model_.config_->model.decoder.inputs.past_key_names, i));
+    input_name_strings_.emplace_back(ComposeKeyValueName(model_.config_->model.decoder.inputs.past_value_names, i));
+
+    output_name_strings_.emplace_back(ComposeKeyValueName(model_.config_->model.decoder.outputs.present_key_names, i));
+    output_name_strings_.emplace_back(ComposeKeyValueName(model_.config_->model.decoder.outputs.present_value_names, i));
+  }
+
+  // Derive the KV data type from the KV input 0
+  type_ = model_.session_info_.GetInputDataType(input_name_strings_[0]);
+  empty_past_ = OrtValue::CreateTensor(Allocator(), shape_, type_);
+
+  {
+    std::lock_guard<std::mutex> lock{model_.kv_block_pool_mutex_};
+    if (!model_.kv_block_pool_)
+      model_.kv_block_pool_ = std::make_shared<KeyValueBlockPool>(Device(), layer_count_, static_cast<int>(shape_[1]), static_cast<int>(shape_[3]),
+                                                                  model_.config_->model.decoder.paged_key_value_cache->block_size, type_);
+    pool_ = model_.kv_block_pool_;
+  }
+
+  block_tables_.resize(shape_[0]);
+}
+
+PagedKeyValueCache::~PagedKeyValueCache() {
+  TruncateBlockTables(0);
+}
+
+void PagedKeyValueCache::Add() {
+  input_index_ = state_.inputs_.size();
+  output_index_ = state_.outputs_.size();
+
+  for (int i = 0; i < layer_count_ * 2; ++i) {
+    state_.inputs_.push_back(empty_past_.get());  // Set empty past here, Update() takes care of the rest
+    state_.input_names_.push_back(input_name_strings_[i].c_str());
+    state_.outputs_.push_back(nullptr);
+    state_.output_names_.push_back(output_name_strings_[i].c_str());
+  }
+}
+
+void PagedKeyValueCache::Update(DeviceSpan<int32_t> beam_indices, int total_length) {
+  // The presents are already stored if the state called AfterRun
+  if (has_presents_)
+    StorePresents(static_cast<size_t>(shape_[2]));
+  if (!is_first_update_ && !beam_indices.empty())
+    ReorderBlockTables(beam_indices);
+  GatherPasts();
+
+  shape_[2] = total_length;
+  for (int i = 0; i < layer_count_ * 2; i++) {
+    presents_[i] = OrtValue::CreateTensor(Allocator(), shape_, type_);
+    state_.outputs_[output_index_ + i] = presents_[i].get();
+  }
+
+  has_presents_ = true;
+  is_first_update_ = false;
+}
+
+void PagedKeyValueCache::AfterRun() {
+  StorePresents(static_cast<size_t>(shape_[2]));
+}
+
+void PagedKeyValueCache::RewindTo(size_t index) {
+  if (GetLength() < index) {
+    throw std::runtime_error("Requested length of rewind is greater than the current length.");
+  }
+
+  // Only the positions that are kept need to be stored, the rest are dropped along with the tail blocks
+  if (has_presents_)
+    StorePresents(index);
+  TruncateBlockTables(index);
+  is_first_update_ = true;
+}
+
+std::vector<int> PagedKeyValueCache::ReferenceBlocks(size_t length) {
+  if (block_tables_.size() != 1)
+    throw std::runtime_error("Sharing the key-value cache requires a batch_size and num_beams of 1");
+  if (length > GetLength())
+    throw std::runtime_error("Requested length (" + std::to_string(length) + ") is greater than the key-value cache length (" + std::to_string(GetLength()) + ")");
+
+  if (has_presents_)
+    StorePresents(static_cast<size_t>(shape_[2]));
+
+  const size_t block_count = (length + pool_->BlockSize() - 1) / pool_->BlockSize();
+  std::vector<int> blocks(block_tables_[0].begin(), block_tables_[0].begin() + block_count);
+  for (int block : blocks)
+    pool_->AddRef(block);
+  return blocks;
+}
+
+void PagedKeyValueCache::SetBlocks(std::span<const int> blocks, size_t length) {
+  if (block_tables_.size() != 1)
+    throw std::runtime_error("Sharing the key-value cache requires a batch_size and num_beams of 1");
+  if (GetLength() != 0)
+    throw std::runtime_error("The key-value cache must be empty to start it from shared blocks");
+  assert(blocks.size() == (length + pool_->BlockSize() - 1) / pool_->BlockSize());
+
+  for (int block : blocks)
+    pool_->AddRef(block);
+  block_tables_[0].assign(blocks.begin(), blocks.end());
+  stored_length_ = length;
+}
+
+void PagedKeyValueCache::StorePresents(size_t length) {
+  const int block_size = pool_->BlockSize();
+  const size_t position_bytes = Ort::SizeOf(type_) * shape_[3];
+  const size_t present_length = static_cast<size_t>(shape_[2]);
+
+  for (size_t beam = 0; beam < block_tables_.size(); beam++) {
+    auto& block_table = block_tables_[beam];
+    for (size_t position = stored_length_; position < length;) {
+      const size_t block_index = position / block_size;
+      const int begin = static_cast<int>(position % block_size);
+      const int count = static_cast<int>(std::min(length - position, static_cast<size_t>(block_size - begin)));
+
+      if (block_index == block_table.size())
+        block_table.push_back(pool_->Allocate());
+      else
+        block_table[block_index] = pool_->CopyOnWrite(block_table[block_index], begin);
+
+      for (int layer_kv = 0; layer_kv < layer_count_ * 2; layer_kv++) {
+        auto present = ByteWrapTensor(Device(), *presents_[layer_kv]);
+        for (int head = 0; head < shape_[1]; head++) {
+          auto source = present.subspan(((beam * shape_[1] + head) * present_length + position) * position_bytes, count * position_bytes);
+          pool_->Span(block_table[block_index], layer_kv, head, begin, count).CopyFrom(source);
+        }
+      }
+      position += count;
+    }
+  }
+  stored_length_ = std::max(stored_length_, length);
+
+  // The blocks hold the cache now
+  for (int i = 0; i < layer_count_ * 2; i++) {
+    pasts_[i] = nullptr;
+    presents_[i] = nullptr;
+    state_.inputs_[input_index_ + i] = empty_past_.get();
+    state_.outputs_[output_index_ + i] = nullptr;
+  }
+  has_presents_ = false;
+}
+
+void PagedKeyValueCache::GatherPasts() {
+  if (stored_length_ == 0)
+    return;  // StorePresents left the empty past as the input
+
+  const int block_size = pool_->BlockSize();
+  const size_t position_bytes = Ort::SizeOf(type_) * shape_[3];
+  std::array<int64_t, 4> past_shape = shape_;
+  past_shape[2] = static_cast<int64_t>(stored_length_);
+
+  for (int layer_kv = 0; layer_kv < layer_count_ * 2; layer_kv++) {
+    pasts_[layer_kv] = OrtValue::CreateTensor(Allocator(), past_shape, type_);
+    auto past = ByteWrapTensor(Device(), *pasts_[layer_kv]);
+    for (size_t beam = 0; beam < block_tables_.size(); beam++) {
+      for (int head = 0; head < shape_[1]; head++) {
+        for (size_t position = 0; position < stored_length_; position += block_size) {
+          const int count = static_cast<int>(std::min(stored_length_ - position, static_cast<size_t>(block_size)));
+          auto dest = past.subspan(((beam * shape_[1] + head) * stored_length_ + position) * position_bytes, count * position_bytes);
+          dest.CopyFrom(pool_->Span(block_tables_[beam][position / block_size], layer_kv, head, 0, count));
+        }
+      }
+    }
+    state_.inputs_[input_index_ + layer_kv] = pasts_[layer_kv].get();
+  }
+}
+
+void PagedKeyValueCache::ReorderBlockTables(DeviceSpan<int32_t> beam_indices_device) {
+  std::span<const int32_t> beam_indices = beam_indices_device.CopyDeviceToCpu();
+
+  std::vector<std::vector<int>> block_tables(block_tables_.size());
+  for (size_t j = 0; j < beam_indices.size(); j++) {
+    block_tables[j] = block_tables_[beam_indices[j]];
+    for (int block : block_tables[j])
+      pool_->AddRef(block);
+  }
+
+  for (auto& block_table : block_tables_) {
+    for (int block : block_table)
+      pool_->Release(block);
+  }
+  block_tables_ = std::move(block_tables);
+}
+
+void PagedKeyValueCache::TruncateBlockTables(size_t length) {
+  const size_t block_count = (length + pool_->BlockSize() - 1) / pool_->BlockSize();
+  for (auto& block_table : block_tables_) {
+    while (block_table.size() > block_count) {
+      pool_->Release(block_table.back());
+      block_table.pop_back();
+    }
+  }
+  stored_length_ = std::min(stored_length_, length);
+}
+
 CrossCache::CrossCache(State& state, int sequence_length) {
   const Model& model = state.model_;
   auto& allocator = state.model_.p_device_kvcache_->GetAllocator();
@@ -418,12 +891,25 @@ std::unique_ptr<KeyValueCache> CreateKeyValueCache(State& state) {
     return nullptr;
   }
 
+  if (!state.model_.config_->model.decoder.inputs.past_key_scale_names.empty()) {
+    if (state.model_.config_->model.decoder.paged_key_value_cache ||
+        (state.model_.config_->model.decoder.sliding_window && state.model_.config_->model.decoder.sliding_window->slide_key_value_cache))
+      throw std::runtime_error("The quantized key-value cache is not supported with paged_key_value_cache or slide_key_value_cache.");
+    return std::make_unique<QuantizedKeyValueCache>(state);
+  }
+
   if (state.model_.p_device_->GetType() != DeviceType::NvTensorRtRtx &&
       state.model_.config_->model.decoder.sliding_window &&
       state.model_.config_->model.decoder.sliding_window->slide_key_value_cache) {
     return std::make_unique<WindowedKeyValueCache>(state);
   }
 
+  if (state.model_.config_->model.decoder.paged_key_value_cache) {
+    if (state.model_.config_->model.decoder.sliding_window)
+      throw std::runtime_error("paged_key_value_cache is not supported with sliding_window.");
+    return std::make_unique<PagedKeyValueCache>(state);
+  }
+
   return std::make_unique<DefaultKeyValueCache>(state);
 }
 
@@ -16,6 +16,9 @@ struct KeyValueCache {
 
   virtual void RewindTo(size_t index) = 0;
 
+  // Called once the model has run, so a cache can move the presents into storage of its own before the next Update
+  virtual void AfterRun() {}
+
   // Note: PartialUpdate() is mainly for supporting DecoderOnlyPipelineState usage where we update
   // part of the KV cache after running part of the pipeline.
   // An alternative may be to have a dedicated KV cache per IntermediatePipelineState.
@@ -75,6 +78,12 @@ struct DefaultKeyValueCache : KeyValueCache {
   void Update(DeviceSpan<int32_t> beam_indices, int total_length) override;
   void RewindTo(size_t index) override;
 
+  // Used by the Engine to run part of the batch. Points the inputs & outputs at 'count' batch entries starting at 'begin'
+  // (requires past_present_share_buffer, so the entries are views into the shared buffers)
+  void SetBatchRange(size_t begin, size_t count);
+  // Copies the first 'length' positions of batch entry 'source' into batch entry 'dest'
+  void CopyBatchEntry(size_t source, size_t dest, size_t length);
+
  private:
   template <typename ScoreType>
   void PickPastState(DeviceSpan<int32_t> beam_indices, int index);
@@ -97,6 +106,153 @@ struct DefaultKeyValueCache : KeyValueCache {
   std::array<int64_t, 4> shape_;
   ONNXTensorElementDataType type_;
 
+  std::unique_ptr<OrtValue> empty_past_;
+  std::vector<std::unique_ptr<OrtValue>> pasts_, presents_;
+  std::vector<std::unique_ptr<OrtValue>> batch_views_;  // Views of part of the batch, see SetBatchRange
+  std::vector<std::string> input_name_strings_, output_name_strings_;
+};
+
+// For models that store the key-value cache as int8 with a float scale per position of each head (built with the
+// kv_cache_int8 option). The model dequantizes the past and quantizes the new positions of the present itself, so this
+// works like the DefaultKeyValueCache without past_present_share_buffer, over 4 tensors per layer (key, value, key scale,
+// value scale) of any element type. Every step, the model dequantizes the whole past and copies it into a new present,
+// trading decode speed for memory. The Engine doesn't support it, since it can't run part of the batch.
+struct QuantizedKeyValueCache : KeyValueCache {
+  QuantizedKeyValueCache(State& state);
+
+  void Add() override;
+  void Update(DeviceSpan<int32_t> beam_indices, int total_length) override;
+  void RewindTo(size_t index) override;
+
+ private:
+  static constexpr int TensorsPerLayer = 4;
+
+  bool IsScale(int index) const { return index % TensorsPerLayer >= 2; }
+  std::array<int64_t, 4> GetShape(int index) const;  // The scales have a head_size of 1
+  ONNXTensorElementDataType GetType(int index) const { return IsScale(index) ? scale_type_ : type_; }
+
+  void PickPastState(std::span<const int32_t> beam_indices, int index);
+  void RewindPastTensorsTo(size_t index);
+
+  DeviceInterface& Device() { return *model_.p_device_kvcache_; }
+  Ort::Allocator& Allocator() { return model_.p_device_kvcache_->GetAllocator(); }
+
+  State& state_;
+  const Model& model_{state_.model_};
+  int layer_count_;
+  size_t input_index_{~0U}, output_index_{~0U};
+
+  bool is_first_update_{true};
+
+  std::array<int64_t, 4> shape_;
+  ONNXTensorElementDataType type_, scale_type_;
+
+  std::unique_ptr<OrtValue> empty_past_, empty_past_scale_;
+  std::vector<std::unique_ptr<OrtValue>> pasts_, presents_;
+  std::vector<std::string> input_name_strings_, output_name_strings_;
+};
+
+struct KeyValueBlockPoolStats {
+  size_t block_bytes{};
+  size_t blocks_in_use{};
+  size_t max_blocks_in_use{};  // Most blocks that have been in use at once
+  size_t bytes_allocated{};    // Memory of the chunks that have blocks in use
+  size_t blocks_copied{};      // Blocks copied because they were written while shared
+};
+
+// Fixed size blocks of key-value cache memory, shared by all PagedKeyValueCaches of a model.
+// A block holds 'block_size' token positions of every layer, laid out as [layer_count * 2, num_key_value_heads, block_size, head_size]
+// Blocks are reference counted so that sequences can share them, and are reused once released. The lowest free block is
+// handed out first, so the blocks in use pack into the first chunks and a chunk is freed once none of its blocks are in use.
+struct KeyValueBlockPool {
+  KeyValueBlockPool(DeviceInterface& device, int layer_count, int num_key_value_heads, int head_size, int block_size, ONNXTensorElementDataType type);
+
+  int BlockSize() const { return block_size_; }
+  size_t BlockBytes() const { return block_bytes_; }
+  ONNXTensorElementDataType GetType() const { return type_; }
+
+  int Allocate();  // Returns a block with a reference count of 1
+  void AddRef(int block);
+  void Release(int block);
+  // Returns a block that positions [begin, block_size) can be written to: the block itself, or if it is shared, a copy of
+  // its first 'begin' positions (releasing the reference to the shared block)
+  int CopyOnWrite(int block, int begin);
+
+  // The bytes of positions [begin, begin + count) of one head of one key or value tensor ('layer_kv' is layer * 2 + is_value)
+  DeviceSpan<uint8_t> Span(int block, int layer_kv, int head, int begin, int count);
+
+  KeyValueBlockPoolStats GetStats();
+
+ private:
+  static constexpr int BlocksPerChunk = 64;  // Memory is allocated in chunks of blocks, to avoid an allocation per block
+
+  DeviceInterface& device_;
+  int layer_count_, num_key_value_heads_, head_size_, block_size_;
+  ONNXTensorElementDataType type_;
+  size_t position_bytes_;  // Bytes of one position of one head
+  size_t block_bytes_;
+
+  std::mutex mutex_;
+  std::vector<DeviceSpan<uint8_t>> chunks_;  // Empty once a chunk has no blocks in use
+  std::vector<int> chunk_blocks_in_use_;
+  std::vector<int> ref_counts_;
+  std::set<int> free_blocks_;
+  size_t blocks_in_use_{}, max_blocks_in_use_{}, blocks_copied_{};
+};
+
+// Stores the key-value cache of each sequence as a table of blocks from the model's KeyValueBlockPool, which is the only
+// memory it keeps between runs. Memory grows one block at a time instead of being reserved to max_length, RewindTo only
+// drops blocks from the tables, and beam search reorders tables instead of copying the cache (a block that is written
+// while shared is copied first).
+// The attention ops take a contiguous past and produce a contiguous present, so for each run the past is gathered from
+// the blocks, and once it is done the new positions of the present are stored into them and both are freed.
+// This makes every decode step copy the whole past of every layer out of the blocks, on top of the attention op copying
+// it into the present. The past can't be gathered incrementally, since each head's positions move whenever the length
+// grows, and keeping the present of the last run as the next past would keep a second copy of the cache between runs.
+// So a step costs O(length) copies instead of the O(1) writes of the DefaultKeyValueCache with past_present_share_buffer,
+// and while a run is in flight the gathered pasts and the presents of all layers are allocated next to the blocks.
+struct PagedKeyValueCache : KeyValueCache {
+  PagedKeyValueCache(State& state);
+  ~PagedKeyValueCache() override;
+
+  void Add() override;
+  void Update(DeviceSpan<int32_t> beam_indices, int total_length) override;
+  void RewindTo(size_t index) override;
+  void AfterRun() override;
+
+  // Used by the PrefixCache to share the blocks of a batch with a single sequence
+  size_t GetLength() const { return has_presents_ ? static_cast<size_t>(shape_[2]) : stored_length_; }
+  // Returns the blocks holding the first 'length' positions, each with a reference the caller must release
+  std::vector<int> ReferenceBlocks(size_t length);
+  // Starts an empty cache from blocks holding 'length' positions (adding a reference to each). RewindTo(length) must follow
+  void SetBlocks(std::span<const int> blocks, size_t length);
+  const std::shared_ptr<KeyValueBlockPool>& GetPool() const { return pool_; }
+
+ private:
+  // Stores positions [stored_length_, length) of the presents in the blocks, then frees the pasts and presents of the run
+  void StorePresents(size_t length);
+  void GatherPasts();  // Create the pasts from the first stored_length_ positions of the blocks
+  void ReorderBlockTables(DeviceSpan<int32_t> beam_indices);
+  void TruncateBlockTables(size_t length);
+
+  DeviceInterface& Device() { return *model_.p_device_kvcache_; }
+  Ort::Allocator& Allocator() { return model_.p_device_kvcache_->GetAllocator(); }
+
+  State& state_;
+  const Model& model_{state_.model_};
+  int layer_count_;
+  size_t input_index_{~0U}, output_index_{~0U};
+
+  bool is_first_update_{true};
+  bool has_presents_{};  // The presents of a run that aren't stored in the blocks yet
+
+  std::array<int64_t, 4> shape_;
+  ONNXTensorElementDataType type_;
+
+  std::shared_ptr<KeyValueBlockPool> pool_;
+  std::vector<std::vector<int>> block_tables_;  // Blocks of each sequence of the batch
+  size_t stored_length_{};                      // Number of positions of each sequence held in the blocks
+
   std::unique_ptr<OrtValue> empty_past_;
   std::vector<std::unique_ptr<OrtValue>> pasts_, presents_;
   std::vector<std::string> input_name_strings_, output_name_strings_;
@@ -7,10 +7,28 @@
 
 namespace Generators {
 
+namespace {
+
+// Models with an in-graph TopK or ArgMax head return the token ids of the top k logits instead of the logits
+bool HasTopKHead(const Model& model) {
+  const auto& outputs = model.config_->model.decoder.outputs;
+  return !model.session_info_.HasOutput(outputs.logits) && model.session_info_.HasOutput(outputs.top_k_indices);
+}
+
+ONNXTensorElementDataType GetLogitsType(const Model& model) {
+  const auto& outputs = model.config_->model.decoder.outputs;
+  if (HasTopKHead(model))
+    return model.session_info_.HasOutput(outputs.top_k_logits) ? model.session_info_.GetOutputDataType(outputs.top_k_logits)
+                                                                : Ort::TypeToTensorType<float>;
+  return model.session_info_.GetOutputDataType(outputs.logits);
+}
+
+}  // namespace
+
 Logits::Logits(State& state)
     : state_{state},
       shape_{static_cast<int64_t>(state_.params_->BatchBeamSize()), 0, model_.config_->model.vocab_size},
-      type_{model_.session_info_.GetOutputDataType(model_.config_->model.decoder.outputs.logits)} {
+      type_{GetLogitsType(model_)} {
   output_raw_ = std::make_unique<Tensor>(model_.p_device_inputs_, type_);
 
   input_sequence_lengths.resize(state_.params_->search.batch_size);
@@ -25,9 +43,43 @@ Logits::Logits(State& state)
 
     trimmed_prefill_logits_ = true;
   }
+
+  if (model_.session_info_.HasInput(model_.config_->model.decoder.inputs.last_token_indices)) {
+    // The model gathers the hidden states of the last tokens before the LM head, so it only returns their logits.
+    if (g_log.enabled)
+      Log("info", "Logits: Using Trimmed Prefill Logits from last_token_indices");
+
+    trimmed_prefill_logits_ = true;
+    last_token_indices_ = std::make_unique<Tensor>(model_.p_device_inputs_, Ort::TypeToTensorType<int64_t>);
+    const std::array<int64_t, 1> last_token_indices_shape{shape_[0]};
+    last_token_indices_->CreateTensor(last_token_indices_shape, state_.params_->use_graph_capture);
+  }
+
+  if (HasTopKHead(model_)) {
+    if (!trimmed_prefill_logits_)
+      throw std::runtime_error("Models with a TopK or ArgMax head must also have the last_token_indices input");
+    if (g_log.enabled)
+      Log("info", "Logits: Using TopK Head");
+
+    top_k_head_ = true;
+    has_top_k_logits_ = model_.session_info_.HasOutput(model_.config_->model.decoder.outputs.top_k_logits);
+    // The top k logits and token ids are always [batch_size*num_beams, 1, k]
+    shape_[1] = 1;
+    shape_[2] = model_.session_info_.GetOutputShape(model_.config_->model.decoder.outputs.top_k_indices).back();
+    top_k_indices_ = std::make_unique<Tensor>(model_.p_device_inputs_, Ort::TypeToTensorType<int64_t>);
+  }
+}
+
+DeviceSpan<int64_t> Logits::GetTopKIndices() {
+  if (!top_k_head_)
+    return {};
+  return top_k_indices_->GetDeviceSpan<int64_t>();
 }
 
 DeviceSpan<float> Logits::Get() {
+  if (top_k_head_ && !has_top_k_logits_)
+    return {};
+
   size_t element_count = shape_[0] * shape_[1] * shape_[2];
 
   // The model's output logits are {batch_size*num_beams, input_seq_len, vocab_size}
@@ -79,11 +131,14 @@ DeviceSpan<float> Logits::Get() {
 }
 
 void Logits::Update(const DeviceSpan<int32_t>& next_tokens, size_t new_kv_length) {
-  if (trimmed_prefill_logits_) {
-    new_kv_length = 1;
-  }
-
-  if (output_raw_->ort_tensor_ && static_cast<size_t>(output_raw_->GetShape()[1]) == new_kv_length && new_kv_length == 1) {
+  // Trimmed logits only hold the last token of each sequence, even for the prompt
+  const size_t logits_length = trimmed_prefill_logits_ ? 1 : new_kv_length;
+  // The token ids are always returned by a TopK or ArgMax head, but the top k logits are not returned by an ArgMax head
+  const auto& output = top_k_head_ ? *top_k_indices_ : *output_raw_;
+
+  if (output.ort_tensor_ && static_cast<size_t>(output.GetShape()[1]) == logits_length && new_kv_length == 1) {
+    if (last_token_indices_ && last_token_indices_kv_length_ != 1)
+      UpdateLastTokenIndices(new_kv_length);
     return;
   }
 
@@ -99,20 +154,62 @@ void Logits::Update(const DeviceSpan<int32_t>& next_tokens, size_t new_kv_length
     input_sequence_lengths[b] = static_cast<int>(token_index + 1);
   }
 
-  if (output_raw_->ort_tensor_ && static_cast<size_t>(output_raw_->GetShape()[1]) == new_kv_length) {
+  if (last_token_indices_)
+    UpdateLastTokenIndices(new_kv_length);
+
+  if (output.ort_tensor_ && static_cast<size_t>(output.GetShape()[1]) == logits_length) {
+    return;
+  }
+
+  if (top_k_head_) {
+    top_k_indices_->CreateTensor(shape_, state_.params_->use_graph_capture);
+    state_.outputs_[top_k_indices_index_] = top_k_indices_->GetOrtTensor();
+    if (has_top_k_logits_) {
+      output_raw_->CreateTensor(shape_, state_.params_->use_graph_capture);
+      state_.outputs_[output_index_] = output_raw_->GetOrtTensor();
+    }
     return;
   }
 
-  shape_[1] = new_kv_length;
+  shape_[1] = logits_length;
   output_raw_->CreateTensor(shape_, state_.params_->use_graph_capture && shape_[1] == 1);
   state_.outputs_[output_index_] = output_raw_->GetOrtTensor();
 }
 
+void Logits::UpdateLastTokenIndices(size_t new_kv_length) {
+  auto last_token_indices = last_token_indices_->GetDeviceSpan<int64_t>();
+  auto last_token_indices_cpu = last_token_indices.CpuSpan();
+  const size_t num_beams = state_.params_->search.num_beams;
+
+  for (int batch_index = 0; batch_index < state_.params_->search.batch_size; batch_index++) {
+    // Every token is the last token when generating one token at a time
+    const int64_t token_index = new_kv_length == 1 ? 0 : std::max(input_sequence_lengths[batch_index] - 1, 0);
+    for (size_t beam_index = 0; beam_index < num_beams; beam_index++)
+      last_token_indices_cpu[batch_index * num_beams + beam_index] = token_index;
+  }
+
+  last_token_indices.CopyCpuToDevice();
+  last_token_indices_kv_length_ = new_kv_length;
+}
+
 void Logits::Add() {
-  output_index_ = state_.outputs_.size();
+  if (top_k_head_) {
+    top_k_indices_index_ = state_.outputs_.size();
+    state_.output_names_.push_back(model_.config_->model.decoder.outputs.top_k_indices.c_str());
+    state_.outputs_.push_back(top_k_indices_->GetOrtTensor());
+  }
+
+  if (!top_k_head_ || has_top_k_logits_) {
+    output_index_ = state_.outputs_.size();
+    state_.output_names_.push_back(top_k_head_ ? model_.config_->model.decoder.outputs.top_k_logits.c_str()
+                                               : model_.config_->model.decoder.outputs.logits.c_str());
+    state_.outputs_.push_back(output_raw_->GetOrtTensor());
+  }
 
-  state_.output_names_.push_back(model_.config_->model.decoder.outputs.logits.c_str());
-  state_.outputs_.push_back(output_raw_->GetOrtTensor());
+  if (last_token_indices_) {
+    state_.input_names_.push_back(model_.config_->model.decoder.inputs.last_token_indices.c_str());
+    state_.inputs_.push_back(last_token_indices_->GetOrtTensor());
+  }
 }
 
 }  // namespace Generators
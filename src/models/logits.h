@@ -15,7 +15,14 @@ struct Logits {
   // Resize logits to [bz, token_count, vocab_size] if necessary.
   void Update(const DeviceSpan<int32_t>& next_tokens, size_t new_kv_length);
 
+  // For models with an in-graph TopK or ArgMax head, the token ids of the top k logits of each beam (shape [bz, 1, k]).
+  // Get() then returns the top k logits instead of the logits (or nothing for an ArgMax head). Otherwise it is empty.
+  DeviceSpan<int64_t> GetTopKIndices();
+
  private:
+  // Set last_token_indices_ to the index of the last non pad token of each beam
+  void UpdateLastTokenIndices(size_t new_kv_length);
+
   State& state_;
   const Model& model_{state_.model_};
   size_t output_index_{~0U};
@@ -37,6 +44,18 @@ struct Logits {
 
   // Set to true when prefill will generate the already 'trimmed' logits required for sampling.
   bool trimmed_prefill_logits_ = false;
+
+  // Optional model input with the index of the last token of each beam. Models with this input only return the
+  // logits of those tokens, so the prompt logits are trimmed before the LM head instead of after it.
+  std::unique_ptr<Tensor> last_token_indices_;
+  size_t last_token_indices_kv_length_{};  // new_kv_length that last_token_indices_ was last updated for
+
+  // Set for models with an in-graph TopK or ArgMax head, which return the top k logits and their token ids instead of
+  // the logits. output_raw_ then holds the top k logits, which are not returned by an ArgMax head.
+  bool top_k_head_{};
+  bool has_top_k_logits_{};
+  std::unique_ptr<Tensor> top_k_indices_;
+  size_t top_k_indices_index_{~0U};
 };
 
 }  // namespace Generators
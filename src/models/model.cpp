@@ -19,6 +19,7 @@
 #include "multi_modal.h"
 #include "marian.h"
 #include "decoder_only_pipeline.h"
+#include "threadpool.h"
 #include "../dml/interface.h"
 
 #if defined(_WIN32)
@@ -716,6 +717,13 @@ std::vector<const char*> SessionInfo::GetOutputSymbolicShape(const std::string&
   return type_info->second->GetTensorTypeAndShapeInfo().GetSymbolicDimensions();
 }
 
+std::vector<int64_t> SessionInfo::GetOutputShape(const std::string& name) const {
+  auto type_info = outputs_.find(name);
+  if (type_info == outputs_.end())
+    throw std::runtime_error("Model output was not found: " + name);
+  return type_info->second->GetTensorTypeAndShapeInfo().GetShape();
+}
+
 Model::Model(std::unique_ptr<Config> config) : config_{std::move(config)} {
   CreateSessionOptions();
   EnsureDeviceOrtInit(*p_device_, *config_);
@@ -746,6 +754,18 @@ Model::~Model() {
 #endif
 }
 
+std::shared_ptr<ThreadPool> Model::GetThreadPool() const {
+  std::lock_guard<std::mutex> lock{thread_pool_mutex_};
+  if (!thread_pool_) {
+    // The thread that hands out the work takes part in it, so one thread less than the hardware has is enough
+    const int thread_count = config_->model.thread_pool_size >= 0
+                                 ? config_->model.thread_pool_size
+                                 : std::max(1, static_cast<int>(std::thread::hardware_concurrency())) - 1;
+    thread_pool_ = std::make_shared<ThreadPool>(thread_count);
+  }
+  return thread_pool_;
+}
+
 void Model::CreateSessionOptionsFromConfig(const Config::SessionOptions& config_session_options,
                                            OrtSessionOptions& session_options,
                                            bool is_primary_session_options,
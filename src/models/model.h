@@ -11,10 +11,14 @@
 #include "gemma_image_processor.h"
 #include "adapters.h"
 #include "extra_outputs.h"
+#include <mutex>
 
 namespace Generators {
 
 struct Tokenizer;
+struct KeyValueBlockPool;
+struct ThreadPool;
+struct KeyValueCache;
 
 void Cast(OrtValue& input, std::unique_ptr<OrtValue>& output, DeviceInterface& device, ONNXTensorElementDataType type);
 void CheckResult(extError_t error);
@@ -24,6 +28,9 @@ struct State {
   virtual ~State();
 
   virtual DeviceSpan<float> Run(int total_length, DeviceSpan<int32_t>& next_tokens, DeviceSpan<int32_t> next_indices = {}) = 0;
+  // For models with an in-graph TopK or ArgMax head, the token ids of the top k logits returned by the last Run
+  // (which then returns the top k logits instead of the logits). Otherwise it is empty.
+  virtual DeviceSpan<int64_t> GetTopKIndices() { return {}; }
   virtual void Finalize(int current_length) {}
 
   void SetTerminate();
@@ -31,6 +38,7 @@ struct State {
   bool session_terminated_{};
 
   virtual void RewindTo(size_t index) { (void)index; };
+  virtual KeyValueCache* GetKeyValueCache() { return nullptr; }
   virtual OrtValue* GetInput(const char* name);
   virtual OrtValue* GetOutput(const char* name);
 
@@ -126,6 +134,7 @@ struct SessionInfo {
 
   std::vector<const char*> GetInputSymbolicShape(const std::string& name) const;
   std::vector<const char*> GetOutputSymbolicShape(const std::string& name) const;
+  std::vector<int64_t> GetOutputShape(const std::string& name) const;
 
  private:
   std::unordered_map<std::string, std::unique_ptr<OrtTypeInfo>> inputs_, outputs_;
@@ -147,6 +156,10 @@ struct Model : std::enable_shared_from_this<Model>, LeakChecked<Model>, External
 
   std::unique_ptr<OrtSession> CreateSession(OrtEnv& ort_env, const std::string& model_filename, OrtSessionOptions* session_options);
 
+  // Worker pool shared by the states and searches of this model (KV cache updates, sampling of batch rows), created on
+  // first use with config.model.thread_pool_size threads
+  std::shared_ptr<ThreadPool> GetThreadPool() const;
+
   std::unique_ptr<Config> config_;
   std::unique_ptr<OrtSessionOptions> session_options_;
 
@@ -158,6 +171,13 @@ struct Model : std::enable_shared_from_this<Model>, LeakChecked<Model>, External
 
   SessionInfo session_info_;
 
+  // Block pool shared by the PagedKeyValueCaches of this model, created by the first one
+  mutable std::mutex kv_block_pool_mutex_;
+  mutable std::shared_ptr<KeyValueBlockPool> kv_block_pool_;
+
+  mutable std::mutex thread_pool_mutex_;
+  mutable std::shared_ptr<ThreadPool> thread_pool_;
+
  protected:
   void CreateSessionOptions();
 
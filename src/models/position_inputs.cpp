@@ -89,8 +89,25 @@ void DefaultPositionInputs::RewindTo(size_t index) {
     // Position ids next is set to nullptr after the first Run() call. This restores it
     if (has_posid_input_)
       position_ids_next_ = std::make_unique<Tensor>(model_.p_device_inputs_, type_);
-    // Rewind the mask input to a previous state
+  } else if (is_first_update_) {
+    // Nothing has run yet, so the key-value cache of the first 'index' tokens was loaded from elsewhere (see PrefixCache).
+    // Continue after them as if the state had been rewound to 'index'
+    if (attention_mask_shape_[0] != 1 || state_.params_->use_graph_capture)
+      throw std::runtime_error("DefaultPositionInputs::RewindTo - Starting from a cached prefix requires a batch size of 1 and no graph capture");
+    if (has_mask_input_) {
+      attention_mask_shape_[1] = static_cast<int64_t>(index);
+      attention_mask_->CreateTensor(attention_mask_shape_);
+      auto mask = attention_mask_->GetByteSpan();
+      if (type_ == Ort::TypeToTensorType<int32_t>)
+        std::fill_n(reinterpret_cast<int32_t*>(mask.CpuSpan().data()), index, 1);
+      else
+        std::fill_n(reinterpret_cast<int64_t*>(mask.CpuSpan().data()), index, 1);
+      mask.CopyCpuToDevice();
+      state_.inputs_[mask_input_index_] = attention_mask_->GetOrtTensor();
+    }
+    is_first_update_ = false;
   } else if (has_mask_input_) {
+    // Rewind the mask input to a previous state
     if (attention_mask_shape_[0] == 1) {
       RewindMask(index);
     } else
@@ -1,22 +1,174 @@
 // Copyright (c) Microsoft Corporation. All rights reserved.
 // Licensed under the MIT License.
 
+#include <algorithm>
 #include "threadpool.h"
 
 namespace Generators {
 
-ThreadPool::ThreadPool(size_t num_threads) : num_threads_{num_threads} {}
+namespace {
 
-void ThreadPool::Compute(const std::function<void(size_t)>& func) {
-  for (size_t i = 0; i < num_threads_; ++i) {
-    threads_.emplace_back([&, i] { func(i); });
+// The pool and queue of the pool thread running on this thread, so tasks it pushes go to its own queue
+thread_local const ThreadPool* current_pool{};
+thread_local size_t current_worker{};
+
+}  // namespace
+
+ThreadPool::ThreadPool(size_t num_threads) {
+  queues_.reserve(num_threads);
+  for (size_t i = 0; i < num_threads; ++i) {
+    queues_.push_back(std::make_unique<Queue>());
+  }
+
+  threads_.reserve(num_threads);
+  for (size_t i = 0; i < num_threads; ++i) {
+    threads_.emplace_back([this, i] { WorkerLoop(i); });
+  }
+}
+
+ThreadPool::~ThreadPool() {
+  {
+    std::lock_guard<std::mutex> lock{mutex_};
+    stop_ = true;
   }
+  work_cv_.notify_all();
 
   for (auto& thread : threads_) {
     thread.join();
   }
+}
+
+std::future<void> ThreadPool::Submit(std::function<void()> task) {
+  // std::function must be copyable, which a packaged_task isn't
+  auto packaged_task = std::make_shared<std::packaged_task<void()>>(std::move(task));
+  auto future = packaged_task->get_future();
+  if (threads_.empty()) {
+    (*packaged_task)();
+    return future;
+  }
+
+  Push([packaged_task] { (*packaged_task)(); });
+  return future;
+}
+
+void ThreadPool::Compute(const std::function<void(size_t)>& func) {
+  Compute(threads_.size(), func);
+}
+
+void ThreadPool::Compute(size_t count, const std::function<void(size_t)>& func) {
+  if (threads_.empty() || count <= 1) {
+    for (size_t i = 0; i < count; ++i) {
+      func(i);
+    }
+    return;
+  }
+
+  // Threads that get to their part after every index was taken find nothing left to do, the job is shared so it
+  // outlives this call for them
+  auto job = std::make_shared<Job>(func, count);
+  const size_t helper_count = std::min(count - 1, threads_.size());
+  for (size_t i = 0; i < helper_count; ++i) {
+    Push([job] { RunJob(*job); });
+  }
+
+  RunJob(*job);
+
+  std::unique_lock<std::mutex> lock{job->mutex};
+  job->done_cv.wait(lock, [&job] { return job->remaining == 0; });
+  if (job->exception) {
+    std::rethrow_exception(job->exception);
+  }
+}
 
-  threads_.clear();
+ThreadPoolStats ThreadPool::GetStats() const {
+  std::lock_guard<std::mutex> lock{mutex_};
+  return {threads_.size(), queued_, max_queued_, executed_, stolen_};
+}
+
+void ThreadPool::Push(std::function<void()> task) {
+  // Counted before it's queued, so the count never drops below zero when a thread takes the task right away
+  {
+    std::lock_guard<std::mutex> lock{mutex_};
+    max_queued_ = std::max<size_t>(max_queued_, ++queued_);
+  }
+
+  const size_t index = current_pool == this ? current_worker : next_queue_++ % queues_.size();
+  {
+    std::lock_guard<std::mutex> lock{queues_[index]->mutex};
+    queues_[index]->tasks.push_back(std::move(task));
+  }
+  work_cv_.notify_one();
+}
+
+bool ThreadPool::RunQueuedTask(size_t worker) {
+  std::function<void()> task;
+  {
+    auto& queue = *queues_[worker];
+    std::lock_guard<std::mutex> lock{queue.mutex};
+    if (!queue.tasks.empty()) {
+      task = std::move(queue.tasks.back());
+      queue.tasks.pop_back();
+    }
+  }
+
+  bool stolen{};
+  for (size_t i = 1; !task && i < queues_.size(); ++i) {
+    auto& queue = *queues_[(worker + i) % queues_.size()];
+    std::lock_guard<std::mutex> lock{queue.mutex};
+    if (!queue.tasks.empty()) {
+      task = std::move(queue.tasks.front());
+      queue.tasks.pop_front();
+      stolen = true;
+    }
+  }
+
+  if (!task) {
+    return false;
+  }
+
+  --queued_;
+  ++executed_;
+  if (stolen) {
+    ++stolen_;
+  }
+  task();  // Submitted tasks keep their exception in their future, and jobs in the Job
+  return true;
+}
+
+void ThreadPool::WorkerLoop(size_t worker) {
+  current_pool = this;
+  current_worker = worker;
+
+  while (true) {
+    if (RunQueuedTask(worker)) {
+      continue;
+    }
+
+    std::unique_lock<std::mutex> lock{mutex_};
+    work_cv_.wait(lock, [this] { return stop_ || queued_ > 0; });
+    if (stop_ && queued_ == 0) {
+      return;
+    }
+  }
+}
+
+void ThreadPool::RunJob(Job& job) {
+  for (size_t index; (index = job.next++) < job.count;) {
+    try {
+      job.func(index);
+    } catch (...) {
+      std::lock_guard<std::mutex> lock{job.mutex};
+      if (!job.exception) {
+        job.exception = std::current_exception();
+      }
+    }
+
+    // Notified with the mutex locked, so the Compute can't check remaining and then miss the notification
+    if (--job.remaining == 0) {
+      std::lock_guard<std::mutex> lock{job.mutex};
+      job.done_cv.notify_all();
+    }
+  }
 }
 
-}  // namespace Generators
\ No newline at end of file
+}  // namespace Generators
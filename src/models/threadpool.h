@@ -1,19 +1,88 @@
 // Copyright (c) Microsoft Corporation. All rights reserved.
 // Licensed under the MIT License.
 
+#pragma once
+
+#include <atomic>
+#include <condition_variable>
+#include <deque>
+#include <exception>
 #include <functional>
+#include <future>
+#include <memory>
+#include <mutex>
 #include <vector>
 #include <thread>
 
 namespace Generators {
 
+struct ThreadPoolStats {
+  size_t thread_count{};
+  size_t queued{};      // Tasks waiting in the queues right now
+  size_t max_queued{};  // Most tasks that have waited in the queues at once
+  size_t executed{};    // Tasks run (or running) on the pool's threads
+  size_t stolen{};      // Tasks a thread took from the queue of another thread
+};
+
+// Threads that are created once and wait for work. Each thread has a queue of its own: tasks submitted from a pool
+// thread go to its queue, others are spread across the queues. A thread runs the newest task of its queue and, when
+// that is empty, steals the oldest task of another queue. A pool can be shared by everything that runs in a model
+// (see Model::GetThreadPool), any number of threads may submit to it at once.
 struct ThreadPool {
   ThreadPool(size_t num_threads);
+  ~ThreadPool();  // Runs the tasks still queued before returning
+
+  ThreadPool(const ThreadPool&) = delete;
+  ThreadPool& operator=(const ThreadPool&) = delete;
 
+  size_t ThreadCount() const { return threads_.size(); }
+
+  // Runs task on one of the pool's threads, or right away on the calling thread when the pool has none
+  std::future<void> Submit(std::function<void()> task);
+
+  // Calls func(i) for each i in [0, num_threads)
   void Compute(const std::function<void(size_t)>& func);
 
+  // Calls func(i) for each i in [0, count), on the pool's threads and the calling thread. Returns once every call is
+  // done, rethrowing the first exception thrown by one of them. The calling thread takes part, so a Compute from a pool
+  // thread finishes even when every other thread is busy
+  void Compute(size_t count, const std::function<void(size_t)>& func);
+
+  ThreadPoolStats GetStats() const;
+
  private:
-  size_t num_threads_;
+  struct Queue {
+    std::mutex mutex;
+    std::deque<std::function<void()>> tasks;
+  };
+
+  struct Job {
+    Job(const std::function<void(size_t)>& func, size_t count) : func{func}, count{count}, remaining{count} {}
+
+    const std::function<void(size_t)>& func;  // Only called while indices remain, the Compute waits for them
+    size_t count;
+    std::atomic<size_t> next{};     // Next index to take
+    std::atomic<size_t> remaining;  // Indices not done yet
+    std::mutex mutex;
+    std::condition_variable done_cv;
+    std::exception_ptr exception;
+  };
+
+  void Push(std::function<void()> task);
+  bool RunQueuedTask(size_t worker);  // Runs a task from the queue of worker, or one stolen from another queue
+  void WorkerLoop(size_t worker);
+  static void RunJob(Job& job);
+
+  std::vector<std::unique_ptr<Queue>> queues_;  // One per thread
+  std::atomic<size_t> next_queue_{};            // Queue for the next task pushed from outside of the pool
+
+  mutable std::mutex mutex_;
+  std::condition_variable work_cv_;
+  std::atomic<size_t> queued_{};  // Incremented with mutex_ locked, so a thread going to sleep can't miss a task
+  size_t max_queued_{};           // Guarded by mutex_
+  std::atomic<size_t> executed_{}, stolen_{};
+  bool stop_{};
+
   std::vector<std::thread> threads_;
 };
 
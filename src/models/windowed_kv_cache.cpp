@@ -326,8 +326,7 @@ void WindowedKeyValueCache::Update(DeviceSpan<int32_t> beam_indices, int current
 
 void WindowedKeyValueCache::PartialUpdate(DeviceSpan<int32_t> beam_indices, int total_length,
                                           std::span<const size_t> layer_indices) {
-  ThreadPool thread_pool{layer_indices.size()};
-  thread_pool.Compute([&](size_t i) {
+  model_.GetThreadPool()->Compute(layer_indices.size(), [&](size_t i) {
     UpdateLayer(beam_indices, total_length, layer_indices[i]);
   });
 }
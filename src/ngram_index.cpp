@@ -0,0 +1,74 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+
+#include "generators.h"
+#include "ngram_index.h"
+
+namespace Generators {
+
+namespace {
+
+constexpr uint64_t HashBase = 0x9E3779B97F4A7C15ULL;  // Odd, so the hashes (modulo 2^64) lose no information
+
+}  // namespace
+
+NgramIndex::NgramIndex(size_t row_count, int ngram_size)
+    : prefix_size_{static_cast<size_t>(ngram_size) - 1},
+      prefix_power_{1},
+      rows_(row_count) {
+  assert(ngram_size > 0);
+  for (size_t i = 0; i < prefix_size_; i++)
+    prefix_power_ *= HashBase;
+}
+
+void NgramIndex::Add(size_t row, std::span<const int32_t> sequence) {
+  auto& r = rows_[row];
+  const size_t position = sequence.size() - 1;
+  assert(r.prefix_hashes.size() == sequence.size());
+
+  // Tokens are offset by one so token 0 changes the hash too
+  r.prefix_hashes.push_back(r.prefix_hashes.back() * HashBase + static_cast<uint64_t>(sequence[position]) + 1);
+  if (position >= prefix_size_)
+    r.followers[PrefixHash(r, position)].push_back(static_cast<uint32_t>(position));
+}
+
+void NgramIndex::RewindTo(size_t row, std::span<const int32_t> sequence, size_t new_length) {
+  auto& r = rows_[row];
+  assert(r.prefix_hashes.size() == sequence.size() + 1);
+
+  // Positions are added in increasing order, so the ones rewound are at the back of their lists
+  for (size_t position = sequence.size(); position-- > std::max(new_length, prefix_size_);) {
+    auto it = r.followers.find(PrefixHash(r, position));
+    assert(it != r.followers.end() && it->second.back() == position);
+    it->second.pop_back();
+    if (it->second.empty())
+      r.followers.erase(it);
+  }
+  r.prefix_hashes.resize(new_length + 1);
+}
+
+void NgramIndex::Clear() {
+  for (auto& row : rows_)
+    row = Row{};
+}
+
+void NgramIndex::Reorder(std::span<const int32_t> source_rows) {
+  assert(source_rows.size() == rows_.size());
+
+  // A row is moved to the last row that copies it, and copied to the others
+  std::vector<size_t> copies_left(rows_.size());
+  for (int32_t source_row : source_rows)
+    copies_left[source_row]++;
+
+  std::vector<Row> rows(rows_.size());
+  for (size_t row = 0; row < source_rows.size(); row++) {
+    const size_t source_row = static_cast<size_t>(source_rows[row]);
+    if (--copies_left[source_row] == 0)
+      rows[row] = std::move(rows_[source_row]);
+    else
+      rows[row] = rows_[source_row];
+  }
+  rows_ = std::move(rows);
+}
+
+}  // namespace Generators
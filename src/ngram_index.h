@@ -0,0 +1,61 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+#pragma once
+
+namespace Generators {
+
+// Where each (n-1)-gram occurs in each sequence of a search, so the tokens that no_repeat_ngram_size bans after the last
+// n-1 tokens are found with a single lookup instead of a scan of the sequence. The (n-1)-grams are keyed by a rolling
+// hash, taken from a running hash of each prefix of the sequence, and matches are checked against the tokens so a
+// collision can't ban a token. It is kept up to date as tokens are appended, rewound and reordered by beam search.
+struct NgramIndex {
+  NgramIndex(size_t row_count, int ngram_size);
+
+  // Indexes the last token of 'sequence', which was just appended to the row
+  void Add(size_t row, std::span<const int32_t> sequence);
+  // Drops the tokens of 'sequence' from new_length on, before the row is rewound to new_length
+  void RewindTo(size_t row, std::span<const int32_t> sequence, size_t new_length);
+  void Clear();
+
+  // Makes each row i a copy of row source_rows[i], as beam search does with the sequences
+  void Reorder(std::span<const int32_t> source_rows);
+
+  // Calls ban(token) for each token that would repeat an n-gram of 'sequence' if it came next (once per occurrence)
+  template <typename Ban>
+  void ForEachBannedToken(size_t row, std::span<const int32_t> sequence, Ban&& ban) const;
+
+ private:
+  struct Row {
+    std::vector<uint64_t> prefix_hashes{0};                         // prefix_hashes[i] is the hash of the first i tokens
+    std::unordered_map<uint64_t, std::vector<uint32_t>> followers;  // Positions of the tokens that follow each (n-1)-gram
+  };
+
+  // Hash of the n-1 tokens before 'end'
+  uint64_t PrefixHash(const Row& row, size_t end) const {
+    return row.prefix_hashes[end] - row.prefix_hashes[end - prefix_size_] * prefix_power_;
+  }
+
+  size_t prefix_size_;     // n-1
+  uint64_t prefix_power_;  // Base^(n-1), to take a prefix out of a running hash
+  std::vector<Row> rows_;
+};
+
+template <typename Ban>
+void NgramIndex::ForEachBannedToken(size_t row, std::span<const int32_t> sequence, Ban&& ban) const {
+  const size_t length = sequence.size();
+  if (length < prefix_size_)
+    return;
+
+  const auto& followers = rows_[row].followers;
+  auto it = followers.find(PrefixHash(rows_[row], length));
+  if (it == followers.end())
+    return;
+
+  const auto last = sequence.subspan(length - prefix_size_);
+  for (uint32_t position : it->second) {
+    if (std::equal(last.begin(), last.end(), sequence.begin() + (position - prefix_size_)))
+      ban(sequence[position]);
+  }
+}
+
+}  // namespace Generators
@@ -229,6 +229,14 @@ struct OgaModel : OgaAbstract {
     return p;
   }
 
+  void GetThreadPoolStats(size_t& thread_count, size_t& queued, size_t& max_queued, size_t& executed, size_t& stolen) const {
+    OgaCheckResult(OgaModelGetThreadPoolStats(this, &thread_count, &queued, &max_queued, &executed, &stolen));
+  }
+
+  void GetKeyValueBlockPoolStats(size_t& block_bytes, size_t& blocks_in_use, size_t& max_blocks_in_use, size_t& bytes_allocated, size_t& blocks_copied) const {
+    OgaCheckResult(OgaModelGetKeyValueBlockPoolStats(this, &block_bytes, &blocks_in_use, &max_blocks_in_use, &bytes_allocated, &blocks_copied));
+  }
+
   static void operator delete(void* p) { OgaDestroyModel(reinterpret_cast<OgaModel*>(p)); }
 };
 
@@ -433,6 +441,23 @@ struct OgaGenerator : OgaAbstract {
     OgaCheckResult(OgaGenerator_RewindTo(this, new_length));
   }
 
+  void SetDraftModel(const OgaModel& draft_model, int draft_token_count) {
+    OgaCheckResult(OgaGenerator_SetDraftModel(this, &draft_model, draft_token_count));
+  }
+
+#if OGA_USE_SPAN
+  std::span<const int32_t> SpeculateNextTokens() {
+    const int32_t* out;
+    size_t out_count;
+    OgaCheckResult(OgaGenerator_SpeculateNextTokens(this, &out, &out_count));
+    return {out, out_count};
+  }
+#endif
+
+  void GetSpeculativeStats(size_t& step_count, size_t& draft_token_count, size_t& accepted_token_count) const {
+    OgaCheckResult(OgaGenerator_GetSpeculativeStats(this, &step_count, &draft_token_count, &accepted_token_count));
+  }
+
   void SetRuntimeOption(const char* key, const char* value) {
     OgaCheckResult(OgaGenerator_SetRuntimeOption(this, key, value));
   }
@@ -480,6 +505,72 @@ struct OgaGenerator : OgaAbstract {
   static void operator delete(void* p) { OgaDestroyGenerator(reinterpret_cast<OgaGenerator*>(p)); }
 };
 
+struct OgaEngine : OgaAbstract {
+  static std::unique_ptr<OgaEngine> Create(const OgaModel& model, const OgaGeneratorParams& params) {
+    OgaEngine* p;
+    OgaCheckResult(OgaCreateEngine(&model, &params, &p));
+    return std::unique_ptr<OgaEngine>(p);
+  }
+
+  int64_t Submit(const OgaGeneratorParams& params, const int32_t* input_ids, size_t input_ids_count) {
+    int64_t request_id;
+    OgaCheckResult(OgaEngine_Submit(this, &params, input_ids, input_ids_count, &request_id));
+    return request_id;
+  }
+
+#if OGA_USE_SPAN
+  int64_t Submit(const OgaGeneratorParams& params, std::span<const int32_t> input_ids) {
+    return Submit(params, input_ids.data(), input_ids.size());
+  }
+#endif
+
+  void Cancel(int64_t request_id) {
+    OgaCheckResult(OgaEngine_Cancel(this, request_id));
+  }
+
+  bool HasPendingRequests() const {
+    return OgaEngine_HasPendingRequests(this);
+  }
+
+  size_t Step() {
+    size_t token_count;
+    OgaCheckResult(OgaEngine_Step(this, &token_count));
+    return token_count;
+  }
+
+  void GetToken(size_t index, int64_t& request_id, int32_t& token, bool& is_done) const {
+    OgaCheckResult(OgaEngine_GetToken(this, index, &request_id, &token, &is_done));
+  }
+
+  static void operator delete(void* p) { OgaDestroyEngine(reinterpret_cast<OgaEngine*>(p)); }
+};
+
+struct OgaPrefixCache : OgaAbstract {
+  static std::unique_ptr<OgaPrefixCache> Create(const OgaModel& model, size_t max_bytes) {
+    OgaPrefixCache* p;
+    OgaCheckResult(OgaCreatePrefixCache(&model, max_bytes, &p));
+    return std::unique_ptr<OgaPrefixCache>(p);
+  }
+
+  void Add(OgaGenerator& generator) {
+    OgaCheckResult(OgaPrefixCache_Add(this, &generator));
+  }
+
+  size_t AppendTokens(OgaGenerator& generator, const int32_t* input_ids, size_t input_ids_count) {
+    size_t cached_count;
+    OgaCheckResult(OgaPrefixCache_AppendTokens(this, &generator, input_ids, input_ids_count, &cached_count));
+    return cached_count;
+  }
+
+#if OGA_USE_SPAN
+  size_t AppendTokens(OgaGenerator& generator, std::span<const int32_t> input_ids) {
+    return AppendTokens(generator, input_ids.data(), input_ids.size());
+  }
+#endif
+
+  static void operator delete(void* p) { OgaDestroyPrefixCache(reinterpret_cast<OgaPrefixCache*>(p)); }
+};
+
 struct OgaTensor : OgaAbstract {
 #if OGA_USE_SPAN
   template <typename T>
@@ -8,7 +8,11 @@
 #include "ort_genai_c.h"
 #include "generators.h"
 #include "models/model.h"
+#include "models/kv_cache.h"
 #include "constrained_logits_processor.h"
+#include "engine.h"
+#include "prefix_cache.h"
+#include "speculative.h"
 #include "runtime_settings.h"
 #include "search.h"
 #include "smartptrs.h"
@@ -44,12 +48,14 @@ struct OgaAbstract {
 struct OgaAdapters : Generators::Adapters, OgaAbstract {};
 struct OgaAudios : Generators::Audios, OgaAbstract {};
 struct OgaConfig : Generators::Config, OgaAbstract {};
+struct OgaEngine : Generators::Engine, OgaAbstract {};
 struct OgaGenerator : Generators::Generator, OgaAbstract {};
 struct OgaGeneratorParams : Generators::GeneratorParams, OgaAbstract {};
 struct OgaImages : Generators::Images, OgaAbstract {};
 struct OgaModel : Generators::Model, OgaAbstract {};
 struct OgaMultiModalProcessor : Generators::MultiModalProcessor, OgaAbstract {};
 struct OgaNamedTensors : Generators::NamedTensors, OgaAbstract {};
+struct OgaPrefixCache : Generators::PrefixCache, OgaAbstract {};
 struct OgaResult : Generators::Result, OgaAbstract {};
 struct OgaRuntimeSettings : Generators::RuntimeSettings, OgaAbstract {};
 struct OgaSequences : Generators::TokenSequences, OgaAbstract {};
@@ -314,6 +320,35 @@ OgaResult* OGA_API_CALL OgaModelGetDeviceType(const OgaModel* model, const char*
   OGA_CATCH
 }
 
+OgaResult* OGA_API_CALL OgaModelGetThreadPoolStats(const OgaModel* model, size_t* thread_count, size_t* queued, size_t* max_queued, size_t* executed, size_t* stolen) {
+  OGA_TRY
+  auto stats = model->GetThreadPool()->GetStats();
+  *thread_count = stats.thread_count;
+  *queued = stats.queued;
+  *max_queued = stats.max_queued;
+  *executed = stats.executed;
+  *stolen = stats.stolen;
+  return nullptr;
+  OGA_CATCH
+}
+
+OgaResult* OGA_API_CALL OgaModelGetKeyValueBlockPoolStats(const OgaModel* model, size_t* block_bytes, size_t* blocks_in_use, size_t* max_blocks_in_use, size_t* bytes_allocated, size_t* blocks_copied) {
+  OGA_TRY
+  Generators::KeyValueBlockPoolStats stats;
+  {
+    std::lock_guard<std::mutex> lock{model->kv_block_pool_mutex_};
+    if (model->kv_block_pool_)
+      stats = model->kv_block_pool_->GetStats();
+  }
+  *block_bytes = stats.block_bytes;
+  *blocks_in_use = stats.blocks_in_use;
+  *max_blocks_in_use = stats.max_blocks_in_use;
+  *bytes_allocated = stats.bytes_allocated;
+  *blocks_copied = stats.blocks_copied;
+  return nullptr;
+  OGA_CATCH
+}
+
 OgaResult* OGA_API_CALL OgaCreateGeneratorParams(const OgaModel* model, OgaGeneratorParams** out) {
   OGA_TRY
   auto params = std::make_shared<Generators::GeneratorParams>(*model);
@@ -364,6 +399,71 @@ OgaResult* OgaCreateGenerator(const OgaModel* model, const OgaGeneratorParams* p
   OGA_CATCH
 }
 
+OgaResult* OGA_API_CALL OgaCreateEngine(const OgaModel* model, const OgaGeneratorParams* params, OgaEngine** out) {
+  OGA_TRY
+  *out = ReturnUnique<OgaEngine>(std::make_unique<Generators::Engine>(*model, *params));
+  return nullptr;
+  OGA_CATCH
+}
+
+OgaResult* OGA_API_CALL OgaEngine_Submit(OgaEngine* engine, const OgaGeneratorParams* params, const int32_t* input_ids, size_t input_ids_count, int64_t* request_id) {
+  OGA_TRY
+  *request_id = engine->Submit(*params, {input_ids, input_ids_count});
+  return nullptr;
+  OGA_CATCH
+}
+
+OgaResult* OGA_API_CALL OgaEngine_Cancel(OgaEngine* engine, int64_t request_id) {
+  OGA_TRY
+  engine->Cancel(request_id);
+  return nullptr;
+  OGA_CATCH
+}
+
+bool OGA_API_CALL OgaEngine_HasPendingRequests(const OgaEngine* engine) {
+  return engine->HasPendingRequests();
+}
+
+OgaResult* OGA_API_CALL OgaEngine_Step(OgaEngine* engine, size_t* token_count) {
+  OGA_TRY
+  *token_count = engine->Step().size();
+  return nullptr;
+  OGA_CATCH
+}
+
+OgaResult* OGA_API_CALL OgaEngine_GetToken(const OgaEngine* engine, size_t index, int64_t* request_id, int32_t* token, bool* is_done) {
+  OGA_TRY
+  auto tokens = engine->GetTokens();
+  if (index >= tokens.size())
+    throw std::runtime_error("Token index " + std::to_string(index) + " is out of range, the last step produced " + std::to_string(tokens.size()) + " tokens");
+  *request_id = tokens[index].request_id;
+  *token = tokens[index].token;
+  *is_done = tokens[index].is_done;
+  return nullptr;
+  OGA_CATCH
+}
+
+OgaResult* OGA_API_CALL OgaCreatePrefixCache(const OgaModel* model, size_t max_bytes, OgaPrefixCache** out) {
+  OGA_TRY
+  *out = ReturnUnique<OgaPrefixCache>(std::make_unique<Generators::PrefixCache>(*model, max_bytes));
+  return nullptr;
+  OGA_CATCH
+}
+
+OgaResult* OGA_API_CALL OgaPrefixCache_Add(OgaPrefixCache* prefix_cache, OgaGenerator* generator) {
+  OGA_TRY
+  prefix_cache->Add(*generator);
+  return nullptr;
+  OGA_CATCH
+}
+
+OgaResult* OGA_API_CALL OgaPrefixCache_AppendTokens(OgaPrefixCache* prefix_cache, OgaGenerator* generator, const int32_t* input_ids, size_t input_ids_count, size_t* cached_count) {
+  OGA_TRY
+  *cached_count = prefix_cache->AppendTokens(*generator, {input_ids, input_ids_count});
+  return nullptr;
+  OGA_CATCH
+}
+
 bool OGA_API_CALL OgaGenerator_IsDone(const OgaGenerator* generator) {
   return generator->IsDone();
 }
@@ -435,6 +535,32 @@ OgaResult* OGA_API_CALL OgaGenerator_RewindTo(OgaGenerator* generator, size_t ne
   OGA_CATCH
 }
 
+OgaResult* OGA_API_CALL OgaGenerator_SetDraftModel(OgaGenerator* generator, const OgaModel* draft_model, int draft_token_count) {
+  OGA_TRY
+  generator->SetDraftModel(*draft_model, draft_token_count);
+  return nullptr;
+  OGA_CATCH
+}
+
+OgaResult* OGA_API_CALL OgaGenerator_SpeculateNextTokens(OgaGenerator* generator, const int32_t** out, size_t* out_count) {
+  OGA_TRY
+  auto tokens = generator->SpeculateNextTokens();
+  *out = tokens.data();
+  *out_count = tokens.size();
+  return nullptr;
+  OGA_CATCH
+}
+
+OgaResult* OGA_API_CALL OgaGenerator_GetSpeculativeStats(const OgaGenerator* generator, size_t* step_count, size_t* draft_token_count, size_t* accepted_token_count) {
+  OGA_TRY
+  auto& stats = generator->GetSpeculativeStats();
+  *step_count = stats.step_count;
+  *draft_token_count = stats.draft_token_count;
+  *accepted_token_count = stats.accepted_token_count;
+  return nullptr;
+  OGA_CATCH
+}
+
 OgaResult* OGA_API_CALL OgaGenerator_SetRuntimeOption(OgaGenerator* generator, const char* key, const char* value) {
   OGA_TRY
   generator->SetRuntimeOption(key, value);
@@ -877,6 +1003,8 @@ void OGA_API_CALL OgaDestroySequences(OgaSequences* p) { delete p; }
 void OGA_API_CALL OgaDestroyConfig(OgaConfig* p) { delete p; }
 void OGA_API_CALL OgaDestroyModel(OgaModel* p) { p->ExternalRelease(); }
 void OGA_API_CALL OgaDestroyGeneratorParams(OgaGeneratorParams* p) { p->ExternalRelease(); }
+void OGA_API_CALL OgaDestroyEngine(OgaEngine* p) { delete p; }
+void OGA_API_CALL OgaDestroyPrefixCache(OgaPrefixCache* p) { delete p; }
 void OGA_API_CALL OgaDestroyGenerator(OgaGenerator* p) { delete p; }
 void OGA_API_CALL OgaDestroyTokenizer(OgaTokenizer* p) { p->ExternalRelease(); }
 void OGA_API_CALL OgaDestroyTokenizerStream(OgaTokenizerStream* p) { delete p; }
@@ -77,6 +77,8 @@ typedef struct OgaMultiModalProcessor OgaMultiModalProcessor;
 typedef struct OgaAudios OgaAudios;
 typedef struct OgaStringArray OgaStringArray;
 typedef struct OgaAdapters OgaAdapters;
+typedef struct OgaEngine OgaEngine;
+typedef struct OgaPrefixCache OgaPrefixCache;
 
 //! @}
 
@@ -335,6 +337,32 @@ OGA_EXPORT OgaResult* OGA_API_CALL OgaModelGetType(const OgaModel* model, const
  */
 OGA_EXPORT OgaResult* OGA_API_CALL OgaModelGetDeviceType(const OgaModel* model, const char** out);
 
+/**
+ * \brief Returns the statistics of the worker pool shared by the generators of the model (KV cache updates, CPU search).
+ *        The size of the pool is set by model.thread_pool_size in the genai_config.json.
+ * \param[in] model The model to get the statistics of.
+ * \param[out] thread_count The number of threads in the pool.
+ * \param[out] queued The number of tasks waiting in the queues of the pool.
+ * \param[out] max_queued The largest number of tasks that have waited in the queues at once.
+ * \param[out] executed The number of tasks run by the threads of the pool.
+ * \param[out] stolen The number of tasks a thread took from the queue of another thread.
+ * \return OgaResult containing the error message if getting the statistics failed.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaModelGetThreadPoolStats(const OgaModel* model, size_t* thread_count, size_t* queued, size_t* max_queued, size_t* executed, size_t* stolen);
+
+/**
+ * \brief Returns the statistics of the block pool that holds the key-value caches of the generators of the model, when
+ *        model.decoder.paged_key_value_cache is set in the genai_config.json. They are all 0 until the first generator is created.
+ * \param[in] model The model to get the statistics of.
+ * \param[out] block_bytes The size of a block, which holds block_size positions of every layer.
+ * \param[out] blocks_in_use The number of blocks referenced by the generators and the prefix caches of the model.
+ * \param[out] max_blocks_in_use The largest number of blocks that have been in use at once.
+ * \param[out] bytes_allocated The memory allocated for blocks. Blocks are allocated in chunks, which are freed once none of their blocks are in use.
+ * \param[out] blocks_copied The number of blocks that were copied because they were written to while shared.
+ * \return OgaResult containing the error message if getting the statistics failed.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaModelGetKeyValueBlockPoolStats(const OgaModel* model, size_t* block_bytes, size_t* blocks_in_use, size_t* max_blocks_in_use, size_t* bytes_allocated, size_t* blocks_copied);
+
 /**
  * \brief Destroys the given config
  * \param[in] config The config to be destroyed.
@@ -457,6 +485,35 @@ OGA_EXPORT OgaResult* OGA_API_CALL OgaGenerator_SetRuntimeOption(OgaGenerator* g
  */
 OGA_EXPORT OgaResult* OGA_API_CALL OgaGenerator_RewindTo(OgaGenerator* generator, size_t new_length);
 
+/**
+ * \brief Enables speculative decoding with a draft model. The draft model proposes tokens that the model verifies in a
+ *        single run, see OgaGenerator_SpeculateNextTokens. Requires a batch_size and num_beams of 1.
+ * \param[in] generator The generator to enable speculative decoding on.
+ * \param[in] draft_model A smaller model with the same tokenizer as the generator's model.
+ * \param[in] draft_token_count The maximum number of tokens proposed per run of the model.
+ * \return OgaResult containing the error message if the draft model could not be set.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaGenerator_SetDraftModel(OgaGenerator* generator, const OgaModel* draft_model, int draft_token_count);
+
+/**
+ * \brief Appends one or more tokens to the sequence using speculative decoding. Use instead of OgaGenerator_GenerateNextToken.
+ * \param[in] generator The generator to generate the tokens with.
+ * \param[out] out The pointer to the appended tokens. The pointer is valid until the next OgaGenerator call
+ * \param[out] out_count The number of tokens in the out array.
+ * \return OgaResult containing the error message if the generation failed.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaGenerator_SpeculateNextTokens(OgaGenerator* generator, const int32_t** out, size_t* out_count);
+
+/**
+ * \brief Returns the statistics of speculative decoding so far.
+ * \param[in] generator The generator to get the statistics of.
+ * \param[out] step_count The number of runs of the model that verified proposed tokens.
+ * \param[out] draft_token_count The number of proposed tokens.
+ * \param[out] accepted_token_count The number of proposed tokens that were accepted.
+ * \return OgaResult containing the error message if getting the statistics failed.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaGenerator_GetSpeculativeStats(const OgaGenerator* generator, size_t* step_count, size_t* draft_token_count, size_t* accepted_token_count);
+
 /**
  * \brief Returns a copy of the model input identified by the given name as an OgaTensor on CPU. The buffer is owned by returned OgaTensor
  *       and will be released when the OgaTensor is destroyed
@@ -482,7 +539,8 @@ OGA_EXPORT OgaResult* OGA_API_CALL OgaGenerator_GetOutput(const OgaGenerator* ge
  *        and will be released when the OgaTensor is destroyed
  * \param[in] generator The generator get the logits from
  * \param[out] out The OgaTensor containing the logits, it only contains the last token logits even in prompt processing
- * \return OgaResult containing the error message if the computation failed.
+ * \return OgaResult containing the error message if the computation failed, or if the model has a TopK or ArgMax head
+ *         instead of the logits (see OgaGenerator_GetOutput for its top_k_logits and top_k_indices outputs).
  */
 OGA_EXPORT OgaResult* OGA_API_CALL OgaGenerator_GetLogits(OgaGenerator* generator, OgaTensor** out);
 
@@ -515,6 +573,104 @@ OGA_EXPORT size_t OGA_API_CALL OgaGenerator_GetSequenceCount(const OgaGenerator*
  */
 OGA_EXPORT const int32_t* OGA_API_CALL OgaGenerator_GetSequenceData(const OgaGenerator* generator, size_t index);
 
+/**
+ * \brief Creates an engine that serves many requests from one live batch (continuous batching). Requests are admitted
+ *        into free batch entries between decode steps and retired as soon as they finish. It uses the default key-value
+ *        cache, so it doesn't support paged_key_value_cache or the OgaPrefixCache.
+ * \param[in] model The model to use for generation. Currently this must be a decoder-only model on the CPU provider.
+ * \param[in] params Sets the number of batch entries (batch_size) and the maximum length of every request (max_length).
+ * \param[out] out The created engine.
+ * \return OgaResult containing the error message if the engine creation failed.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaCreateEngine(const OgaModel* model, const OgaGeneratorParams* params, OgaEngine** out);
+
+/**
+ * \brief Destroys the given engine.
+ * \param[in] engine The engine to be destroyed.
+ */
+OGA_EXPORT void OGA_API_CALL OgaDestroyEngine(OgaEngine* engine);
+
+/**
+ * \brief Queues a request. It is admitted into the batch by a later OgaEngine_Step.
+ * \param[in] engine The engine to submit the request to.
+ * \param[in] params The search options of the request. The batch_size must be 1.
+ * \param[in] input_ids The prompt tokens of the request.
+ * \param[in] input_ids_count The number of prompt tokens.
+ * \param[out] request_id The id of the request, which identifies its tokens in the OgaEngine_Step results.
+ * \return OgaResult containing the error message if the request is invalid.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaEngine_Submit(OgaEngine* engine, const OgaGeneratorParams* params, const int32_t* input_ids, size_t input_ids_count, int64_t* request_id);
+
+/**
+ * \brief Drops a request that is waiting or running. Does nothing if the request already finished.
+ * \param[in] engine The engine the request was submitted to.
+ * \param[in] request_id The id returned by OgaEngine_Submit.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaEngine_Cancel(OgaEngine* engine, int64_t request_id);
+
+/**
+ * \brief Returns true while any submitted request has not finished.
+ */
+OGA_EXPORT bool OGA_API_CALL OgaEngine_HasPendingRequests(const OgaEngine* engine);
+
+/**
+ * \brief Admits waiting requests, runs one decode step over the batch and retires finished requests.
+ * \param[in] engine The engine to step.
+ * \param[out] token_count The number of requests that produced a token, see OgaEngine_GetToken.
+ * \return OgaResult containing the error message if the step failed.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaEngine_Step(OgaEngine* engine, size_t* token_count);
+
+/**
+ * \brief Returns one of the tokens produced by the last OgaEngine_Step.
+ * \param[in] engine The engine that was stepped.
+ * \param[in] index The index of the token, less than the token_count returned by OgaEngine_Step.
+ * \param[out] request_id The request the token belongs to.
+ * \param[out] token The token.
+ * \param[out] is_done True if this is the last token of the request.
+ * \return OgaResult containing the error message if the index is out of range.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaEngine_GetToken(const OgaEngine* engine, size_t index, int64_t* request_id, int32_t* token, bool* is_done);
+
+/**
+ * \brief Creates a cache of the key-value state of token prefixes (such as a shared system prompt), so that generators
+ *        starting with the same tokens don't recompute them. Entries share key-value blocks with copy-on-write, which
+ *        requires the model to set paged_key_value_cache in its genai_config. The paged cache copies the whole past out
+ *        of its blocks at every decode step, so it is slower per generated token than the default cache. Sharing pays off
+ *        for long prefixes and short generations.
+ * \param[in] model The model whose generators use the cache.
+ * \param[in] max_bytes The budget for the key-value blocks held by the entries. The least recently used entries are evicted beyond it.
+ * \param[out] out The created prefix cache.
+ * \return OgaResult containing the error message if the prefix cache creation failed.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaCreatePrefixCache(const OgaModel* model, size_t max_bytes, OgaPrefixCache** out);
+
+/**
+ * \brief Destroys the given prefix cache. Generators started from its entries are not affected.
+ * \param[in] prefix_cache The prefix cache to be destroyed.
+ */
+OGA_EXPORT void OGA_API_CALL OgaDestroyPrefixCache(OgaPrefixCache* prefix_cache);
+
+/**
+ * \brief Adds the tokens of a generator (batch_size and num_beams of 1) whose key-value state has been computed, typically right
+ *        after OgaGenerator_AppendTokens with the prefix.
+ * \param[in] prefix_cache The prefix cache to add the entry to.
+ * \param[in] generator The generator to take the tokens and key-value state from.
+ * \return OgaResult containing the error message if the entry could not be added.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaPrefixCache_Add(OgaPrefixCache* prefix_cache, OgaGenerator* generator);
+
+/**
+ * \brief Appends the input ids to a generator that has no tokens yet, reusing the key-value state of the longest cached prefix of them.
+ * \param[in] prefix_cache The prefix cache to look up the input ids in.
+ * \param[in] generator The generator to append the input ids to.
+ * \param[in] input_ids The input ids to append.
+ * \param[in] input_ids_count The number of input ids.
+ * \param[out] cached_count The number of input ids whose key-value state was taken from the cache.
+ * \return OgaResult containing the error message if appending the input ids failed.
+ */
+OGA_EXPORT OgaResult* OGA_API_CALL OgaPrefixCache_AppendTokens(OgaPrefixCache* prefix_cache, OgaGenerator* generator, const int32_t* input_ids, size_t input_ids_count, size_t* cached_count);
+
 OGA_EXPORT OgaResult* OGA_API_CALL OgaCreateTokenizer(const OgaModel* model, OgaTokenizer** out);
 OGA_EXPORT void OGA_API_CALL OgaDestroyTokenizer(OgaTokenizer*);
 
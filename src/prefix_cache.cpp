@@ -0,0 +1,134 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+
+#include "generators.h"
+#include "models/model.h"
+#include "models/kv_cache.h"
+#include "prefix_cache.h"
+
+namespace Generators {
+
+namespace {
+
+// FNV-1a, extended one token at a time so the hashes of all prefixes are found in a single pass
+constexpr uint64_t HashBasis = 14695981039346656037ULL;
+constexpr uint64_t HashPrime = 1099511628211ULL;
+
+uint64_t HashToken(uint64_t hash, int32_t token) {
+  return (hash ^ static_cast<uint32_t>(token)) * HashPrime;
+}
+
+PagedKeyValueCache& GetPagedKeyValueCache(Generator& generator) {
+  auto* cache = dynamic_cast<PagedKeyValueCache*>(generator.state_->GetKeyValueCache());
+  if (!cache)
+    throw std::runtime_error("PrefixCache requires a decoder-only model with paged_key_value_cache set in its genai_config");
+  if (generator.state_->params_->BatchBeamSize() != 1)
+    throw std::runtime_error("PrefixCache requires a batch_size and num_beams of 1");
+  return *cache;
+}
+
+}  // namespace
+
+PrefixCache::PrefixCache(const Model& model, size_t max_bytes)
+    : model_{model.shared_from_this()},
+      max_bytes_{max_bytes} {
+}
+
+PrefixCache::~PrefixCache() {
+  while (!entries_.empty())
+    Evict(entries_.begin());
+}
+
+void PrefixCache::Add(Generator& generator) {
+  if (generator.model_ != model_)
+    throw std::runtime_error("The generator was created for a different model than the PrefixCache");
+  auto& cache = GetPagedKeyValueCache(generator);
+  const size_t length = cache.GetLength();
+  if (length == 0)
+    throw std::runtime_error("The generator has no computed tokens to add to the PrefixCache");
+
+  auto sequence = generator.GetSequence(0).CopyDeviceToCpu();
+  Entry entry;
+  entry.tokens.assign(sequence.begin(), sequence.begin() + length);
+  entry.hash = HashBasis;
+  for (int32_t token : entry.tokens)
+    entry.hash = HashToken(entry.hash, token);
+
+  std::lock_guard<std::mutex> lock{mutex_};
+  if (auto it = entries_by_hash_.find(entry.hash); it != entries_by_hash_.end()) {
+    if (it->second->tokens == entry.tokens) {
+      entries_.splice(entries_.begin(), entries_, it->second);
+      return;
+    }
+    Evict(it->second);  // A hash collision, the newer entry wins
+  }
+
+  entry.blocks = cache.ReferenceBlocks(length);
+  pool_ = cache.GetPool();
+  bytes_ += entry.blocks.size() * pool_->BlockBytes();
+  entry_lengths_[length]++;
+  entries_.push_front(std::move(entry));
+  entries_by_hash_[entries_.front().hash] = entries_.begin();
+
+  while (bytes_ > max_bytes_ && !entries_.empty())
+    Evict(std::prev(entries_.end()));
+}
+
+size_t PrefixCache::AppendTokens(Generator& generator, cpu_span<const int32_t> input_ids) {
+  if (generator.model_ != model_)
+    throw std::runtime_error("The generator was created for a different model than the PrefixCache");
+  auto& cache = GetPagedKeyValueCache(generator);
+
+  size_t length = 0;
+  {
+    std::lock_guard<std::mutex> lock{mutex_};
+    if (!entry_lengths_.empty()) {
+      std::vector<uint64_t> hashes(input_ids.size() + 1);
+      hashes[0] = HashBasis;
+      for (size_t i = 0; i < input_ids.size(); i++)
+        hashes[i + 1] = HashToken(hashes[i], input_ids[i]);
+
+      // Look up the longest prefixes first
+      for (auto it = entry_lengths_.rbegin(); it != entry_lengths_.rend(); ++it) {
+        if (it->first >= input_ids.size())
+          continue;
+        auto match = entries_by_hash_.find(hashes[it->first]);
+        if (match == entries_by_hash_.end() || !std::equal(match->second->tokens.begin(), match->second->tokens.end(), input_ids.begin()))
+          continue;
+
+        entries_.splice(entries_.begin(), entries_, match->second);
+        // Referenced while locked, so an eviction can't release the blocks first
+        cache.SetBlocks(match->second->blocks, it->first);
+        length = it->first;
+        break;
+      }
+    }
+  }
+
+  if (length != 0)
+    generator.AppendCachedTokens(input_ids.subspan(0, length));
+  generator.AppendTokens(input_ids.subspan(length));
+  return length;
+}
+
+size_t PrefixCache::GetEntryCount() const {
+  std::lock_guard<std::mutex> lock{mutex_};
+  return entries_.size();
+}
+
+size_t PrefixCache::GetBytes() const {
+  std::lock_guard<std::mutex> lock{mutex_};
+  return bytes_;
+}
+
+void PrefixCache::Evict(std::list<Entry>::iterator entry) {
+  for (int block : entry->blocks)
+    pool_->Release(block);
+  bytes_ -= entry->blocks.size() * pool_->BlockBytes();
+  if (--entry_lengths_[entry->tokens.size()] == 0)
+    entry_lengths_.erase(entry->tokens.size());
+  entries_by_hash_.erase(entry->hash);
+  entries_.erase(entry);
+}
+
+}  // namespace Generators
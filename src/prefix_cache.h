@@ -0,0 +1,54 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+#pragma once
+
+#include <list>
+#include <map>
+#include <mutex>
+
+namespace Generators {
+
+struct KeyValueBlockPool;
+
+// Snapshots of the key-value cache of token prefixes (such as a shared system prompt), so that generators starting with
+// the same tokens skip recomputing them. An entry references the blocks of the generator it was taken from, and
+// generators started from it copy a block only when they write to it. This requires the model to use the
+// paged_key_value_cache. Entries are keyed by a hash of their tokens, and the least recently used entries are evicted
+// once the entries hold more than max_bytes of blocks.
+// The paged cache gathers the whole past at every decode step, so the prompt computation saved by an entry has to
+// outweigh that per-token cost. It pays off for long shared prefixes and short generations.
+struct PrefixCache : LeakChecked<PrefixCache> {
+  PrefixCache(const Model& model, size_t max_bytes);
+  ~PrefixCache();
+
+  // Adds the tokens of the generator whose key-value cache has been computed. Does nothing if they're already cached
+  void Add(Generator& generator);
+
+  // Appends input_ids to a generator that has no tokens yet. The longest cached entry that is a prefix of input_ids (and
+  // shorter, so there is at least one token to compute the logits of) is reused. Returns the number of reused tokens
+  size_t AppendTokens(Generator& generator, cpu_span<const int32_t> input_ids);
+
+  size_t GetEntryCount() const;
+  size_t GetBytes() const;  // Bytes of the blocks referenced by the entries (blocks shared by entries are counted once per entry)
+
+ private:
+  struct Entry {
+    uint64_t hash;
+    std::vector<int32_t> tokens;
+    std::vector<int> blocks;
+  };
+
+  void Evict(std::list<Entry>::iterator entry);
+
+  std::shared_ptr<const Model> model_;
+  size_t max_bytes_;
+
+  mutable std::mutex mutex_;
+  std::shared_ptr<KeyValueBlockPool> pool_;  // Set by the first Add
+  std::list<Entry> entries_;                 // Most recently used first
+  std::unordered_map<uint64_t, std::list<Entry>::iterator> entries_by_hash_;
+  std::map<size_t, int> entry_lengths_;  // Number of entries of each token count, which are the prefix lengths to look up
+  size_t bytes_{};
+};
+
+}  // namespace Generators
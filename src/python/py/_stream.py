@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License
+
+import asyncio
+import threading
+
+import onnxruntime_genai as og
+
+_DONE = object()
+
+
+async def stream(model, params, tokens, tokenizer=None):
+    """Generate text for one sequence and yield it as it is decoded.
+
+    The generator runs on a worker thread, which releases the GIL while the model runs,
+    so the event loop can serve other streams meanwhile. For example:
+
+        async for text in og.stream(model, params, tokenizer.encode(prompt)):
+            print(text, end="", flush=True)
+
+    Generation stops early if the caller stops iterating (e.g. the request is cancelled).
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    if tokenizer is None:
+        tokenizer = og.Tokenizer(model)
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop was closed, so nobody is waiting for more text
+            stop.set()
+
+    def run():
+        try:
+            generator = og.Generator(model, params)
+            generator.append_tokens(tokens)
+            tokenizer_stream = tokenizer.create_stream()
+            while not stop.is_set() and not generator.is_done():
+                generator.generate_next_token()
+                put(tokenizer_stream.decode(generator.get_next_tokens()[0]))
+        except BaseException as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    thread = threading.Thread(target=run, name="onnxruntime_genai.stream", daemon=True)
+    thread.start()
+    try:
+        while (item := await queue.get()) is not _DONE:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
@@ -11,9 +11,15 @@ from __future__ import annotations
 
 import argparse
 import ast
+import enum
+import glob
+import hashlib
 import json
+import multiprocessing
 import os
+import shutil
 import textwrap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from typing import Any, Literal, Sequence
 
 import numpy as np
@@ -103,6 +109,7 @@ class Model:
             "input_ids": ir.DataType.INT64,                                                                      # For standard models
             "attention_mask": ir.DataType.INT64,                                                                 # For standard models
             "position_ids": ir.DataType.INT64,                                                                   # For standard models
+            "last_token_indices": ir.DataType.INT64,                                                             # For standard models where you only want the logits of the last token of each sequence
             "inputs_embeds": self.io_dtype,                                                                      # For standard models where you want to remove the embedding layer from the model (note that `inputs_embeds` is written this way to match Hugging Face format)
             "past_key_values.key": self.io_dtype,                                                                # For standard models (note that `past_key_values.key` is written this way to match Hugging Face format)
             "past_key_values.value": self.io_dtype,                                                              # For standard models (note that `past_key_values.value` is written this way to match Hugging Face format)
@@ -111,6 +118,7 @@ class Model:
             "input_ids": ["batch_size", "sequence_length"],                                                      # For standard models
             "attention_mask": ["batch_size", "total_sequence_length"],                                           # For standard models
             "position_ids": ["batch_size", "sequence_length"],                                                   # For standard models
+            "last_token_indices": ["batch_size"],                                                                # For standard models where you only want the logits of the last token of each sequence
             "inputs_embeds": ["batch_size", "sequence_length", self.hidden_size],                                # For standard models where you want to remove the embedding layer from the model (note that `inputs_embeds` is written this way to match Hugging Face format)
             "past_key_values.key": ["batch_size", self.num_kv_heads, "past_sequence_length", self.head_size],    # For standard models (note that `past_key_values.key` is written this way to match Hugging Face format)
             "past_key_values.value": ["batch_size", self.num_kv_heads, "past_sequence_length", self.head_size],  # For standard models (note that `past_key_values.value` is written this way to match Hugging Face format)
@@ -300,6 +308,7 @@ class Model:
                 "op_types_to_quantize": extra_options.get("int4_op_types_to_quantize", ("MatMul", )),
                 "nodes_to_exclude": extra_options.get("int4_nodes_to_exclude", []),
                 "algo_config": int4_algo_config,
+                "quantize_on_the_fly": int4_algo_config is None and not extra_options.get("use_qdq", False),  # Quantize float MatMul weights to MatMulNBits while building instead of with MatMulNBitsQuantizer at the end
             },
             "use_qdq": extra_options.get("use_qdq", False),
         }
@@ -319,6 +328,42 @@ class Model:
         self.model = ir.Model(graph, ir_version=10, producer_name="onnxruntime-genai")
         self.values: dict[str, ir.Value] = {}
 
+        # Streaming-specific variables
+        self.stream_attrs = {
+            "enabled": extra_options.get("streaming", False),                                         # Load, build, and flush one module at a time instead of loading the whole checkpoint
+            "data_path": os.path.join(cache_dir, f"{os.path.basename(self.filename)}.stream.data"),   # Staging file for initializers that have already been built
+            "offset": 0,                                                                              # Current size of the staging file
+            "weight_map": {},                                                                         # Map of checkpoint tensor name to the safetensors file that stores it
+            "module_names": {},                                                                       # Map of module id to its fully-qualified name in the model
+            "aliases": {},                                                                            # Map of tensor id to every name it is registered under (for tied weights)
+            "pending": [],                                                                            # Initializers registered since the last flush to the staging file
+            "quantizing": False,                                                                      # Whether nodes made by MatMulNBitsQuantizer for one node are being added
+        }
+
+        # Parallel layer-specific variables
+        self.parallel_attrs = {
+            "num_workers": int(extra_options.get("parallel_layers", 1)),                              # Number of worker processes used to build decoder layers
+            "dir": os.path.join(cache_dir, f"{os.path.basename(self.filename)}.layers"),              # Folder for each decoder layer's subgraph and external data built by the workers
+            "node_names": set(),                                                                      # Names of nodes that already exist before the decoder layers are built
+            "create_caches": True,                                                                    # Value of `rotemb_attrs["create_caches"]` before the decoder layers are built
+            "source_model": None,                                                                     # GGUF or quantized model whose decoder layers need their weights loaded again when they are built
+        }
+
+        # Layer cache-specific variables
+        self.layer_cache_attrs = {
+            "enabled": extra_options.get("layer_cache", False),                                       # Reuse decoder layers built by a previous run with the same weights and settings
+            "dir": os.path.join(cache_dir, "layer_cache"),                                           # Folder for each cached decoder layer's subgraph and external data
+            "settings": self.make_layer_cache_settings(config, extra_options),                        # Hash of everything besides the weights that changes how decoder layers are built
+        }
+
+        # External data-specific variables
+        self.save_attrs = {
+            "max_shard_size": int(float(extra_options.get("max_shard_size", 0)) * 1024**3),           # Maximum size in bytes of each external data file (0 means one file for all initializers)
+            "num_threads": int(extra_options.get("save_threads", min(8, os.cpu_count() or 1))),        # Number of threads that write initializers to the external data files
+            "align_threshold": 0 if "align_external_data" in extra_options else 1024**2,               # Initializers larger than this are padded to start at an aligned offset
+            "alignment": int(extra_options.get("align_external_data", 65536)),                        # Offset alignment in bytes for memory-mapping (page size and Windows allocation granularity)
+        }
+
     def to_str_dtype(self, dtype: ir.DataType) -> str:
         return dtype.name
 
@@ -335,6 +380,21 @@ class Model:
         elif self.include_hidden_states:
             self.output_names = ["hidden_states"] + self.output_names
 
+        self.top_k_head = 0 if self.exclude_lm_head else int(self.extra_options.get("top_k_head", 0))
+        if (self.extra_options.get("last_token_logits", False) or self.top_k_head > 0) and not self.exclude_lm_head:
+            # Gather the last token of each sequence before the LM head so that logits are only computed for it
+            self.input_names.append("last_token_indices")
+            self.output_shapes["logits"] = ["batch_size", 1, self.vocab_size]
+
+        if self.top_k_head > 0:
+            # Replace the logits with the token ids of the top k logits (and the top k logits when k > 1)
+            top_k_outputs = ["top_k_indices"] if self.top_k_head == 1 else ["top_k_logits", "top_k_indices"]
+            self.output_names = [output for name in self.output_names for output in (top_k_outputs if name == "logits" else [name])]
+            self.output_types["top_k_logits"] = self.output_types["logits"]
+            self.output_types["top_k_indices"] = ir.DataType.INT64
+            self.output_shapes["top_k_logits"] = ["batch_size", 1, self.top_k_head]
+            self.output_shapes["top_k_indices"] = ["batch_size", 1, self.top_k_head]
+
     def make_attention_init(self):
         valid_gqa_configurations = {
             ("cpu", ir.DataType.FLOAT),
@@ -368,6 +428,22 @@ class Model:
 
         self.past_present_share_buffer = self.attention_attrs["op_type"] == "GroupQueryAttention"
 
+        self.kv_cache_int8 = self.extra_options.get("kv_cache_int8", False)
+        if self.kv_cache_int8:
+            if self.ep != "cpu" or self.attention_attrs["op_type"] != "GroupQueryAttention":
+                raise NotImplementedError("kv_cache_int8 is only supported with GroupQueryAttention on the CPU execution provider.")
+
+            # Store the KV cache as int8 with a float scale per position of each head. The present is quantized after the attention op,
+            # so it can't share its buffer with the past.
+            self.past_present_share_buffer = False
+            for kv in ["key", "value"]:
+                self.input_types[f"past_key_values.{kv}"] = ir.DataType.INT8
+                self.output_types[f"present.{kv}"] = ir.DataType.INT8
+                self.input_types[f"past_key_values.{kv}_scale"] = self.io_dtype
+                self.output_types[f"present.{kv}_scale"] = self.io_dtype
+                self.input_shapes[f"past_key_values.{kv}_scale"] = ["batch_size", self.num_kv_heads, "past_sequence_length", 1]
+                self.output_shapes[f"present.{kv}_scale"] = ["batch_size", self.num_kv_heads, "total_sequence_length", 1]
+
     def make_genai_config(self, model_name_or_path, extra_kwargs, out_dir):
         try:
             config = GenerationConfig.from_pretrained(model_name_or_path, token=self.hf_token, trust_remote_code=True, **extra_kwargs)
@@ -384,6 +460,15 @@ class Model:
             "present_key_names": "present.%d.key",
             "present_value_names": "present.%d.value",
         })
+        if self.kv_cache_int8:
+            inputs.update({
+                "past_key_scale_names": "past_key_values.%d.key_scale",
+                "past_value_scale_names": "past_key_values.%d.value_scale",
+            })
+            outputs.update({
+                "present_key_scale_names": "present.%d.key_scale",
+                "present_value_scale_names": "present.%d.value_scale",
+            })
         if "hidden_states" in outputs:
             # Remove 'hidden_states' from 'outputs' entry in config since ORT GenAI doesn't use it
             del outputs["hidden_states"]
@@ -472,9 +557,18 @@ class Model:
             int4_algo_config = KQuantWeightOnlyQuantConfig(customized_weight_config=customized_weight_config)
         return int4_algo_config
 
-    def to_int4(self) -> ir.Model:
-        quant = MatMulNBitsQuantizer(
-            model=ir.to_proto(self.model),
+    def uses_int4_quantizer(self):
+        # Whether float `MatMul` weights are quantized with MatMulNBitsQuantizer instead of while building
+        already_quantized_in_qdq_format = self.quant_type is not None and self.quant_attrs["use_qdq"]  # Skip quantizing `MatMul` in `DequantizeLinear --> Transpose --> MatMul` path
+        already_quantized_on_the_fly = self.quant_attrs["int4"]["quantize_on_the_fly"] and set(self.quant_attrs["int4"]["op_types_to_quantize"]) == {"MatMul"}  # Skip quantizing since all `MatMul` weights were quantized while building
+        return self.onnx_dtype in {ir.DataType.INT4, ir.DataType.UINT4} and not already_quantized_in_qdq_format and not already_quantized_on_the_fly
+
+    def is_streaming(self):
+        return self.stream_attrs["enabled"] and (bool(self.stream_attrs["module_names"]) or self.quant_type is not None)
+
+    def make_int4_quantizer(self, model: ir.Model):
+        return MatMulNBitsQuantizer(
+            model=ir.to_proto(model),
             block_size=self.quant_attrs["int4"]["block_size"],
             is_symmetric=self.quant_attrs["int4"]["is_symmetric"],
             accuracy_level=self.quant_attrs["int4"]["accuracy_level"],
@@ -483,14 +577,20 @@ class Model:
             op_types_to_quantize=self.quant_attrs["int4"]["op_types_to_quantize"],
             algo_config=self.quant_attrs["int4"]["algo_config"],
         )
+
+    def to_int4(self) -> ir.Model:
+        # The quantizer operates on an in-memory ModelProto, so any initializers that were written to
+        # temporary files while building (e.g. decoder layers built in parallel) must be loaded back first
+        ir.external_data.load_to_model(self.model)
+        quant = self.make_int4_quantizer(self.model)
         quant.process()
         return ir.from_proto(quant.model.model)
 
     def save_model(self, out_dir):
         print(f"Saving ONNX model in {out_dir}")
 
-        already_quantized_in_qdq_format = self.quant_type is not None and self.quant_attrs["use_qdq"]  # Skip quantizing `MatMul` in `DequantizeLinear --> Transpose --> MatMul` path
-        if self.onnx_dtype in {ir.DataType.INT4, ir.DataType.UINT4} and not already_quantized_in_qdq_format:
+        if self.uses_int4_quantizer() and not self.is_streaming():
+            # When streaming, each node was quantized as it was built (see `make_node_int4`)
             model = self.to_int4()
         else:
             model = self.model
@@ -498,40 +598,96 @@ class Model:
         # Make sure all nodes are topologically sorted
         model.graph.sort()
 
-        # Save ONNX model with only one external data file and delete any existing duplicate copies
+        # Save ONNX model with its external data files and delete any existing duplicate copies
         out_path = os.path.join(out_dir, self.filename)
-        data_path = os.path.join(out_dir, os.path.basename(out_path) + ".data")
-        if os.path.exists(out_path):
-            print(f"Overwriting {out_path}")
-            os.remove(out_path)
-        if os.path.exists(data_path):
-            print(f"Overwriting {data_path}")
-            os.remove(data_path)
-
-        with tqdm() as pbar:
-            total_set = False
-
-            def callback(tensor: ir.TensorProtocol, metadata: dict):
-                nonlocal total_set
-                if not total_set:
-                    pbar.total = metadata.total
-                    total_set = True
-
-                pbar.update()
-                pbar.set_description(f"Saving {tensor.name} ({tensor.dtype.short_name()}, {tensor.shape})")
-
-            ir.save(
-                model,
-                out_path,
-                external_data=os.path.basename(data_path),
-                size_threshold_bytes=0,
-                callback=callback,
-            )
+        name = os.path.basename(out_path)
+        for path in [out_path, f"{out_path}.data", f"{out_path}.data.index.json", *glob.glob(os.path.join(glob.escape(out_dir), f"{glob.escape(name)}-*-of-*.data"))]:
+            if os.path.exists(path):
+                print(f"Overwriting {path}")
+                os.remove(path)
+        self.save_external_data(model, out_path)
+
+        # Delete temporary files used by streaming and parallel layer building
+        for value in self.model.graph.initializers.values():
+            if isinstance(value.const_value, ir.ExternalTensor):
+                value.const_value.release()
+        if os.path.exists(self.stream_attrs["data_path"]):
+            os.remove(self.stream_attrs["data_path"])
+        if os.path.exists(self.parallel_attrs["dir"]):
+            shutil.rmtree(self.parallel_attrs["dir"])
 
         # Delete temporary cache dir if empty
         if not os.listdir(self.cache_dir):
             os.rmdir(self.cache_dir)
 
+    def save_external_data(self, model: ir.Model, out_path: str):
+        out_dir, name = os.path.dirname(out_path), os.path.basename(out_path)
+        values = [value for graph in model.graphs() for value in graph.initializers.values() if value.const_value is not None]
+
+        # Assign each initializer to a shard and an offset within it
+        max_shard_size, alignment = self.save_attrs["max_shard_size"], self.save_attrs["alignment"]
+        layout, shard_sizes = [], [0]
+        for value in values:
+            nbytes = value.const_value.nbytes
+            offset = shard_sizes[-1]
+            if nbytes > self.save_attrs["align_threshold"]:
+                # Pad large initializers so that each one can be memory-mapped directly from its file
+                offset = (offset + alignment - 1) // alignment * alignment
+            if max_shard_size > 0 and shard_sizes[-1] > 0 and offset + nbytes > max_shard_size:
+                shard_sizes.append(0)
+                offset = 0
+            layout.append((len(shard_sizes) - 1, offset, nbytes))
+            shard_sizes[-1] = offset + nbytes
+
+        # Follow the Hugging Face naming convention (e.g. model.onnx-00001-of-00003.data) when there is more than one shard
+        num_shards = len(shard_sizes)
+        filenames = [f"{name}.data"] if num_shards == 1 else [f"{name}-{i + 1:05d}-of-{num_shards:05d}.data" for i in range(num_shards)]
+        for filename, size in zip(filenames, shard_sizes):
+            with open(os.path.join(out_dir, filename), "wb") as f:
+                f.truncate(size)
+
+        def write(tensor: ir.TensorProtocol, shard: int, offset: int):
+            # Each file is opened separately so that threads write to their own regions without sharing a file position
+            data = tensor.tobytes()
+            with open(os.path.join(out_dir, filenames[shard]), "r+b") as f:
+                f.seek(offset)
+                f.write(data)
+            if isinstance(tensor, ir.ExternalTensor):
+                tensor.release()
+
+        with ThreadPoolExecutor(max_workers=max(self.save_attrs["num_threads"], 1)) as executor, tqdm(total=len(values)) as pbar:
+            futures = {executor.submit(write, value.const_value, shard, offset): value.const_value for value, (shard, offset, _) in zip(values, layout)}
+            for future in as_completed(futures):
+                future.result()
+                tensor = futures[future]
+                pbar.update()
+                pbar.set_description(f"Saving {tensor.name} ({tensor.dtype.short_name()}, {tensor.shape})")
+
+        # Save the ONNX model with references to the external data files and then restore the original initializers
+        tensors = [value.const_value for value in values]
+        try:
+            for value, (shard, offset, nbytes) in zip(values, layout):
+                tensor = value.const_value
+                value.const_value = ir.ExternalTensor(filenames[shard], offset, nbytes, tensor.dtype, shape=tensor.shape, name=tensor.name, base_dir=out_dir)
+            ir.save(model, out_path)
+        finally:
+            for value, tensor in zip(values, tensors):
+                value.const_value = tensor
+
+        if max_shard_size > 0:
+            # Save an index of where each initializer is stored for tools that read the shards without parsing the ONNX model.
+            # ONNX Runtime doesn't read it: each initializer in the model already refers to its file, offset, and length
+            index = {
+                "metadata": {"total_size": sum(shard_sizes), "alignment": alignment},
+                "shards": dict(zip(filenames, shard_sizes)),
+                "weight_map": {
+                    value.name: {"file": filenames[shard], "offset": offset, "length": nbytes}
+                    for value, (shard, offset, nbytes) in zip(values, layout)
+                },
+            }
+            with open(os.path.join(out_dir, f"{name}.data.index.json"), "w") as f:
+                json.dump(index, f, indent=4)
+
     def make_initializer(
         self, tensor: torch.Tensor | np.ndarray | ir.TensorProtocol, /, name: str, to: ir.DataType | None = None
     ):
@@ -551,7 +707,12 @@ class Model:
             ir_tensor = ir.tensor(tensor, name=name)
         value = self.make_value(name, ir_tensor.dtype, ir_tensor.shape)
         value.const_value = ir_tensor
+        self.register_initializer(value)
+
+    def register_initializer(self, value: ir.Value):
         self.model.graph.register_initializer(value)
+        if self.stream_attrs["enabled"]:
+            self.stream_attrs["pending"].append(value)
 
     def make_node(self, op_type, inputs: Sequence[str], outputs: Sequence[str], *, name: str, domain="", **kwargs):
         assert name, "Node name must be provided"
@@ -572,6 +733,10 @@ class Model:
             if input_name.startswith("/model/constants") and input_name not in self.node_names:
                 self.make_constant(input_name)
 
+        if self.is_int4_quantized_while_streaming(op_type, inputs, name, domain):
+            self.make_node_int4(op_type, inputs, outputs, name=name, **kwargs)
+            return
+
         # Resolve values from names
         input_values = [self.make_value(name) for name in inputs]
         output_values = [self.make_value(name) for name in outputs]
@@ -579,6 +744,59 @@ class Model:
         self.model.graph.append(node)
         self.node_names.add(name)
 
+    def is_int4_quantized_while_streaming(self, op_type, inputs, name, domain):
+        # Quantizing at the end would read every streamed weight back into memory, so each node that
+        # MatMulNBitsQuantizer would quantize is quantized on its own as it's built instead
+        if not self.is_streaming() or self.stream_attrs["quantizing"] or not self.uses_int4_quantizer():
+            return False
+        if domain != "" or op_type not in self.quant_attrs["int4"]["op_types_to_quantize"] or name in self.quant_attrs["int4"]["nodes_to_exclude"]:
+            return False
+        weight_index = {"MatMul": 1, "Gather": 0}.get(op_type)
+        return weight_index is not None and inputs[weight_index] in self.model.graph.initializers
+
+    def make_node_int4(self, op_type, inputs, outputs, *, name, **kwargs):
+        # Make a model with only this node and its weight for MatMulNBitsQuantizer
+        weight_index = 1 if op_type == "MatMul" else 0
+        weight = self.values[inputs[weight_index]]
+        tensor = weight.const_value
+        if isinstance(tensor, ir.ExternalTensor):
+            # The quantizer needs the weight in memory (e.g. for decoder layers loaded from the layer cache)
+            tensor = ir.Tensor(tensor.numpy(), dtype=tensor.dtype, name=tensor.name)
+
+        graph_inputs = [ir.Value(name=input_name, type=self.make_value(input_name).type, shape=self.make_value(input_name).shape) for i, input_name in enumerate(inputs) if i != weight_index]
+        graph_weight = ir.Value(name=weight.name, type=weight.type, shape=weight.shape, const_value=tensor)
+        graph_outputs = [ir.Value(name=output_name) for output_name in outputs]
+        node_inputs = graph_inputs[:weight_index] + [graph_weight] + graph_inputs[weight_index:]
+        node = ir.node(op_type, inputs=node_inputs, attributes=kwargs, outputs=graph_outputs, name=name)
+        graph = ir.Graph(graph_inputs, graph_outputs, nodes=[node], initializers=[graph_weight], opset_imports=self.model.opset_imports)
+
+        quant = self.make_int4_quantizer(ir.Model(graph, ir_version=self.model.ir_version))
+        quant.process()
+        quantized = ir.from_proto(quant.model.model)
+
+        # Add the quantized nodes and their initializers, and drop the float weight if it was replaced
+        for initializer_name, value in quantized.graph.initializers.items():
+            if initializer_name in self.model.graph.initializers:
+                continue
+            initializer = self.make_value(initializer_name, value.dtype, value.shape)
+            initializer.const_value = value.const_value
+            self.register_initializer(initializer)
+
+        self.stream_attrs["quantizing"] = True
+        try:
+            for node in quantized.graph:
+                node_inputs = [value.name if value is not None else "" for value in node.inputs]
+                node_outputs = [value.name for value in node.outputs]
+                self.make_node(node.op_type, inputs=node_inputs, outputs=node_outputs, name=node.name, domain=node.domain, **node.attributes)
+        finally:
+            self.stream_attrs["quantizing"] = False
+        self.node_names.add(name)
+
+        if weight.name not in quantized.graph.initializers and not weight.uses():
+            self.model.graph.initializers.pop(weight.name)
+            weight.const_value = None
+            del self.values[weight.name]
+
     def make_value(self, name, dtype: ir.DataType | int| None = None, shape: Sequence[int | str] | ir.Shape | None = None) -> ir.Value:
         """Obtain or create an IR value by value name.
 
@@ -628,6 +846,12 @@ class Model:
             value_name = f"present.{i}.value"
             outputs.append(self.make_value(value_name, dtype=self.output_types["present.value"], shape=self.output_shapes["present.value"]))
 
+            if self.kv_cache_int8:
+                # Add KV cache scales to inputs and outputs
+                for kv in ["key", "value"]:
+                    inputs.append(self.make_value(f"past_key_values.{i}.{kv}_scale", dtype=self.input_types[f"past_key_values.{kv}_scale"], shape=self.input_shapes[f"past_key_values.{kv}_scale"]))
+                    outputs.append(self.make_value(f"present.{i}.{kv}_scale", dtype=self.output_types[f"present.{kv}_scale"], shape=self.output_shapes[f"present.{kv}_scale"]))
+
     def make_constant(self, name):
         # Make constant ops for 0, 1, 2, 3, etc.
         # Format of name is "/model/constants/{dtype}/{num}"
@@ -723,9 +947,9 @@ class Model:
         self.make_node("ReduceSum", inputs=inputs, outputs=[output], name=name)
         self.make_value(output, dtype, shape=shape)
 
-    def make_reduce_max(self, name, inputs, dtype, shape):
+    def make_reduce_max(self, name, inputs, dtype, shape, keepdims=False):
         output = f"{name}/output_0"
-        self.make_node("ReduceMax", inputs=inputs, outputs=[output], name=name, keepdims=False)
+        self.make_node("ReduceMax", inputs=inputs, outputs=[output], name=name, keepdims=keepdims)
         self.make_value(output, dtype, shape=shape)
 
     def make_reduce_mean(self, name, inputs, dtype, shape, keepdims=False):
@@ -738,6 +962,21 @@ class Model:
         self.make_node("Sqrt", inputs=inputs, outputs=[output], name=name)
         self.make_value(output, dtype, shape=shape)
 
+    def make_abs(self, name, root_input, dtype, shape):
+        output = f"{name}/output_0"
+        self.make_node("Abs", inputs=[root_input], outputs=[output], name=name)
+        self.make_value(output, dtype, shape=shape)
+
+    def make_round(self, name, root_input, dtype, shape):
+        output = f"{name}/output_0"
+        self.make_node("Round", inputs=[root_input], outputs=[output], name=name)
+        self.make_value(output, dtype, shape=shape)
+
+    def make_max(self, name, inputs, dtype, shape):
+        output = f"{name}/output_0"
+        self.make_node("Max", inputs=inputs, outputs=[output], name=name)
+        self.make_value(output, dtype, shape=shape)
+
     def make_cast(self, name, root_input, dtype, shape):
         output = f"{name}/output_0"
         self.make_node("Cast", inputs=[root_input], outputs=[output], name=name, to=dtype)
@@ -820,10 +1059,12 @@ class Model:
 
     def make_matmul_int4(self, matmul, basename, root_input, **kwargs):
         if not hasattr(matmul, "qweight"):
-            # TODO: quantize weights, then save new MatMul weights for onnx model
-            # print(f"Quantizing to {self.onnx_dtype} on-the-fly is not currently supported.")
-            # print(f"Saving as {self.io_dtype} on-the-fly and quantizing to {self.onnx_dtype} at the end.")
-            return self.make_matmul_float(matmul, basename, root_input, **kwargs)
+            if not self.quant_attrs["int4"]["quantize_on_the_fly"] or basename in self.quant_attrs["int4"]["nodes_to_exclude"]:
+                # Save as float MatMul and quantize (or skip) with MatMulNBitsQuantizer at the end
+                return self.make_matmul_float(matmul, basename, root_input, **kwargs)
+
+            # Quantize weights, then save new MatMul weights for onnx model
+            matmul = self.make_int4_quantized_weights(matmul)
 
         name = f"{basename}NBits"
 
@@ -836,8 +1077,9 @@ class Model:
         inputs = [root_input, weight, scales]
 
         if hasattr(matmul, "qzeros") and matmul.qzeros is not None:
+            # Float zero points (e.g. from GGUF models) must have the same type as the scales
             zeros = name[1:].replace("/", ".") + ".qzeros"
-            self.make_initializer(matmul.qzeros, zeros)
+            self.make_initializer(matmul.qzeros, zeros, to=self.io_dtype if matmul.qzeros.is_floating_point() else None)
             inputs.append(zeros)
 
         if hasattr(matmul, "g_idx") and matmul.g_idx is not None:
@@ -855,6 +1097,52 @@ class Model:
 
         return name
 
+    def make_int4_quantized_weights(self, matmul):
+        # Blockwise round-to-nearest quantization of a float weight of shape N x K into the MatMulNBits format:
+        #   qweight: N x k_blocks x (block_size / 2) uint8, with 2 4-bit values per byte (low nibble first)
+        #   scales:  N * k_blocks
+        #   qzeros:  N * ceil(k_blocks / 2) uint8, with 2 4-bit values per byte (only for asymmetric quantization)
+        block_size = self.quant_attrs["int4"]["block_size"]
+        is_symmetric = self.quant_attrs["int4"]["is_symmetric"]
+
+        weight = matmul.weight.float()
+        N, K = weight.shape
+        k_blocks = (K + block_size - 1) // block_size
+        blocks = torch.nn.functional.pad(weight, (0, k_blocks * block_size - K)).reshape(N, k_blocks, block_size)
+
+        if is_symmetric:
+            # Map the value with the largest magnitude in each block to -8 and use 8 as the implicit zero point
+            # (the minimum is used when it ties with the maximum in magnitude, as in MatMulNBitsQuantizer)
+            vmin = blocks.amin(dim=-1, keepdim=True)
+            vmax = blocks.amax(dim=-1, keepdim=True)
+            scales = torch.where(vmax.abs() > vmin.abs(), vmax, vmin) / -8
+            zeros = torch.full_like(scales, 8)
+        else:
+            # Map the range of each block (including 0) to [0, 15]
+            vmin = blocks.amin(dim=-1, keepdim=True).clamp(max=0)
+            vmax = blocks.amax(dim=-1, keepdim=True).clamp(min=0)
+            scales = (vmax - vmin) / 15
+            zeros = torch.where(scales != 0, torch.floor(-vmin / scales + 0.5), 0).clamp(0, 15)
+
+        # Add the zero point before rounding so that halfway cases round up, as in MatMulNBitsQuantizer
+        reciprocals = torch.where(scales != 0, 1 / scales, 0)
+        intweight = torch.clamp(torch.floor(blocks * reciprocals + zeros + 0.5), 0, 15).to(torch.uint8)
+
+        try:
+            from quantized_model import QuantizedTensorModule
+        except ImportError:
+            from onnxruntime_genai.models.quantized_model import QuantizedTensorModule
+
+        quantized_matmul = QuantizedTensorModule(bits=4, group_size=block_size)
+        quantized_matmul.qweight = (intweight[..., 0::2] | (intweight[..., 1::2] << 4)).contiguous()
+        quantized_matmul.scales = scales.reshape(-1)
+        if not is_symmetric:
+            intzeros = torch.nn.functional.pad(zeros.reshape(N, k_blocks).to(torch.uint8), (0, k_blocks & 1))
+            quantized_matmul.qzeros = (intzeros[:, 0::2] | (intzeros[:, 1::2] << 4)).reshape(-1)
+        quantized_matmul.in_features = K
+        quantized_matmul.out_features = N
+        return quantized_matmul
+
     def make_dequantize_linear(self, dequantize_name, quantized_op):
         # Input weights are quantized, save quantized MatMul weights for onnx model
         qweight = dequantize_name[1:].replace("/", ".") + ".qweight"
@@ -897,9 +1185,7 @@ class Model:
 
     def make_matmul_int4_qdq(self, matmul, matmul_name, root_input, **kwargs):
         if not hasattr(matmul, "qweight"):
-            # TODO: quantize weights, then save new MatMul weights for onnx model
-            # print(f"Quantizing to {self.onnx_dtype} on-the-fly is not currently supported.")
-            # print(f"Saving as {self.io_dtype} on-the-fly and quantizing to {self.onnx_dtype} at the end.")
+            # Save as float MatMul and quantize with MatMulNBitsQuantizer in QDQ format at the end
             return self.make_matmul_float(matmul, matmul_name, root_input, **kwargs)
 
         dequantize_output = self.make_dequantize_linear(f"{matmul_name}/DequantizeLinear", matmul)
@@ -986,9 +1272,7 @@ class Model:
 
     def make_packed_matmul_int4(self, q_matmul, k_matmul, v_matmul, basename, root_input, **kwargs):
         if not hasattr(q_matmul, "qweight"):
-            # TODO: quantize weights, then save new MatMul weights for onnx model
-            # print(f"Quantizing to {self.onnx_dtype} on-the-fly is not currently supported.")
-            # print(f"Saving as {self.io_dtype} on-the-fly and quantizing to {self.onnx_dtype} at the end.")
+            # Pack the float weights, the packed MatMul is then quantized like any other (see `make_matmul_int4`)
             return self.make_packed_matmul_float(q_matmul, k_matmul, v_matmul, basename, root_input, **kwargs)
 
         # Create dummy PackedMatMul class
@@ -996,7 +1280,7 @@ class Model:
             def __init__(self):
                 self.qweight = torch.cat([q_matmul.qweight, k_matmul.qweight, v_matmul.qweight], dim=0)
                 self.scales = torch.cat([q_matmul.scales, k_matmul.scales, v_matmul.scales], dim=0)
-                self.qzeros = torch.cat([q_matmul.qzeros, k_matmul.qzeros, v_matmul.qzeros], dim=0)
+                self.qzeros = torch.cat([q_matmul.qzeros, k_matmul.qzeros, v_matmul.qzeros], dim=0) if q_matmul.qzeros is not None else None
                 self.g_idx = q_matmul.g_idx
 
                 self.in_features = q_matmul.in_features
@@ -1796,6 +2080,15 @@ class Model:
 
     def make_attention_op(self, name, **kwargs):
         op_type = self.attention_attrs["op_type"]
+        if self.kv_cache_int8 and kwargs.get("past_k", ""):
+            # Dequantize the int8 past KV cache for the attention op, and quantize the new positions of its present
+            present_k, present_v = kwargs["present_k"], kwargs["present_v"]
+            past_k, past_v = kwargs["past_k"], kwargs["past_v"]
+            kwargs["past_k"] = self.make_kv_cache_dequantize(f"{name}/past_k", past_k)
+            kwargs["past_v"] = self.make_kv_cache_dequantize(f"{name}/past_v", past_v)
+            kwargs["present_k"], kwargs["present_v"] = f"{name}/present_k", f"{name}/present_v"
+            self.make_value(kwargs["present_k"], self.io_dtype, shape=self.output_shapes["present.key"])
+            self.make_value(kwargs["present_v"], self.io_dtype, shape=self.output_shapes["present.value"])
 
         if op_type == "MultiHeadAttention":
             self.make_multi_head_attention(name, add_qk=f"{self.mask_attrs['mask_name']}/output_0", **kwargs)
@@ -1806,6 +2099,86 @@ class Model:
         else:
             raise NotImplementedError(f"The {op_type} op is not currently supported.")
 
+        if self.kv_cache_int8 and kwargs.get("past_k", ""):
+            self.make_kv_cache_quantize(f"{name}/present_k", kwargs["present_k"], past_k, present_k)
+            self.make_kv_cache_quantize(f"{name}/present_v", kwargs["present_v"], past_v, present_v)
+
+    def make_kv_cache_dequantize(self, name, past):
+        # Make nodes for the int8 past KV cache dequantization subgraph. The whole past is dequantized at every step, since
+        # GroupQueryAttention only reads the io_dtype. The float past is an intermediate, so it is freed once its layer is done.
+        #
+        #   past (int8)   past_scale
+        #        |            |
+        #      Cast           |
+        #         \          /
+        #            Mul
+        shape = self.input_shapes["past_key_values.key"]
+        cast_name = f"{name}/Cast"
+        self.make_cast(cast_name, past, dtype=self.io_dtype, shape=shape)
+        mul_name = f"{name}/Mul"
+        self.make_mul(mul_name, [f"{cast_name}/output_0", f"{past}_scale"], dtype=self.io_dtype, shape=shape)
+        return f"{mul_name}/output_0"
+
+    def make_kv_cache_quantize(self, name, root_input, past, present):
+        # Make nodes for the int8 present KV cache quantization subgraph. Only the new positions of the present are quantized, with a
+        # scale of max(abs(x)) / 127 per position of each head, and they're appended to the past so the past is stored as is.
+        #
+        #      past          root_input (present)
+        #        |                   |
+        #      Shape                 |
+        #        |                   |
+        #      Slice --------------> Slice (positions from past_sequence_length)
+        #                            /     \
+        #                          Abs      |
+        #                           |       |
+        #                       ReduceMax   |
+        #                           |       |
+        #                          Div      |
+        #                           |       |
+        #                          Max ---> Div
+        #                           |       |
+        #   past_scale ---> Concat  |     Round
+        #                     |     |       |
+        #              present_scale|     Clip
+        #                           |       |
+        #                           |     Cast (int8)
+        #                           |       |
+        #                           +     Concat <--- past
+        #                                   |
+        #                                present
+        new_shape = ["batch_size", self.num_kv_heads, "sequence_length", self.head_size]
+        scale_shape = ["batch_size", self.num_kv_heads, "sequence_length", 1]
+        str_dtype = self.to_str_dtype(self.io_dtype)
+
+        shape_name = f"{name}/Shape"
+        self.make_shape(shape_name, past, shape=[4])
+        slice_1_name = f"{name}/Slice_1"
+        slice_1_inputs = [f"{shape_name}/output_0", "/model/constants/INT64/[2]", "/model/constants/INT64/[3]"]
+        self.make_slice(slice_1_name, slice_1_inputs, dtype=ir.DataType.INT64, shape=[1])
+        slice_2_name = f"{name}/Slice_2"
+        slice_2_inputs = [root_input, f"{slice_1_name}/output_0", f"/model/constants/INT64/[{torch.iinfo(torch.int64).max}]", "/model/constants/INT64/[2]"]
+        self.make_slice(slice_2_name, slice_2_inputs, dtype=self.io_dtype, shape=new_shape)
+
+        abs_name = f"{name}/Abs"
+        self.make_abs(abs_name, f"{slice_2_name}/output_0", dtype=self.io_dtype, shape=new_shape)
+        reduce_max_name = f"{name}/ReduceMax"
+        self.make_reduce_max(reduce_max_name, [f"{abs_name}/output_0", "/model/constants/INT64/[3]"], dtype=self.io_dtype, shape=scale_shape, keepdims=True)
+        div_1_name = f"{name}/Div_1"
+        self.make_div(div_1_name, [f"{reduce_max_name}/output_0", f"/model/constants/{str_dtype}/127.0"], dtype=self.io_dtype, shape=scale_shape)
+        max_name = f"{name}/Max"
+        self.make_max(max_name, [f"{div_1_name}/output_0", f"/model/constants/{str_dtype}/1e-8"], dtype=self.io_dtype, shape=scale_shape)
+        self.make_node("Concat", inputs=[f"{past}_scale", f"{max_name}/output_0"], outputs=[f"{present}_scale"], name=f"{name}/Concat_1", axis=2)
+
+        div_2_name = f"{name}/Div_2"
+        self.make_div(div_2_name, [f"{slice_2_name}/output_0", f"{max_name}/output_0"], dtype=self.io_dtype, shape=new_shape)
+        round_name = f"{name}/Round"
+        self.make_round(round_name, f"{div_2_name}/output_0", dtype=self.io_dtype, shape=new_shape)
+        clip_name = f"{name}/Clip"
+        self.make_clip(clip_name, [f"{round_name}/output_0", f"/model/constants/{str_dtype}/-127.0", f"/model/constants/{str_dtype}/127.0"], dtype=self.io_dtype, shape=new_shape)
+        cast_name = f"{name}/Cast"
+        self.make_cast(cast_name, f"{clip_name}/output_0", dtype=ir.DataType.INT8, shape=new_shape)
+        self.make_node("Concat", inputs=[past, f"{cast_name}/output_0"], outputs=[present], name=f"{name}/Concat_2", axis=2)
+
     def make_multi_head_attention(self, name, **kwargs):
         inputs = [
             kwargs["q_path"], kwargs["k_path"], kwargs["v_path"], kwargs.get("bias", ""),
@@ -2433,6 +2806,24 @@ class Model:
             raise NotImplementedError(f"The {self.activation} activation function is not currently supported.")
         return output_name
 
+    def make_last_token_gather(self, root_input):
+        # Make nodes for selecting the hidden states of the last token of each sequence
+        #
+        #   last_token_indices (B) --> Unsqueeze (B, 1, 1) --> Expand (B, 1, H)
+        #                                                           |
+        #   root_input (B, S, H) --------------------------> GatherElements (B, 1, H)
+        basename = "/lm_head/last_token"
+        unsqueeze_name = f"{basename}/Unsqueeze"
+        self.make_unsqueeze(unsqueeze_name, ["last_token_indices", "/model/constants/INT64/[1, 2]"], dtype=ir.DataType.INT64, shape=["batch_size", 1, 1])
+        expand_name = f"{basename}/Expand"
+        self.make_expand(expand_name, [f"{unsqueeze_name}/output_0", f"/model/constants/INT64/[1, 1, {self.hidden_size}]"], dtype=ir.DataType.INT64, shape=["batch_size", 1, self.hidden_size])
+
+        gather_name = f"{basename}/GatherElements"
+        gather_output = f"{gather_name}/output_0"
+        self.make_node("GatherElements", inputs=[root_input, f"{expand_name}/output_0"], outputs=[gather_output], name=gather_name, axis=1)
+        self.make_value(gather_output, self.io_dtype, shape=["batch_size", 1, self.hidden_size])
+        return gather_output
+
     def make_lm_head(self, lm_head):
         # Check if there are ops to insert after MatMul
         bias_exists = lm_head.bias is not None
@@ -2447,6 +2838,8 @@ class Model:
 
         matmul_basename = "/lm_head/MatMul"
         root_input = self.layernorm_attrs["output_0"]
+        if "last_token_indices" in self.input_names:
+            root_input = self.make_last_token_gather(root_input)
         matmul_name = self.make_matmul(lm_head, matmul_basename, root_input, logits=not any(exists_checks))
         lm_name = matmul_name
 
@@ -2498,6 +2891,25 @@ class Model:
             self.make_node('Cast', inputs=[f"{lm_name}/output_0"], outputs=[cast_output], name=cast_name, to=self.output_types['logits'])
             self.make_value(cast_output, self.output_types['logits'], shape=['batch_size', 'sequence_length', self.vocab_size])
 
+        if self.top_k_head > 0:
+            self.make_top_k_head()
+
+    def make_top_k_head(self):
+        # Make nodes for selecting the top k logits so that only their token ids leave the model
+        #
+        #   logits (B, 1, V) --> ArgMax --> top_k_indices (B, 1, 1)        when k = 1
+        #
+        #                             +--> top_k_logits (B, 1, k)
+        #   logits (B, 1, V) --> TopK |                                   when k > 1
+        #                             +--> top_k_indices (B, 1, k)
+        #
+        # Temperature is applied by the runtime to the top k logits since it does not change which logits are the largest.
+        if self.top_k_head == 1:
+            self.make_node("ArgMax", inputs=["logits"], outputs=["top_k_indices"], name="/lm_head/ArgMax", axis=-1, keepdims=1)
+        else:
+            topk_inputs = ["logits", f"/model/constants/INT64/[{self.top_k_head}]"]
+            self.make_node("TopK", inputs=topk_inputs, outputs=["top_k_logits", "top_k_indices"], name="/lm_head/TopK", axis=-1, largest=1, sorted=1)
+
     def make_layer(self, layer_id, layer):
         # Each LLM decoder layer is typically defined as:
         # input_layernorm --> attention --> output_layernorm --> MLP
@@ -2518,6 +2930,10 @@ class Model:
         # Make pre-processing nodes
         self.make_preprocessing_nodes()
 
+        # Remove any staging file left behind by an interrupted build
+        if self.stream_attrs["enabled"] and os.path.exists(self.stream_attrs["data_path"]):
+            os.remove(self.stream_attrs["data_path"])
+
         # Load weights of original model
         if input_path.endswith(".gguf"):
             # Load GGUF model
@@ -2525,7 +2941,8 @@ class Model:
                 from gguf_model import GGUFModel
             except ImportError:
                 from onnxruntime_genai.models.gguf_model import GGUFModel
-            model = GGUFModel.from_pretrained(self.model_type, input_path, self.head_size, self.hidden_size, self.intermediate_size, self.num_attn_heads, self.num_kv_heads, self.vocab_size)
+            use_matmul_nbits = self.onnx_dtype in {ir.DataType.INT4, ir.DataType.UINT4} and not self.quant_attrs["use_qdq"]
+            model = GGUFModel.from_pretrained(self.model_type, input_path, self.head_size, self.hidden_size, self.intermediate_size, self.num_attn_heads, self.num_kv_heads, self.vocab_size, use_matmul_nbits)
             self.layernorm_attrs["add_offset"] = 0  # add offset already done for GGUF models
 
         elif self.quant_type is not None:
@@ -2538,24 +2955,36 @@ class Model:
             kv_size = self.num_kv_heads * self.head_size
             model = QuantModel.from_pretrained(self.quant_type, input_path=input_path, quant_attrs=self.quant_attrs, q_size=q_size, kv_size=kv_size, intermediate_size=self.intermediate_size, num_layers=self.num_layers)
 
+        elif self.stream_attrs["enabled"] and "adapter_path" not in self.extra_options:
+            # Create PyTorch model without weights and load each module's weights only when it is built
+            model = self.make_streaming_model()
+
         else:
             # Load PyTorch model
             extra_kwargs = {"num_hidden_layers": self.num_layers} if "num_hidden_layers" in self.extra_options else {}
             model = AutoModelForCausalLM.from_pretrained(self.model_name_or_path, cache_dir=self.cache_dir, token=self.hf_token, trust_remote_code=True, **extra_kwargs)
 
+        if hasattr(model, "load_module"):
+            # GGUF and quantized models release each module's weights once the next module is requested,
+            # so decoder layers that are built later in parallel need to load their weights again
+            self.parallel_attrs["source_model"] = model
+
         if "adapter_path" in self.extra_options:
             from peft import PeftModel
             model = PeftModel.from_pretrained(model, self.extra_options["adapter_path"], cache_dir=self.cache_dir, token=self.hf_token)
 
         # Loop through model and map each module to ONNX/ORT ops
         self.layer_id = 0
+        layers = []
         for module in model.modules():
             if (isinstance(module, torch.nn.Embedding) and module.weight.shape[0] == self.vocab_size) or (hasattr(model, "embedding") and module == model.embedding):
                 # Checks (Hugging Face logic) or (GGUF logic)
                 if not self.exclude_embeds:
                     # Embedding layer
                     print("Reading embedding layer")
+                    self.load_streaming_weights(module)
                     self.make_embedding(module.weight)
+                    self.flush_streaming_weights(module)
                 else:
                     # Exclude embedding layer from model
                     self.layernorm_attrs["root_input"] = "inputs_embeds"
@@ -2563,24 +2992,330 @@ class Model:
 
             elif (module.__class__.__name__.endswith("DecoderLayer") or module.__class__.__name__.endswith("GLMBlock")) and self.layer_id < self.num_layers:
                 # Each decoder layer of model
-                print(f"Reading decoder layer {self.layer_id}")
-                self.make_layer(self.layer_id, module)
+                if self.parallel_attrs["num_workers"] > 1:
+                    # Collect decoder layers and build them all at once after the last one is found
+                    layers.append(module)
+                    self.layer_id += 1
+                    if self.layer_id == self.num_layers:
+                        self.make_layers_parallel(layers)
+                    continue
+
+                if self.layer_cache_attrs["enabled"]:
+                    self.make_layer_cached(self.layer_id, module)
+                else:
+                    print(f"Reading decoder layer {self.layer_id}")
+                    self.load_streaming_weights(module)
+                    self.make_layer(self.layer_id, module)
+                self.flush_streaming_weights(module)
                 self.layer_id += 1
 
             elif self.layer_id == self.num_layers and self.has_final_norm(module, model):
                 # SkipLayerNorm after last decoder layer (MatMul --> SkipLayerNorm)
                 print("Reading final norm")
+                self.load_streaming_weights(module)
                 self.make_layernorm(self.layer_id, module, skip=True, simple=self.layernorm_attrs["simple"], location="final_norm")
+                self.flush_streaming_weights(module)
 
             elif (isinstance(module, torch.nn.Linear) and module.out_features == self.vocab_size) or (hasattr(model, "lm_head") and module == model.lm_head):
                 # Checks (Hugging Face logic) or (GGUF logic)
                 if not self.exclude_lm_head:
                     # Language modeling head (SkipLayerNorm --> logits)
                     print("Reading LM head")
+                    self.load_streaming_weights(module)
                     self.make_lm_head(module)
+                    self.flush_streaming_weights(module)
 
+        if hasattr(model, "close"):
+            # Quantized models keep their weight files open until they are built
+            model.close()
+        self.parallel_attrs["source_model"] = None
         del model
 
+    def make_streaming_model(self):
+        # Find the safetensors files that store each checkpoint tensor
+        if os.path.isdir(self.model_name_or_path):
+            model_dir = self.model_name_or_path
+        else:
+            from huggingface_hub import snapshot_download
+            model_dir = snapshot_download(self.model_name_or_path, allow_patterns=["*.safetensors", "*.safetensors.index.json"], cache_dir=self.cache_dir, token=self.hf_token)
+
+        index_path = os.path.join(model_dir, "model.safetensors.index.json")
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                weight_map = json.load(f)["weight_map"]
+            self.stream_attrs["weight_map"] = {name: os.path.join(model_dir, filename) for name, filename in weight_map.items()}
+        else:
+            from safetensors import safe_open
+            for filename in sorted(os.listdir(model_dir)):
+                if not filename.endswith(".safetensors"):
+                    continue
+                with safe_open(os.path.join(model_dir, filename), framework="pt") as f:
+                    self.stream_attrs["weight_map"].update({name: os.path.join(model_dir, filename) for name in f.keys()})
+        if not self.stream_attrs["weight_map"]:
+            raise FileNotFoundError(f"Streaming requires safetensors weights, but none were found in {model_dir}.")
+
+        # Create model on the meta device so that no weights are allocated yet
+        config = AutoConfig.from_pretrained(self.model_name_or_path, cache_dir=self.cache_dir, token=self.hf_token, trust_remote_code=True)
+        if "num_hidden_layers" in self.extra_options:
+            config.num_hidden_layers = self.num_layers
+        with torch.device("meta"):
+            model = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
+
+        self.stream_attrs["module_names"] = {id(module): name for name, module in model.named_modules()}
+        for name, tensor in list(model.named_parameters(remove_duplicate=False)) + list(model.named_buffers(remove_duplicate=False)):
+            self.stream_attrs["aliases"].setdefault(id(tensor), []).append(name)
+        return model
+
+    def load_streaming_weights(self, module):
+        if not self.stream_attrs["enabled"] or not self.stream_attrs["module_names"]:
+            return
+
+        from safetensors import safe_open
+        prefix = self.stream_attrs["module_names"][id(module)]
+        prefix = f"{prefix}." if prefix else ""
+
+        # Group the tensors to read by the file that stores them so each file is opened once
+        to_load = {}
+        for name, tensor in module.state_dict(keep_vars=True).items():
+            aliases = [f"{prefix}{name}"] + self.stream_attrs["aliases"].get(id(tensor), [])
+            key = next((alias for alias in aliases if alias in self.stream_attrs["weight_map"]), None)
+            if key is None:
+                if isinstance(tensor, torch.nn.Parameter):
+                    raise KeyError(f"Could not find {prefix}{name} in the safetensors checkpoint.")
+                # Buffers that are not saved in the checkpoint (e.g. the rotary embedding's `inv_freq`) stay on the
+                # meta device, since the builder computes what it needs from the config instead of reading them
+                continue
+            to_load.setdefault(self.stream_attrs["weight_map"][key], []).append((name, key, tensor.dtype))
+
+        state_dict = {}
+        for path, entries in to_load.items():
+            with safe_open(path, framework="pt") as f:
+                for name, key, dtype in entries:
+                    # Cast to the dtype that `from_pretrained` would have loaded the weight in
+                    state_dict[name] = f.get_tensor(key).to(dtype)
+        module.load_state_dict(state_dict, strict=False, assign=True)
+
+    def flush_streaming_weights(self, module):
+        if not self.stream_attrs["enabled"] or (not self.stream_attrs["module_names"] and self.quant_type is None):
+            return
+
+        # Append the initializers made since the last flush to the staging file and replace them with references to it
+        data_path = self.stream_attrs["data_path"]
+        pending, self.stream_attrs["pending"] = self.stream_attrs["pending"], []
+        with open(data_path, "ab") as f:
+            for value in pending:
+                tensor = value.const_value
+                if tensor is None or isinstance(tensor, ir.ExternalTensor) or self.model.graph.initializers.get(value.name) is not value:
+                    continue
+                data = tensor.tobytes()
+                f.write(data)
+                value.const_value = ir.ExternalTensor(
+                    os.path.basename(data_path),
+                    self.stream_attrs["offset"],
+                    len(data),
+                    tensor.dtype,
+                    shape=tensor.shape,
+                    name=tensor.name,
+                    base_dir=os.path.dirname(data_path),
+                )
+                self.stream_attrs["offset"] += len(data)
+
+        # Free the module's weights before the next module is loaded (quantized models release their own weights)
+        if isinstance(module, torch.nn.Module):
+            module.to("meta")
+
+    def load_source_weights(self, layer):
+        if self.parallel_attrs["source_model"] is not None:
+            self.parallel_attrs["source_model"].load_module(layer)
+
+    def release_source_weights(self, layer):
+        if self.parallel_attrs["source_model"] is not None:
+            self.parallel_attrs["source_model"].release_module(layer)
+
+    def make_layers_parallel(self, layers):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            print("WARNING: Building decoder layers in parallel requires the 'fork' start method, which is not available on this platform. Building decoder layers serially instead.")
+            for layer_id, layer in enumerate(layers):
+                if self.layer_cache_attrs["enabled"]:
+                    self.make_layer_cached(layer_id, layer)
+                else:
+                    print(f"Reading decoder layer {layer_id}")
+                    self.load_streaming_weights(layer)
+                    self.load_source_weights(layer)
+                    self.make_layer(layer_id, layer)
+                self.flush_streaming_weights(layer)
+                self.release_source_weights(layer)
+            return
+
+        # Remember the state that every worker should start each decoder layer from
+        if os.path.exists(self.parallel_attrs["dir"]):
+            shutil.rmtree(self.parallel_attrs["dir"])
+        os.makedirs(self.parallel_attrs["dir"])
+        self.parallel_attrs["node_names"] = set(self.node_names)
+        self.parallel_attrs["create_caches"] = self.rotemb_attrs["create_caches"]
+
+        # Workers are forked so they inherit this object and the layers without pickling them
+        global _parallel_layers_context
+        _parallel_layers_context = (self, layers)
+        num_workers = min(self.parallel_attrs["num_workers"], len(layers))
+        print(f"Reading {len(layers)} decoder layers with {num_workers} worker processes")
+        try:
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork"), initializer=torch.set_num_threads, initargs=(1,)) as executor:
+                # Merge each decoder layer in order as soon as it and all layers before it are done
+                for layer_id, (path, layernorm_attrs) in enumerate(executor.map(_make_layer_in_worker, range(len(layers)))):
+                    print(f"Merging decoder layer {layer_id}")
+                    self.merge_layer(layer_id, path, layernorm_attrs)
+        finally:
+            _parallel_layers_context = None
+
+    def make_layer_in_worker(self, layer_id, layer):
+        # Build the decoder layer into an empty graph so that the graph contains only the layer's nodes and initializers
+        graph = ir.Graph(inputs=(), outputs=(), nodes=(), opset_imports=self.model.opset_imports, name=f"layers.{layer_id}")
+        self.model = ir.Model(graph, ir_version=self.model.ir_version, producer_name=self.model.producer_name)
+        self.values = {}
+        self.stream_attrs["pending"] = []  # The decoder layer's initializers are saved with it, not flushed to the staging file
+        self.node_names = set(self.parallel_attrs["node_names"])
+        self.rotemb_attrs["create_caches"] = self.parallel_attrs["create_caches"]
+
+        # The outputs of the previous decoder layer are not known yet, so use placeholders that are renamed when merging
+        self.layernorm_attrs["root_input"] = f"/model/layers.{layer_id}/parallel/root_input"
+        self.layernorm_attrs["skip_input"] = f"/model/layers.{layer_id}/parallel/skip_input"
+        self.layernorm_attrs["first_layernorm"] = layer_id == 0
+
+        print(f"Reading decoder layer {layer_id}")
+        self.load_streaming_weights(layer)
+        self.load_source_weights(layer)
+
+        path = os.path.join(self.parallel_attrs["dir"], f"layers.{layer_id}.onnx")
+        if self.layer_cache_attrs["enabled"]:
+            path = os.path.join(self.layer_cache_attrs["dir"], f"{self.make_layer_cache_key(layer_id, layer)}.onnx")
+            if os.path.exists(path):
+                print(f"Using cached decoder layer {layer_id}")
+                if self.stream_attrs["enabled"] and isinstance(layer, torch.nn.Module):
+                    layer.to("meta")
+                return path, json.loads(ir.load(path).metadata_props["layernorm_attrs"])
+
+        self.make_layer(layer_id, layer)
+
+        # Mark values made outside of this decoder layer as graph inputs so that the subgraph can be saved and loaded
+        produced = {value.name for node in graph for value in node.outputs} | set(graph.initializers)
+        for node in graph:
+            for value in node.inputs:
+                if value is not None and value.name and value.name not in produced and value not in graph.inputs:
+                    graph.inputs.append(value)
+        self.model.metadata_props["layernorm_attrs"] = json.dumps(self.layernorm_attrs)
+
+        # Save the decoder layer with its own external data file so that the weights do not need to be sent back
+        if self.layer_cache_attrs["enabled"]:
+            # Save into a temporary folder first so that an interrupted save never leaves a partial layer in the cache
+            tmp_dir = f"{path}.{os.getpid()}.tmp"
+            os.makedirs(tmp_dir, exist_ok=True)
+            ir.save(self.model, os.path.join(tmp_dir, os.path.basename(path)), external_data=f"{os.path.basename(path)}.data", size_threshold_bytes=0)
+            os.replace(os.path.join(tmp_dir, f"{os.path.basename(path)}.data"), f"{path}.data")
+            os.replace(os.path.join(tmp_dir, os.path.basename(path)), path)
+            shutil.rmtree(tmp_dir)
+        else:
+            ir.save(self.model, path, external_data=f"layers.{layer_id}.onnx.data", size_threshold_bytes=0)
+        if self.stream_attrs["enabled"] and isinstance(layer, torch.nn.Module):
+            layer.to("meta")
+
+        # Drop the decoder layer's graph, whose lazy initializers hold on to its converted weights, so that a worker process
+        # doesn't keep the weights of every decoder layer it builds
+        self.model = ir.Model(ir.Graph(inputs=(), outputs=(), nodes=(), opset_imports=graph.opset_imports), ir_version=self.model.ir_version, producer_name=self.model.producer_name)
+        self.values = {}
+        self.stream_attrs["pending"] = []
+        return path, self.layernorm_attrs
+
+    def make_layer_cached(self, layer_id, layer):
+        # Build the decoder layer into its own subgraph in the same way as a parallel worker, then merge it into the model
+        os.makedirs(self.layer_cache_attrs["dir"], exist_ok=True)
+        model, values, node_names, layernorm_attrs = self.model, self.values, self.node_names, self.layernorm_attrs
+        pending = self.stream_attrs["pending"]
+        self.parallel_attrs["node_names"] = set(self.node_names)
+        self.parallel_attrs["create_caches"] = self.rotemb_attrs["create_caches"]
+        self.layernorm_attrs = layernorm_attrs.copy()
+        try:
+            path, new_layernorm_attrs = self.make_layer_in_worker(layer_id, layer)
+        finally:
+            # Every decoder layer starts from the same state as in a parallel build so that cached layers can be shared
+            self.model, self.values, self.node_names, self.layernorm_attrs = model, values, node_names, layernorm_attrs
+            self.stream_attrs["pending"] = pending
+            self.rotemb_attrs["create_caches"] = self.parallel_attrs["create_caches"]
+        self.merge_layer(layer_id, path, new_layernorm_attrs)
+
+    def make_layer_cache_settings(self, config, extra_options):
+        # Options that only change how the model is built, not the model itself, are left out
+        build_options = {"streaming", "parallel_layers", "layer_cache", "hf_token"}
+        settings = {
+            "config": config.to_json_string(use_diff=False) if hasattr(config, "to_json_string") else repr(config),
+            "io_dtype": self.io_dtype.name,
+            "onnx_dtype": self.onnx_dtype.name,
+            "ep": self.ep,
+            "extra_options": {key: str(value) for key, value in extra_options.items() if key not in build_options},
+        }
+        sha = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+
+        # Changes to the builder itself also change how decoder layers are built
+        with open(__file__, "rb") as f:
+            sha.update(f.read())
+        return sha.hexdigest()
+
+    def make_layer_cache_key(self, layer_id, layer):
+        sha = hashlib.sha256(self.layer_cache_attrs["settings"].encode())
+        sha.update(f"{layer_id}/{self.rotemb_attrs['create_caches']}".encode())
+
+        # Hash the weights of the decoder layer, whether they are stored in a PyTorch, GGUF, or quantized module
+        seen = set()
+        def update(name, obj):
+            if id(obj) in seen:
+                return
+            if isinstance(obj, torch.Tensor):
+                sha.update(f"{name}/{obj.dtype}/{tuple(obj.shape)}".encode())
+                if obj.device.type != "meta":
+                    sha.update(obj.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+            elif isinstance(obj, np.ndarray):
+                sha.update(f"{name}/{obj.dtype}/{obj.shape}".encode())
+                sha.update(np.ascontiguousarray(obj).reshape(-1).view(np.uint8))
+            elif obj is None or isinstance(obj, (bool, int, float, str, enum.Enum)):
+                sha.update(f"{name}/{obj!r}".encode())
+            elif isinstance(obj, torch.nn.Module):
+                seen.add(id(obj))
+                for key, value in obj.state_dict(keep_vars=True).items():
+                    update(f"{name}.{key}", value)
+            elif hasattr(obj, "__dict__"):
+                seen.add(id(obj))
+                for key, value in sorted(vars(obj).items()):
+                    update(f"{name}.{key}", value)
+        update("layer", layer)
+        return sha.hexdigest()
+
+    def merge_layer(self, layer_id, path, layernorm_attrs):
+        # Replace the placeholder inputs with the outputs of the previous decoder layer
+        renames = {
+            f"/model/layers.{layer_id}/parallel/root_input": self.layernorm_attrs["root_input"],
+            f"/model/layers.{layer_id}/parallel/skip_input": self.layernorm_attrs["skip_input"],
+        }
+
+        # Initializers keep pointing to the decoder layer's external data file until the model is saved
+        layer_model = ir.load(path)
+        for name, value in layer_model.graph.initializers.items():
+            if name in self.model.graph.initializers:
+                continue
+            initializer = self.make_value(name, value.dtype, value.shape)
+            initializer.const_value = value.const_value
+            self.register_initializer(initializer)
+
+        # Re-create nodes by name so that they connect to the existing values in the model
+        for node in layer_model.graph:
+            inputs = [renames.get(value.name, value.name) if value is not None else "" for value in node.inputs]
+            outputs = [value.name for value in node.outputs]
+            self.make_node(node.op_type, inputs=inputs, outputs=outputs, name=node.name, domain=node.domain, **node.attributes)
+            for value in node.outputs:
+                if value.name:
+                    self.make_value(value.name, value.dtype, value.shape)
+
+        self.layernorm_attrs.update(layernorm_attrs)
+
     def has_final_norm(self, module, orig_model):
         # Find where the language model is stored to check attributes. Some classes
         # store the language model in a different attribute than `model.model`.
@@ -3633,11 +4368,20 @@ class ErnieModel(MistralModel):
             self.rotemb_attrs["rescale_factors"] = 1.0 / config.compression_ratio
 
 
+_parallel_layers_context = None
+
+
+def _make_layer_in_worker(layer_id):
+    # Runs in a forked worker process, so `_parallel_layers_context` is inherited from the parent process
+    onnx_model, layers = _parallel_layers_context
+    return onnx_model.make_layer_in_worker(layer_id, layers[layer_id])
+
+
 def check_extra_options(kv_pairs):
     """
     Check key-value pairs and set values correctly
     """
-    bools = ["int4_is_symmetric", "exclude_embeds", "exclude_lm_head", "include_hidden_states", "enable_cuda_graph", "use_8bits_moe", "use_qdq", "use_webgpu_fp32"]
+    bools = ["int4_is_symmetric", "exclude_embeds", "exclude_lm_head", "include_hidden_states", "enable_cuda_graph", "use_8bits_moe", "use_qdq", "use_webgpu_fp32", "streaming", "layer_cache", "last_token_logits", "kv_cache_int8"]
     for key in bools:
         if key in kv_pairs:
             if kv_pairs[key] in {"false", "False", "0"}:
@@ -3659,6 +4403,17 @@ def check_extra_options(kv_pairs):
             nodes_to_exclude.append(node)
         kv_pairs["int4_nodes_to_exclude"] = nodes_to_exclude
 
+    if "align_external_data" in kv_pairs:
+        alignment = int(kv_pairs["align_external_data"])
+        if alignment <= 0 or alignment & (alignment - 1) != 0:
+            raise ValueError("align_external_data must be a power of 2 (e.g. 4096 for pages or 2097152 for huge pages).")
+
+    if "top_k_head" in kv_pairs:
+        if int(kv_pairs["top_k_head"]) < 1:
+            raise ValueError("top_k_head must be 1 (ArgMax) or greater (TopK).")
+        if kv_pairs.get("exclude_lm_head", False):
+            raise ValueError("Both 'top_k_head' and 'exclude_lm_head' cannot be used together. Please use only one of them at once.")
+
     if "exclude_lm_head" in kv_pairs and "include_hidden_states" in kv_pairs:
         # 'exclude_lm_head' is for when 'hidden_states' are outputted and 'logits' are not outputted
         # 'include_hidden_states' is for when 'hidden_states' are outputted and 'logits' are outputted
@@ -3854,7 +4609,9 @@ def get_args():
         help=textwrap.dedent("""\
             Input model source. Currently supported options are:
                 hf_path: Path to folder on disk containing the Hugging Face config, model, tokenizer, etc.
-                gguf_path: Path to float16/float32 GGUF file on disk containing the GGUF model
+                gguf_path: Path to GGUF file on disk containing the GGUF model.
+                    Float16/float32 weights are read as is. For INT4 precision, Q4_0, Q4_1, Q4_K, and Q8_0 weights are
+                    converted directly to MatMulNBits weights (Q8_0 as 8-bit). Other block-quantized weights are dequantized first.
             """),
     )
 
@@ -3916,6 +4673,7 @@ def get_args():
                     Currently supported options are: 'default', 'rtn', 'k_quant_mixed', 'k_quant_last'.
                     k_quant_mixed = k_quant algorithm with mixed precision (int4 + int8).
                     k_quant_last = k_quant algorithm where only the last MatMul (/lm_head/MatMul) is quantized as int8. Other MatMuls are quantized as int4.
+                    With 'default', MatMul weights are quantized blockwise while each layer is built instead of in a separate pass over the whole model at the end.
                 num_hidden_layers = Manually specify the number of layers in your ONNX model (for unit testing purposes).
                 filename = Filename for ONNX model (default is 'model.onnx').
                     For models with multiple components, each component is exported to its own ONNX model.
@@ -3947,6 +4705,39 @@ def get_args():
                     Use this option to enable GPUs that do not support FP16 on WebGPU (e.g. GTX 10xx).
                 adapter_path = Path to folder on disk containing the adapter files (adapter_config.json and adapter model weights).
                     Use this option for LoRA models.
+                parallel_layers = Number of worker processes used to build decoder layers in parallel. Default is 1.
+                    Each decoder layer is built in a worker process and saved with its own external data file in the cache directory.
+                    The decoder layers are then merged into the model in layer order.
+                    This option requires the 'fork' start method for processes, so it is not used on Windows.
+                streaming = Build the model one module at a time to cap peak memory. Default is false.
+                    If true, each decoder layer's weights are read directly from the safetensors files, converted, written to a staging file in the cache directory, and freed before the next layer is read.
+                    Peak memory is bounded by roughly one decoder layer plus the embedding and LM head instead of the whole checkpoint.
+                    Use this option for large Hugging Face or quantized (AWQ/GPTQ/Quark) models stored in safetensors format. It is not used for GGUF or LoRA models.
+                layer_cache = Cache each decoder layer in the cache directory and reuse it in later runs. Default is false.
+                    If true, each decoder layer is saved with its own external data file in the cache directory, keyed by a hash of the layer's weights,
+                    the model config, the precision, the execution provider, and the other extra options. Rerunning an interrupted or repeated
+                    conversion only builds the decoder layers that are not in the cache yet. Cached layers are not deleted after the model is saved.
+                max_shard_size = Maximum size in GB of each external data file. Default is 0, which saves all initializers to one file.
+                    If set, the initializers are split across files named like model.onnx-00001-of-00003.data and an index of where each initializer
+                    is stored is saved to model.onnx.data.index.json. An initializer that is larger than this size is saved in its own file.
+                save_threads = Number of threads used to write the external data files. Default is min(8, number of CPU cores).
+                    Each thread writes whole initializers to their own offsets, so saving large models is bound by disk bandwidth.
+                align_external_data = Alignment in bytes of every initializer's offset in the external data files (e.g. 4096 or 2097152). Default is unset.
+                    By default, only initializers larger than 1 MB are aligned to 64 KB. If set, every initializer is padded to start at a multiple of this value
+                    so ONNX Runtime can memory-map the weights on CPU instead of copying them.
+                last_token_logits = Only compute the logits of the last token of each sequence. Default is false.
+                    If true, the model has a 'last_token_indices' input with the index of the last token of each sequence, and its hidden states are gathered before the LM head.
+                    The logits output then has shape ['batch_size', 1, vocab_size], which reduces the latency and peak memory of processing long prompts.
+                top_k_head = Replace the logits output with the token ids of the top k logits. Default is unset.
+                    If 1, an ArgMax node returns the 'top_k_indices' output for greedy search. If greater than 1, a TopK node returns the 'top_k_logits'
+                    and 'top_k_indices' outputs, and sampling with top_k <= k, top_p, and temperature is done on them by the runtime.
+                    Only the token ids leave the model instead of the logits. This option implies last_token_logits=true.
+                    Beam search, min_length, repetition_penalty, and guidance are not supported with this option.
+                kv_cache_int8 = Store the KV cache as int8 instead of the io_dtype. Default is false.
+                    If true, each past/present KV cache tensor is int8 and has a matching 'key_scale'/'value_scale' tensor with a float scale per position of each KV head.
+                    The past is dequantized before the attention op and only the new positions of the present are quantized. This cuts the KV cache memory by about 4x on FP32 CPU.
+                    Only supported with GroupQueryAttention on the CPU execution provider, and past_present_share_buffer is disabled.
+                    Each step dequantizes the whole past of each layer to the io_dtype and copies it into the new present, so decoding is slower than with a shared float KV cache.
             """),
     )
 
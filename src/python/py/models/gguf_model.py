@@ -12,10 +12,13 @@ no matter where the weights actually come from.
 """
 
 from functools import reduce
+from gguf.constants import GGMLQuantizationType
 from gguf.gguf_reader import GGUFReader
+from gguf.quants import dequantize
 
-import re
+import numpy as np
 import torch
+import warnings
 
 
 class GGUFTensorModule:
@@ -24,6 +27,63 @@ class GGUFTensorModule:
         self.bias = None
 
 
+class GGUFQuantizedTensor:
+    """
+    Rows of a block-quantized GGUF tensor that are kept in their original format until they are loaded
+    """
+    def __init__(self, data, tensor_type, shape):
+        self.data = data  # Memory-mapped bytes of shape (rows, bytes per row)
+        self.tensor_type = tensor_type
+        self.shape = torch.Size(shape)
+
+    def __getitem__(self, key):
+        # Each row is quantized separately, so rows can be sliced and re-ordered without unpacking them
+        data = self.data[key]
+        return GGUFQuantizedTensor(data, self.tensor_type, [data.shape[0], self.shape[1]])
+
+    def dequantize(self):
+        return torch.from_numpy(dequantize(self.data, self.tensor_type)).reshape(self.shape)
+
+    def unpack(self):
+        """
+        Unpack into `MatMulNBits` blocks of 32 values as (quantized values, scales, offsets, bits) such that
+        weight = quantized value * scale + offset
+        """
+        rows = self.data.shape[0]
+        if self.tensor_type in {GGMLQuantizationType.Q4_0, GGMLQuantizationType.Q4_1}:
+            # Q4_0 block: d (fp16), qs (16 bytes) with weight = (q - 8) * d
+            # Q4_1 block: d (fp16), m (fp16), qs (16 bytes) with weight = q * d + m
+            # The low nibbles of qs store the first 16 values of a block and the high nibbles store the last 16 values
+            header = 2 if self.tensor_type == GGMLQuantizationType.Q4_0 else 4
+            blocks = self.data.reshape(rows, -1, header + 16)
+            scales = blocks[:, :, 0:2].copy().view(np.float16)[..., 0].astype(np.float32)
+            offsets = None if header == 2 else blocks[:, :, 2:4].copy().view(np.float16)[..., 0].astype(np.float32)
+            qs = blocks[:, :, header:]
+            return np.concatenate([qs & 0x0F, qs >> 4], axis=-1), scales, offsets, 4
+
+        if self.tensor_type == GGMLQuantizationType.Q8_0:
+            # Q8_0 block: d (fp16), qs (32 int8 values) with weight = q * d
+            # Store q + 128 so that `MatMulNBits` can use its default zero point of 128
+            blocks = self.data.reshape(rows, -1, 34)
+            scales = blocks[:, :, 0:2].copy().view(np.float16)[..., 0].astype(np.float32)
+            return blocks[:, :, 2:] ^ 0x80, scales, None, 8
+
+        if self.tensor_type == GGMLQuantizationType.Q4_K:
+            # Q4_K super-block of 8 sub-blocks of 32 values: d (fp16), dmin (fp16), 6-bit scales and mins (12 bytes), qs (128 bytes)
+            # with weight = q * d * scale - dmin * min. Each group of 32 bytes in qs stores 2 sub-blocks in its low and high nibbles.
+            blocks = self.data.reshape(rows, -1, 144)
+            d = blocks[:, :, 0:2].copy().view(np.float16).astype(np.float32)
+            dmin = blocks[:, :, 2:4].copy().view(np.float16).astype(np.float32)
+            packed = blocks[:, :, 4:16].astype(np.uint8)
+            sc = np.concatenate([packed[..., 0:4] & 63, (packed[..., 8:12] & 0x0F) | ((packed[..., 0:4] >> 6) << 4)], axis=-1)
+            mins = np.concatenate([packed[..., 4:8] & 63, (packed[..., 8:12] >> 4) | ((packed[..., 4:8] >> 6) << 4)], axis=-1)
+            qs = blocks[:, :, 16:].reshape(rows, -1, 4, 1, 32)
+            values = np.concatenate([qs & 0x0F, qs >> 4], axis=3).reshape(rows, -1, 32)
+            return values, (d * sc).reshape(rows, -1), (-dmin * mins).reshape(rows, -1), 4
+
+        return None
+
+
 class GGUFAttention:
     def __init__(self):
         self.q_proj = GGUFTensorModule()
@@ -56,166 +116,109 @@ class GGUFDecoderLayer:
 
 
 class GGUFModel:
-    def __init__(self, input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size):
+    def __init__(self, input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits=False):
         # Load GGUF model and read its info
         reader = GGUFReader(input_path)
+        self.use_matmul_nbits = use_matmul_nbits
 
         self.embedding = GGUFTensorModule()
         self.final_norm = GGUFTensorModule()
         self.lm_head = GGUFTensorModule()
         self.layers = {}
-
-        layer_id = 0
-        for tensor in sorted(reader.tensors, key=lambda t: t.name):
+        self._permute_args = None
+        self._loaded = {}
+
+        # Map each tensor name to the attributes it is stored in and the shape to view it as, where
+        # fused tensors are split along their first dimension into (attribute, start, end) parts
+        q_size = num_attn_heads * head_size
+        kv_size = num_kv_heads * head_size
+        model_names = {
+            "token_embd.weight": ("embedding.weight", [vocab_size, hidden_size]),
+            "output_norm.weight": ("final_norm.weight", None),
+            "output_norm.bias": ("final_norm.bias", None),
+            "output.weight": ("lm_head.weight", [vocab_size, hidden_size]),
+            "output.bias": ("lm_head.bias", None),
+        }
+        # Graph order is attn_norm --> attn_q/k/v --> attn_output --> ffn_norm --> ffn_gate/up --> >ffn_down
+        layer_names = {
+            "attn_norm.weight": ("input_layernorm.weight", None),
+            "attn_norm.bias": ("input_layernorm.bias", None),
+            "attn_q.weight": ("self_attn.q_proj.weight", [q_size, hidden_size]),
+            "attn_q.bias": ("self_attn.q_proj.bias", None),
+            "attn_k.weight": ("self_attn.k_proj.weight", [kv_size, hidden_size]),
+            "attn_k.bias": ("self_attn.k_proj.bias", None),
+            "attn_v.weight": ("self_attn.v_proj.weight", [kv_size, hidden_size]),
+            "attn_v.bias": ("self_attn.v_proj.bias", None),
+            "attn_output.weight": ("self_attn.o_proj.weight", [hidden_size, q_size]),
+            "attn_output.bias": ("self_attn.o_proj.bias", None),
+            "ffn_norm.weight": ("post_attention_layernorm.weight", None),
+            "ffn_norm.bias": ("post_attention_layernorm.bias", None),
+            "ffn_gate.weight": ("mlp.gate_proj.weight", [intermediate_size, hidden_size]),
+            "ffn_gate.bias": ("mlp.gate_proj.bias", None),
+            "ffn_up.weight": ("mlp.up_proj.weight", [intermediate_size, hidden_size]),
+            "ffn_up.bias": ("mlp.up_proj.bias", None),
+            "ffn_down.weight": ("mlp.down_proj.weight", [hidden_size, intermediate_size]),
+            "ffn_down.bias": ("mlp.down_proj.bias", None),
+            # Fused layers
+            "attn_qkv.weight": ([("self_attn.q_proj.weight", 0, q_size), ("self_attn.k_proj.weight", q_size, q_size + kv_size), ("self_attn.v_proj.weight", q_size + kv_size, None)], [q_size + kv_size + kv_size, hidden_size]),
+            "attn_qkv.bias": ([("self_attn.q_proj.bias", 0, q_size), ("self_attn.k_proj.bias", q_size, q_size + kv_size), ("self_attn.v_proj.bias", q_size + kv_size, None)], None),
+            "ffn_gate_up.weight": ([("mlp.gate_proj.weight", 0, intermediate_size), ("mlp.up_proj.weight", intermediate_size, None)], None),
+            "ffn_gate_up.bias": ([("mlp.gate_proj.bias", 0, intermediate_size), ("mlp.up_proj.bias", intermediate_size, None)], None),
+            # Non-standard attribute names
+            #
+            # Note: The meaning of 'post_attention_norm' differs in Hugging Face vs GGUF.
+            # Hugging Face labels this as the 'pre_feedforward_layernorm' since there is already a 'post_attention_layernorm'.
+            # GGUF labels this as the 'post_attention_norm' since the first norm after attention is named as 'ffn_norm'.
+            "post_attention_norm.weight": ("pre_feedforward_layernorm.weight", None),
+            "post_attention_norm.bias": ("pre_feedforward_layernorm.bias", None),
+            # Note: The meaning of 'post_ffw_norm' differs in Hugging Face vs GGUF.
+            # Hugging Face labels this as the 'input_layernorm' since it is the start of a layer.
+            # GGUF labels this as the 'post_ffw_norm' since the first norm to start a layer is named as 'attn_norm'.
+            "post_ffw_norm.weight": ("post_feedforward_layernorm.weight", None),
+            "post_ffw_norm.bias": ("post_feedforward_layernorm.bias", None),
+        }
+
+        for tensor in reader.tensors:
             name = tensor.name
-            data = torch.tensor(tensor.data)
-            module = self.layers.setdefault(layer_id, GGUFDecoderLayer(layer_id))
-
-            if name == "token_embd.weight":
-                # Remove tensor data's padding via `reduce` when GGUF model's vocab size is larger than the config's vocab size
-                embedding_shape = [vocab_size, hidden_size]
-                self.embedding.weight = data[ : reduce(lambda x, y: x*y, embedding_shape)].reshape(embedding_shape)
-            elif name == "output_norm.weight":
-                self.final_norm.weight = data
-            elif name == "output_norm.bias":
-                self.final_norm.bias = data
-            elif name == "output.weight":
-                lm_head_shape = [vocab_size, hidden_size]
-                self.lm_head.weight = data.reshape(lm_head_shape)
-            elif name == "output.bias":
-                self.lm_head.bias = data
-            elif name in {"rope_freqs.weight", "rope_factors_short.weight", "rope_factors_long.weight"}:
+            if name in {"rope_freqs.weight", "rope_factors_short.weight", "rope_factors_long.weight"}:
                 # Skip rotary embedding weights since they can be re-calculated when looping through the model
                 continue
+
+            if tensor.tensor_type in {GGMLQuantizationType.F32, GGMLQuantizationType.F16}:
+                # View the memory-mapped data instead of copying it. The weights are never modified in place,
+                # so the warning about the data being read-only does not apply.
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", UserWarning)
+                    data = torch.from_numpy(tensor.data)
             else:
-                curr_layer_id = int(name.split(".")[1])
-                if curr_layer_id != layer_id:
-                    # Switch layer module used
-                    layer_id = curr_layer_id
-                    module = self.layers.setdefault(layer_id, GGUFDecoderLayer(layer_id))
-
-                # Map weights and biases of norm, attention, and feed-forward network
-                # Graph order is attn_norm --> attn_q/k/v --> attn_output --> ffn_norm --> ffn_gate/up --> >ffn_down
-                if bool(re.match(r"^blk\.\d+\.attn_norm\.weight$", name)):
-                    # blk.layer_id.attn_norm.weight
-                    module.input_layernorm.weight = data
-                elif bool(re.match(r"^blk\.\d+\.attn_norm\.bias$", name)):
-                    # blk.layer_id.attn_norm.bias
-                    module.input_layernorm.bias = data
-                elif bool(re.match(r"^blk\.\d+\.attn_q\.weight$", name)):
-                    # blk.layer_id.attn_q.weight
-                    q_shape = [head_size * num_attn_heads, hidden_size]
-                    module.self_attn.q_proj.weight = data.reshape(q_shape)
-                elif bool(re.match(r"^blk\.\d+\.attn_q\.bias$", name)):
-                    # blk.layer_id.attn_q.bias
-                    module.self_attn.q_proj.bias = data
-                elif bool(re.match(r"^blk\.\d+\.attn_k\.weight$", name)):
-                    # blk.layer_id.attn_k.weight
-                    k_shape = [head_size * num_kv_heads, hidden_size]
-                    module.self_attn.k_proj.weight = data.reshape(k_shape)
-                elif bool(re.match(r"^blk\.\d+\.attn_k\.bias$", name)):
-                    # blk.layer_id.attn_k.bias
-                    module.self_attn.k_proj.bias = data
-                elif bool(re.match(r"^blk\.\d+\.attn_v\.weight$", name)):
-                    # blk.layer_id.attn_v.weight
-                    v_shape = [head_size * num_kv_heads, hidden_size]
-                    module.self_attn.v_proj.weight = data.reshape(v_shape)
-                elif bool(re.match(r"^blk\.\d+\.attn_v\.bias$", name)):
-                    # blk.layer_id.attn_v.bias
-                    module.self_attn.v_proj.bias = data
-                elif bool(re.match(r"^blk\.\d+\.attn_output\.weight$", name)):
-                    # blk.layer_id.attn_output.weight
-                    o_shape = [hidden_size, head_size * num_attn_heads]
-                    module.self_attn.o_proj.weight = data.reshape(o_shape)
-                elif bool(re.match(r"^blk\.\d+\.attn_output\.bias$", name)):
-                    # blk.layer_id.attn_output.bias
-                    module.self_attn.o_proj.bias = data
-                elif bool(re.match(r"^blk\.\d+\.ffn_norm\.weight$", name)):
-                    # blk.layer_id.ffn_norm.weight
-                    module.post_attention_layernorm.weight = data
-                elif bool(re.match(r"^blk\.\d+\.ffn_norm\.bias$", name)):
-                    # blk.layer_id.ffn_norm.bias
-                    module.post_attention_layernorm.bias = data
-                elif bool(re.match(r"^blk\.\d+\.ffn_gate\.weight$", name)):
-                    # blk.layer_id.ffn_gate.weight
-                    gate_shape = [intermediate_size, hidden_size]
-                    module.mlp.gate_proj.weight = data.reshape(gate_shape)
-                elif bool(re.match(r"^blk\.\d+\.ffn_gate\.bias$", name)):
-                    # blk.layer_id.ffn_gate.bias
-                    module.mlp.gate_proj.bias = data
-                elif bool(re.match(r"^blk\.\d+\.ffn_up\.weight$", name)) and data.shape[0] == intermediate_size:
-                    # blk.layer_id.ffn_up.weight
-                    up_shape = [intermediate_size, hidden_size]
-                    module.mlp.up_proj.weight = data.reshape(up_shape)
-                elif bool(re.match(r"^blk\.\d+\.ffn_up\.bias$", name)) and data.shape[0] == intermediate_size:
-                    # blk.layer_id.ffn_up.bias
-                    module.mlp.up_proj.bias = data
-                elif bool(re.match(r"^blk\.\d+\.ffn_down\.weight$", name)):
-                    # blk.layer_id.ffn_down.weight
-                    down_shape = [hidden_size, intermediate_size]
-                    module.mlp.down_proj.weight = data.reshape(down_shape)
-                elif bool(re.match(r"^blk\.\d+\.ffn_down\.bias$", name)):
-                    # blk.layer_id.ffn_down.bias
-                    module.mlp.down_proj.bias = data
-                # Match against fused layers
-                elif bool(re.match(r"^blk\.\d+\.attn_qkv\.weight$", name)):
-                    # blk.layer_id.attn_qkv.weight
-                    q_size = num_attn_heads * head_size
-                    kv_size = num_kv_heads * head_size
-                    qkv_shape = [q_size + kv_size + kv_size, hidden_size]
-                    qkv = data.reshape(qkv_shape)
-
-                    module.self_attn.q_proj.weight = qkv[: q_size, :]
-                    module.self_attn.k_proj.weight = qkv[q_size : q_size + kv_size, :]
-                    module.self_attn.v_proj.weight = qkv[q_size + kv_size :, :]
-                elif bool(re.match(r"^blk\.\d+\.attn_qkv\.bias$", name)):
-                    # blk.layer_id.attn_qkv.bias
-                    q_size = num_attn_heads * head_size
-                    kv_size = num_kv_heads * head_size
-
-                    module.self_attn.q_proj.bias = data[: q_size]
-                    module.self_attn.k_proj.bias = data[q_size : q_size + kv_size]
-                    module.self_attn.v_proj.bias = data[q_size + kv_size :]
-                elif bool(re.match(r"^blk\.\d+\.ffn_up\.weight$", name)) and data.shape[0] != intermediate_size:
-                    # blk.layer_id.ffn_up.weight (gate_up_proj.weight)
-                    module.mlp.gate_proj.weight = data[: intermediate_size, :]
-                    module.mlp.up_proj.weight = data[intermediate_size :, :]
-                elif bool(re.match(r"^blk\.\d+\.ffn_up\.bias$", name)) and data.shape[0] != intermediate_size:
-                    # blk.layer_id.ffn_up.bias (gate_up_proj.bias)
-                    module.mlp.gate_proj.bias = data[: intermediate_size]
-                    module.mlp.up_proj.bias = data[intermediate_size :]
-                # Match against non-standard attribute names
-                elif bool(re.match(r"^blk\.\d+\.post_attention_norm\.weight$", name)):
-                    # Note: This meaning of this name differs in Hugging Face vs GGUF.
-                    # Hugging Face labels this as the 'pre_feedforward_layernorm' since there is already a 'post_attention_layernorm'.
-                    # GGUF labels this as the 'post_attention_norm' since the first norm after attention is named as 'ffn_norm'.
-
-                    # blk.layer_id.post_attention_norm.weight
-                    module.pre_feedforward_layernorm.weight = data
-                elif bool(re.match(r"^blk\.\d+\.post_attention_norm\.bias$", name)):
-                    # Note: This meaning of this name differs in Hugging Face vs GGUF.
-                    # Hugging Face labels this as the 'pre_feedforward_layernorm' since there is already a 'post_attention_layernorm'.
-                    # GGUF labels this as the 'post_attention_norm' since the first norm after attention is named as 'ffn_norm'.
-
-                    # blk.layer_id.post_attention_norm.bias
-                    module.pre_feedforward_layernorm.bias = data
-                elif bool(re.match(r"^blk\.\d+\.post_ffw_norm\.weight$", name)):
-                    # Note: This meaning of this name differs in Hugging Face vs GGUF.
-                    # Hugging Face labels this as the 'input_layernorm' since it is the start of a layer.
-                    # GGUF labels this as the 'post_ffw_norm' since the first norm to start a layer is named as 'attn_norm'.
-
-                    # blk.layer_id.post_ffw_norm.weight
-                    module.post_feedforward_layernorm.weight = data
-                elif bool(re.match(r"^blk\.\d+\.post_ffw_norm\.bias$", name)):
-                    # Note: This meaning of this name differs in Hugging Face vs GGUF.
-                    # Hugging Face labels this as the 'input_layernorm' since it is the start of a layer.
-                    # GGUF labels this as the 'post_ffw_norm' since the first norm to start a layer is named as 'attn_norm'.
-
-                    # blk.layer_id.post_ffw_norm.bias
-                    module.post_feedforward_layernorm.bias = data
-                else:
+                # Keep block-quantized data as is until the module that uses it is loaded
+                data = GGUFQuantizedTensor(tensor.data, tensor.tensor_type, list(reversed(tensor.shape.tolist())))
+
+            if name in model_names:
+                module, (attrs, shape) = self, model_names[name]
+            else:
+                prefix, layer_id, suffix = name.split(".", 2)
+                if prefix != "blk" or suffix not in layer_names:
                     raise NotImplementedError(f"{name} in your GGUF model is not recognized")
-        
+                if suffix in {"ffn_up.weight", "ffn_up.bias"} and data.shape[0] != intermediate_size:
+                    # blk.layer_id.ffn_up.weight/bias stores gate_up_proj.weight/bias when it is fused
+                    suffix = suffix.replace("ffn_up", "ffn_gate_up")
+                module = self.layers.setdefault(int(layer_id), GGUFDecoderLayer(int(layer_id)))
+                attrs, shape = layer_names[suffix]
+
+            if shape is not None:
+                # Remove tensor data's padding when the GGUF model's vocab size is larger than the config's vocab size
+                if isinstance(data, GGUFQuantizedTensor):
+                    data = data[: shape[0]]
+                else:
+                    data = data.reshape(-1)[: reduce(lambda x, y: x*y, shape)].reshape(shape)
+            if isinstance(attrs, str):
+                attrs = [(attrs, None, None)]
+            for attr, start, end in attrs:
+                submodule_name, weight_name = attr.rsplit(".", 1)
+                submodule = reduce(getattr, submodule_name.split("."), module)
+                setattr(submodule, weight_name, data[start : end])
+
         # Set LM head weights + biases if not already set
         if self.lm_head.weight is None:
             # Embedding and LM head share same weights + biases (lm_head.weight == embedding.weight and lm_head.bias == embedding.bias)
@@ -229,21 +232,99 @@ class GGUFModel:
 
     def modules(self):
         """
-        Return list of modules in GGUF model in order of appearance in the model
+        Yield modules in GGUF model in order of appearance in the model
+
+        Each module is loaded when it is yielded and released when the next module is requested
         """
-        return [self.embedding] + self.layers + [self.final_norm, self.lm_head]
+        for module in [self.embedding] + self.layers + [self.final_norm, self.lm_head]:
+            self.load_module(module)
+            yield module
+            self.release_module(module)
+
+    def load_module(self, module):
+        """
+        Create the weights of a module that cannot be views of the GGUF file
+        """
+        if id(module) in self._loaded:
+            return
+
+        if isinstance(module, GGUFDecoderLayer):
+            attention, mlp = module.self_attn, module.mlp
+            tensor_modules = list(attention.__dict__.values()) + list(mlp.__dict__.values())
+            tensor_modules += [value for value in module.__dict__.values() if isinstance(value, GGUFTensorModule)]
+        else:
+            attention, tensor_modules = None, [module]
+        self._loaded[id(module)] = [(tensor_module, dict(tensor_module.__dict__)) for tensor_module in tensor_modules]
+
+        if attention is not None and self._permute_args is not None:
+            head_size, hidden_size, num_attn_heads, num_kv_heads = self._permute_args
+            attention.q_proj.weight = self.undo_permute_rows(attention.q_proj.weight, num_attn_heads)
+            attention.k_proj.weight = self.undo_permute_rows(attention.k_proj.weight, num_kv_heads)
+
+        # Q/K/V can be packed into one `MatMulNBits`, so only keep them quantized if they share the same format
+        qkv_types = {getattr(matmul.weight, "tensor_type", None) for matmul in [attention.q_proj, attention.k_proj, attention.v_proj]} if attention is not None else set()
+        for tensor_module in tensor_modules:
+            if isinstance(tensor_module.weight, GGUFQuantizedTensor):
+                use_matmul_nbits = module is not self.embedding and not (attention is not None and tensor_module in [attention.q_proj, attention.k_proj, attention.v_proj] and len(qkv_types) > 1)
+                self.load_quantized_weight(tensor_module, use_matmul_nbits)
+
+    def load_quantized_weight(self, module, use_matmul_nbits):
+        """
+        Convert the block-quantized weight of a `GGUFTensorModule` to `MatMulNBits` weights if the block layout
+        is compatible, or dequantize it otherwise
+        """
+        unpacked = module.weight.unpack() if self.use_matmul_nbits and use_matmul_nbits else None
+        if unpacked is None:
+            module.weight = module.weight.dequantize()
+            return
+
+        values, scales, offsets, bits = unpacked
+        out_features, in_features = module.weight.shape
+        qzeros = None
+        if offsets is not None:
+            # Write weight = q * scale + offset as weight = (q - zero point) * scale with a float zero point.
+            # Blocks with a scale of 0 are constant, so they are stored as q = 0, scale = 1, and zero point = -offset.
+            constant = scales == 0
+            values = np.where(constant[..., None], 0, values).astype(np.uint8)
+            scales = np.where(constant, 1, scales)
+            qzeros = torch.from_numpy(-offsets / scales).reshape(-1)
+
+        if bits == 4:
+            values = values[..., 0::2] | (values[..., 1::2] << 4)
+
+        module.qweight = torch.from_numpy(np.ascontiguousarray(values))
+        module.scales = torch.from_numpy(scales).reshape(-1)
+        module.qzeros = qzeros
+        module.g_idx = None
+        module.bits = bits
+        module.group_size = 32
+        module.in_features = in_features
+        module.out_features = out_features
+
+    def release_module(self, module):
+        """
+        Release the weights created by `load_module` by restoring the views of the GGUF file
+        """
+        for tensor_module, state in self._loaded.pop(id(module), []):
+            tensor_module.__dict__.clear()
+            tensor_module.__dict__.update(state)
+
+    def undo_permute_rows(self, weight, num_heads):
+        """
+        Undo `permute` operation by GGUF on the rows of a Q or K weight
+        """
+        rows = weight.shape[0]
+        order = torch.arange(rows).reshape(num_heads, rows // num_heads // 2, 2).swapaxes(1, 2).reshape(rows)
+        return weight[order.numpy()] if isinstance(weight, GGUFQuantizedTensor) else weight[order]
 
     def undo_permute(self, head_size, hidden_size, num_attn_heads, num_kv_heads):
         """
         Undo `permute` operation by GGUF to get Hugging Face format
         For GGUF models that contain a `permute()` call in `convert_hf_to_gguf.py` (e.g. Granite, LLaMA, Mistral, OLMo)
-        """
-        for module in self.layers:
-            q_shape = [head_size * num_attn_heads, hidden_size]
-            module.self_attn.q_proj.weight = module.self_attn.q_proj.weight.flatten().reshape(num_attn_heads, q_shape[0] // num_attn_heads // 2, 2, *q_shape[1:]).swapaxes(1, 2).reshape(q_shape)
 
-            k_shape = [head_size * num_kv_heads, hidden_size]
-            module.self_attn.k_proj.weight = module.self_attn.k_proj.weight.flatten().reshape(num_kv_heads, k_shape[0] // num_kv_heads // 2, 2, *k_shape[1:]).swapaxes(1, 2).reshape(k_shape)
+        Each decoder layer is un-permuted in `load_module` so that its weights are only copied when they are used
+        """
+        self._permute_args = (head_size, hidden_size, num_attn_heads, num_kv_heads)
 
     def swap_mlp_types(self):
         """
@@ -276,40 +357,43 @@ class GGUFModel:
             module.post_attention_layernorm, module.pre_feedforward_layernorm = module.pre_feedforward_layernorm, module.post_attention_layernorm
 
     @staticmethod
-    def from_pretrained(model_type, input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size):
+    def from_pretrained(model_type, input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits=False):
         """
         Create GGUF models with the same attribute structures as Hugging Face's PyTorch models.
         Also performs any pre-processing and post-processing to the GGUF models to ensure the
         weights are the same as the PyTorch models.
+
+        If `use_matmul_nbits` is true, Q4_0, Q4_1, Q4_K, and Q8_0 weights are converted directly to `MatMulNBits` weights.
+        All other block-quantized weights are dequantized.
         """
         if model_type == "ChatGLMModel":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
         elif model_type == "GemmaForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
         elif model_type == "Gemma2ForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
             model.swap_norm_types()
         elif model_type == "GraniteForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
             model.undo_permute(head_size, hidden_size, num_attn_heads, num_kv_heads)
         elif model_type == "LlamaForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
             model.undo_permute(head_size, hidden_size, num_attn_heads, num_kv_heads)
         elif model_type == "MistralForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
             model.undo_permute(head_size, hidden_size, num_attn_heads, num_kv_heads)
         elif model_type == "NemotronForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
         elif model_type == "OlmoForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
             model.undo_permute(head_size, hidden_size, num_attn_heads, num_kv_heads)
         elif model_type == "PhiForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
             model.swap_mlp_types()
         elif model_type == "Phi3ForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
         elif model_type == "Qwen2ForCausalLM":
-            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size)
+            model = GGUFModel(input_path, head_size, hidden_size, intermediate_size, num_attn_heads, num_kv_heads, vocab_size, use_matmul_nbits)
         else:
             raise NotImplementedError(f"The {model_type} model is not currently supported.")
 
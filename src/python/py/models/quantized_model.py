@@ -13,13 +13,59 @@ so that the original Hugging Face --> ONNX code can store the quantized weights
 ONNX Runtime's format no matter where the quantized weights actually come from.
 """
 
-from safetensors.torch import load_file
+from safetensors import safe_open
 import torch
 
+import contextlib
 import os
 import re
 
 
+class LazySafetensor:
+    """
+    Handle to a tensor (or a slice of it) in a safetensors file that is only read when it is materialized
+    """
+    def __init__(self, handle, name, shape, ranges=None, squeezed=()):
+        self.handle = handle
+        self.name = name
+        self.shape = torch.Size(shape)
+        self.ranges = ranges      # Range of each dimension of the stored tensor that is read, or None to read all of it
+        self.squeezed = squeezed  # Dimensions of the stored tensor indexed with an integer, which are dropped once read
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) > len(self.shape) or not all(isinstance(k, slice) or (isinstance(k, int) and not isinstance(k, bool)) for k in key):
+            # Read the data for anything other than integers and slices
+            return self.materialize()[key]
+
+        # Apply the key to the ranges of the dimensions that are left and compute the shape without reading any data
+        ranges = list(self.ranges) if self.ranges is not None else [range(dim) for dim in self.shape]
+        squeezed = list(self.squeezed)
+        dims = [dim for dim in range(len(ranges)) if dim not in squeezed]
+        for k, dim in zip(key, dims):
+            if isinstance(k, slice):
+                ranges[dim] = ranges[dim][k]
+            else:
+                index = ranges[dim][k]
+                ranges[dim] = range(index, index + 1)
+                squeezed.append(dim)
+            if len(ranges[dim]) <= 1:
+                ranges[dim] = range(ranges[dim].start, ranges[dim].start + len(ranges[dim]))
+            elif ranges[dim].step != 1:
+                # safetensors only reads contiguous ranges
+                return self.materialize()[key]
+
+        shape = [len(r) for dim, r in enumerate(ranges) if dim not in squeezed]
+        return LazySafetensor(self.handle, self.name, shape, ranges, tuple(squeezed))
+
+    def materialize(self):
+        # The file is memory-mapped, so only the bytes of this tensor (or slice) are read
+        if self.ranges is None:
+            return self.handle.get_tensor(self.name)
+        tensor = self.handle.get_slice(self.name)[tuple(slice(r.start, r.stop) for r in self.ranges)]
+        return tensor.reshape(self.shape).contiguous()
+
+
 class QuantizedTensorModule:
     def __init__(self, bits, group_size):
         self.qweight = None
@@ -92,6 +138,9 @@ class QuantizedDecoderLayer:
 
 
 class QuantizedModel:
+    # Number of rows to unpack or repack at once to bound the size of temporary tensors
+    chunk_size = 4096
+
     def __init__(self, quant_type, input_path, quant_attrs, q_size, kv_size, intermediate_size, num_layers):
         self.quant_type = quant_type
         self.embedding = TensorModule()
@@ -102,12 +151,17 @@ class QuantizedModel:
         self._quant_attrs = quant_attrs
         self._load_quant_config(quant_attrs)  # codeql[py/init-calls-subclass]
 
-        for weight_file in os.listdir(input_path):
+        # Keep a memory-mapped handle to each weight file and only read each tensor's header for now. The handles are
+        # closed by `close` once the model is built
+        self._handles = contextlib.ExitStack()
+        self._loaded = {}
+        for weight_file in sorted(os.listdir(input_path)):
             if weight_file.endswith(".safetensors"):
-                weights = load_file(os.path.join(input_path, weight_file))
+                handle = self._handles.enter_context(safe_open(os.path.join(input_path, weight_file), framework="pt"))
+                weights = ((name, LazySafetensor(handle, name, handle.get_slice(name).get_shape())) for name in handle.keys())
 
                 # Map weights to modules
-                for name, tensor in weights.items():
+                for name, tensor in weights:
 
                     # Per-layer quantization support
                     local_bits = self.get_layer_bits(name)  # codeql[py/init-calls-subclass]
@@ -508,9 +562,77 @@ class QuantizedModel:
 
     def modules(self):
         """
-        Return list of modules in quantized model in order of appearance in the model
+        Yield modules in quantized model in order of appearance in the model
+
+        Each module's weights are read when it is yielded and released when the next module is requested
+        """
+        for module in [self.embedding] + self.layers + [self.final_norm, self.lm_head]:
+            if isinstance(module, QuantizedDecoderLayer) and module.layer_id >= self.num_layers:
+                yield module
+                continue
+
+            self.load_module(module)
+            yield module
+            self.release_module(module)
+
+    def load_module(self, module):
+        """
+        Read the weights of a module and repack its `QuantizedTensorModule` classes to ORT format
         """
-        return [self.embedding] + self.layers + [self.final_norm, self.lm_head]
+        if id(module) in self._loaded:
+            return
+
+        saved = []
+        def materialize(obj):
+            if not isinstance(obj, (TensorModule, QuantizedTensorModule, QuantizedAttention, QuantizedMLP, QuantizedDecoderLayer)):
+                return
+            saved.append((obj, dict(obj.__dict__)))
+            for key, value in obj.__dict__.items():
+                if isinstance(value, LazySafetensor):
+                    obj.__dict__[key] = value.materialize()
+                else:
+                    materialize(value)
+        materialize(module)
+
+        if isinstance(module, QuantizedDecoderLayer):
+            self.repack_layer(module)
+        elif isinstance(module, QuantizedTensorModule) and module.qweight is not None:
+            self.repack_tensor_module(module)
+        self._loaded[id(module)] = saved
+
+    def release_module(self, module):
+        """
+        Release the weights read by `load_module` by restoring the lazy handles
+        """
+        for obj, state in self._loaded.pop(id(module), []):
+            obj.__dict__.clear()
+            obj.__dict__.update(state)
+
+    def close(self):
+        """
+        Close the weight files, the weights can't be loaded after this
+        """
+        self._loaded.clear()
+        self._handles.close()
+
+    def repack_layer(self, layer):
+        """
+        Unpack and repack all `QuantizedTensorModule` classes in a decoder layer
+        """
+        self_attn = getattr(layer, "self_attn", None) or getattr(layer, "self_attention", None)
+        for q_tensors in list(self_attn.__dict__.values()) + list(layer.mlp.__dict__.values()):
+            if isinstance(q_tensors, QuantizedTensorModule) and q_tensors.qweight is not None:
+                self.repack_tensor_module(q_tensors)
+
+    def repack_tensor_module(self, module):
+        """
+        Unpack and repack a `QuantizedTensorModule` to ORT format
+        """
+        self.unpack(module)
+        self.repack(module)
+
+        # Set `g_idx` to None since it's not used in `MatMulNBits`
+        module.g_idx = None
 
     def unpack(self, module):
         """
@@ -518,15 +640,26 @@ class QuantizedModel:
         """
         self.unpack_qzeros(module)
         self.unpack_qweight(module)
-        self.dequant_weight(module)
+        if not self.has_trivial_g_idx(module):
+            self.dequant_weight(module)
 
     def repack(self, module):
         """
         Repack `scales`, `qzeros` and `qweight` to ORT format
         """
-        intweight = self.quant_weight(module)
+        # When `g_idx` is trivial, de-quantizing and re-quantizing returns the unpacked `qweight` as is
+        intweight = module.qweight if self.has_trivial_g_idx(module) else self.quant_weight(module)
         self.pack_ort_format(module, intweight)
 
+    def has_trivial_g_idx(self, module):
+        """
+        Check if `g_idx` assigns each row to its group in order (i.e. rows are not re-ordered by act-order)
+        """
+        if module.g_idx is None:
+            return True
+        trivial_g_idx = torch.arange(module.g_idx.shape[0], dtype=torch.int32) // module.group_size
+        return torch.equal(module.g_idx.to(torch.int32), trivial_g_idx)
+
     def unpack_qzeros(self, module):
         """
         Unpack `qzeros` to standard format
@@ -558,10 +691,16 @@ class QuantizedModel:
         Perform general-purpose unpacking on 2-bit, 4-bit, or 8-bit tensor
         """
         pack_tensor = tensor.T if transpose else tensor
-        wf = torch.arange(0, 32, bits, device=pack_tensor.device).unsqueeze(0).unsqueeze(0)
-        out = torch.bitwise_right_shift(torch.unsqueeze(pack_tensor, 2), wf)
-        out = out.reshape(pack_tensor.shape[0], -1)
-        out = torch.bitwise_and(out, (2 ** bits) - 1)
+        values_per_int = 32 // bits
+        mask = (2 ** bits) - 1
+
+        # Unpack into uint8 in row chunks so that no full-size int32 intermediates are created
+        out = torch.empty(pack_tensor.shape[0], pack_tensor.shape[1] * values_per_int, dtype=torch.uint8, device=pack_tensor.device)
+        for start in range(0, pack_tensor.shape[0], self.chunk_size):
+            chunk = pack_tensor[start : start + self.chunk_size].to(torch.int32)
+            out_chunk = out[start : start + self.chunk_size].view(chunk.shape[0], chunk.shape[1], values_per_int)
+            for i in range(values_per_int):
+                out_chunk[:, :, i] = torch.bitwise_and(torch.bitwise_right_shift(chunk, bits * i), mask)
         return out.T if transpose else out
 
     def unpack_on_row(self, tensor, bits, transpose):
@@ -578,13 +717,14 @@ class QuantizedModel:
         Perform general-purpose packing on 2-bit, 4-bit, or 8-bit tensor
         """
         orig_tensor = tensor.T if transpose else tensor
-        wf = torch.arange(0, bits).view(1, 1, -1)
-        out = torch.bitwise_right_shift(orig_tensor.unsqueeze(-1), wf)
-        out = torch.bitwise_and(out, 1)
-        out = out.reshape(orig_tensor.shape[0], -1, 32)
-        wf1 = torch.arange(0, 32, 1).view(1, 1, -1)
-        out = torch.bitwise_left_shift(out, wf1)
-        out = out.sum(dim=-1).int()
+        values_per_int = 32 // bits
+        mask = (2 ** bits) - 1
+
+        # Shift each value into its position and OR them together instead of expanding every value into bit planes
+        values = orig_tensor.to(torch.int32).reshape(orig_tensor.shape[0], -1, values_per_int)
+        out = torch.zeros(values.shape[:2], dtype=torch.int32, device=orig_tensor.device)
+        for i in range(values_per_int):
+            out = torch.bitwise_or(out, torch.bitwise_left_shift(torch.bitwise_and(values[:, :, i], mask), bits * i))
         return out.T if transpose else out
 
     def pack_on_row(self, tensor, bits, transpose):
@@ -655,9 +795,12 @@ class QuantizedModel:
             intzeros_pt = (intzeros_pt[:, 0::2]) | (intzeros_pt[:, 1::2] << 4)
             intzeros_pt = intzeros_pt.reshape(-1)
 
-        intweight_pt_T = intweight.T
-        intweight_pt_T = (intweight_pt_T[:, 0::2]) | (intweight_pt_T[:, 1::2] << 4)
-        intweight_pt_T = intweight_pt_T.reshape(cols, k_blocks, blob_size)
+        # Pack 2 values per byte along the input dimension in column chunks to bound the size of temporary tensors
+        intweight_pt_T = torch.empty(cols, k_blocks, blob_size, dtype=torch.uint8, device=intweight_pt.device)
+        for start in range(0, cols, self.chunk_size):
+            chunk = intweight_pt[:, start : start + self.chunk_size].T
+            chunk = (chunk[:, 0::2]) | (chunk[:, 1::2] << 4)
+            intweight_pt_T[start : start + self.chunk_size] = chunk.reshape(-1, k_blocks, blob_size)
 
         scales_pt = module.scales.T.reshape(-1)
 
@@ -670,41 +813,6 @@ class QuantizedModel:
 
 
 class AWQModel(QuantizedModel):
-    def __init__(self, quant_type, input_path, quant_attrs, q_size, kv_size, intermediate_size, num_layers):
-        super().__init__(quant_type, input_path, quant_attrs, q_size, kv_size, intermediate_size, num_layers)
-
-        # Unpack and repack all `QuantizedTensorModule` classes in model
-        for i, layer in enumerate(self.layers):
-            if i >= self.num_layers:
-                break
-            print(f"Unpacking and repacking layer {i}")
-
-            # Unpack and repack all `QuantizedTensorModule` classes in attention
-            self_attn = getattr(layer, "self_attn", None) or getattr(layer, "self_attention", None)
-            for _, q_tensors in self_attn.__dict__.items():
-                if isinstance(q_tensors, QuantizedTensorModule) and q_tensors.qweight is not None:
-                    self.unpack(q_tensors)
-                    self.repack(q_tensors)
-
-                    # Set `g_idx` to None since it's not used in `MatMulNBits`
-                    q_tensors.g_idx = None
-
-            # Unpack and repack all `QuantizedTensorModule` classes in MLP
-            for _, q_tensors in layer.mlp.__dict__.items():
-                if isinstance(q_tensors, QuantizedTensorModule) and q_tensors.qweight is not None:
-                    self.unpack(q_tensors)
-                    self.repack(q_tensors)
-
-                    # Set `g_idx` to None since it's not used in `MatMulNBits`
-                    q_tensors.g_idx = None
-
-        if isinstance(self.lm_head, QuantizedTensorModule) and self.lm_head.qweight is not None:
-            self.unpack(self.lm_head)
-            self.repack(self.lm_head)
-
-            # Set `g_idx` to None since it's not used in `MatMulNBits`
-            self.lm_head.g_idx = None
-
     def unpack_qweight(self, module):
         """
         Unpack `qweight` to standard format
@@ -745,45 +853,17 @@ class AWQModel(QuantizedModel):
 
 
 class GPTQModel(QuantizedModel):
-    def __init__(self, quant_type, input_path, quant_attrs, q_size, kv_size, intermediate_size, num_layers):
-        super().__init__(quant_type, input_path, quant_attrs, q_size, kv_size, intermediate_size, num_layers)
-
-        # Unpack and repack all `QuantizedTensorModule` classes in model
-        for i, layer in enumerate(self.layers):
-            if i >= self.num_layers:
-                break
-            print(f"Unpacking and repacking layer {i}")
-
-            # Unpack and repack all `QuantizedTensorModule` classes in attention
-            for _, q_tensors in layer.self_attn.__dict__.items():
-                if isinstance(q_tensors, QuantizedTensorModule) and q_tensors.qweight is not None:
-                    self.handle_qzeros(q_tensors)
-                    self.unpack(q_tensors)
-                    self.repack(q_tensors)
-
-                    if not quant_attrs["use_g_idx"]:
-                        # Set `g_idx` to None since it's not used in `MatMulNBits`
-                        q_tensors.g_idx = None
-
-            # Unpack and repack all `QuantizedTensorModule` classes in MLP
-            for _, q_tensors in layer.mlp.__dict__.items():
-                if isinstance(q_tensors, QuantizedTensorModule) and q_tensors.qweight is not None:
-                    self.handle_qzeros(q_tensors)
-                    self.unpack(q_tensors)
-                    self.repack(q_tensors)
-
-                    if not quant_attrs["use_g_idx"]:
-                        # Set `g_idx` to None since it's not used in `MatMulNBits`
-                        q_tensors.g_idx = None
-
-        if isinstance(self.lm_head, QuantizedTensorModule) and self.lm_head.qweight is not None:
-            self.handle_qzeros(self.lm_head)
-            self.unpack(self.lm_head)
-            self.repack(self.lm_head)
-
-            if not quant_attrs["use_g_idx"]:
-                # Set `g_idx` to None since it's not used in `MatMulNBits`
-                self.lm_head.g_idx = None
+    def repack_tensor_module(self, module):
+        """
+        Unpack and repack a `QuantizedTensorModule` to ORT format
+        """
+        self.handle_qzeros(module)
+        self.unpack(module)
+        self.repack(module)
+
+        if not self._quant_attrs["use_g_idx"]:
+            # Set `g_idx` to None since it's not used in `MatMulNBits`
+            module.g_idx = None
 
     def handle_qzeros(self, module):
         """
@@ -810,40 +890,6 @@ class GPTQModel(QuantizedModel):
         module.qzeros = temp_module.qzeros
 
 class QuarkModel(QuantizedModel):
-    def __init__(self, quant_type, input_path, quant_attrs, q_size, kv_size, intermediate_size, num_layers):
-        super().__init__(quant_type, input_path, quant_attrs, q_size, kv_size, intermediate_size, num_layers)
-
-        # Unpack and repack all `QuantizedTensorModule` classes in model
-        for i, layer in enumerate(self.layers):
-            if i >= self.num_layers:
-                break
-
-            # Unpack and repack all `QuantizedTensorModule` classes in attention
-            self_attn = getattr(layer, "self_attn", None) or getattr(layer, "self_attention", None)
-            for _, q_tensors in self_attn.__dict__.items():
-                if isinstance(q_tensors, QuantizedTensorModule) and q_tensors.qweight is not None:
-                    self.unpack(q_tensors)
-                    self.repack(q_tensors)
-
-                    # Set `g_idx` to None since it's not used in `MatMulNBits`
-                    q_tensors.g_idx = None
-
-            # Unpack and repack all `QuantizedTensorModule` classes in MLP
-            for _, q_tensors in layer.mlp.__dict__.items():
-                if isinstance(q_tensors, QuantizedTensorModule) and q_tensors.qweight is not None:
-                    self.unpack(q_tensors)
-                    self.repack(q_tensors)
-
-                    # Set `g_idx` to None since it's not used in `MatMulNBits`
-                    q_tensors.g_idx = None
-
-        if isinstance(self.lm_head, QuantizedTensorModule) and self.lm_head.qweight is not None:
-            self.unpack(self.lm_head)
-            self.repack(self.lm_head)
-
-            # Set `g_idx` to None since it's not used in `MatMulNBits`
-            self.lm_head.g_idx = None
-
     def _load_quant_config(self, quant_attrs):
         self.global_quant_config = quant_attrs["config"]["global_quant_config"]["weight"]
         self.global_group_size = self.global_quant_config["group_size"]
@@ -49,6 +49,10 @@ pybind11::array_t<T> ToPython(std::span<T> v) {
   return pybind11::array_t<T>{{v.size()}, {sizeof(T)}, v.data()};
 }
 
+void MakeReadOnly(pybind11::array& v) {
+  pybind11::detail::array_proxy(v.ptr())->flags &= ~pybind11::detail::npy_api::NPY_ARRAY_WRITEABLE_;
+}
+
 ONNXTensorElementDataType ToTensorType(const pybind11::dtype& type) {
   switch (type.num()) {
     case pybind11::detail::npy_api::NPY_BOOL_:
@@ -144,7 +148,7 @@ std::unique_ptr<OgaTensor> ToOgaTensor(pybind11::array& v, bool copy = true) {
   return tensor;
 }
 
-pybind11::array ToNumpy(OgaTensor& v) {
+pybind11::array ToNumpy(OgaTensor& v, pybind11::handle base = {}) {
   auto shape = v.Shape();
   auto type = static_cast<ONNXTensorElementDataType>(v.Type());
   auto element_size = Ort::SizeOf(type);
@@ -168,7 +172,17 @@ pybind11::array ToNumpy(OgaTensor& v) {
       strides                                        // Strides (in bytes) for each index
   };
 
-  return pybind11::array{bufinfo};
+  return pybind11::array{bufinfo, base};
+}
+
+// Returns a read-only view of the tensor that takes ownership of it, so the data isn't copied again. The tensors the C API
+// returns for the logits, inputs and outputs are already copies, so the view stays the same after the generator moves on
+pybind11::array ToNumpy(std::unique_ptr<OgaTensor> v) {
+  auto& tensor = *v;
+  pybind11::capsule owner{v.release(), [](void* p) { delete reinterpret_cast<OgaTensor*>(p); }};
+  auto result = ToNumpy(tensor, owner);
+  MakeReadOnly(result);
+  return result;
 }
 
 struct PyGeneratorParams {
@@ -208,20 +222,24 @@ struct PyGenerator {
     generator_ = OgaGenerator::Create(model, *params.params_);
   }
 
+  // The next tokens and sequences live in buffers the generator updates (and swaps between beams), so they are returned
+  // as copies. They are only a few tokens long, unlike the logits.
   pybind11::array_t<int32_t> GetNextTokens() {
-    return ToPython(generator_->GetNextTokens());
+    auto tokens = generator_->GetNextTokens();
+    return pybind11::array_t<int32_t>(tokens.size(), tokens.data());
   }
 
   pybind11::array_t<int32_t> GetSequence(int index) {
-    return ToPython(generator_->GetSequence(index));
+    auto sequence = generator_->GetSequence(index);
+    return pybind11::array_t<int32_t>(sequence.size(), sequence.data());
   }
 
   pybind11::array GetInput(const std::string& name) {
-    return ToNumpy(*generator_->GetInput(name.c_str()));
+    return ToNumpy(generator_->GetInput(name.c_str()));
   }
 
   pybind11::array GetOutput(const std::string& name) {
-    return ToNumpy(*generator_->GetOutput(name.c_str()));
+    return ToNumpy(generator_->GetOutput(name.c_str()));
   }
 
   void SetModelInput(const std::string& name, pybind11::array& value) {
@@ -232,30 +250,61 @@ struct PyGenerator {
     generator_->SetInputs(named_tensors);
   }
 
+  // Running the model doesn't touch any Python objects, so the GIL is released to let other Python threads run meanwhile
   void AppendTokens(OgaTensor& tokens) {
+    pybind11::gil_scoped_release release;
     generator_->AppendTokens(ToSpan<int32_t>(tokens));
   }
 
   void AppendTokens(pybind11::array_t<int32_t>& tokens) {
-    generator_->AppendTokens(ToSpan(tokens));
+    auto tokens_span = ToSpan(tokens);  // Needs the GIL since it copies a reference to the array
+    pybind11::gil_scoped_release release;
+    generator_->AppendTokens(tokens_span);
   }
 
   pybind11::array_t<float> GetLogits() {
-    return ToNumpy(*generator_->GetLogits());
+    return ToNumpy(generator_->GetLogits());
   }
 
-  void SetLogits(pybind11::array_t<float> new_logits) {
-    generator_->SetLogits(*ToOgaTensor(new_logits, false));
+  void SetLogits(pybind11::array_t<float, pybind11::array::c_style | pybind11::array::forcecast> new_logits) {
+    // The logits are only read from, so this also accepts the read-only arrays returned by get_logits
+    std::vector<int64_t> shape(new_logits.shape(), new_logits.shape() + new_logits.ndim());
+    generator_->SetLogits(*OgaTensor::Create(const_cast<float*>(new_logits.data()), shape));
   }
 
   void GenerateNextToken() {
+    pybind11::gil_scoped_release release;
     generator_->GenerateNextToken();
   }
 
   void RewindTo(size_t new_length) {
+    pybind11::gil_scoped_release release;
     generator_->RewindTo(new_length);
   }
 
+  void SetDraftModel(const OgaModel& draft_model, int num_draft_tokens) {
+    generator_->SetDraftModel(draft_model, num_draft_tokens);
+  }
+
+  pybind11::array_t<int32_t> SpeculateNextTokens() {
+    std::span<const int32_t> tokens;
+    {
+      pybind11::gil_scoped_release release;
+      tokens = generator_->SpeculateNextTokens();
+    }
+    return pybind11::array_t<int32_t>(tokens.size(), tokens.data());
+  }
+
+  pybind11::dict GetSpeculativeStats() const {
+    size_t step_count, draft_token_count, accepted_token_count;
+    generator_->GetSpeculativeStats(step_count, draft_token_count, accepted_token_count);
+    pybind11::dict stats;
+    stats["steps"] = step_count;
+    stats["draft_tokens"] = draft_token_count;
+    stats["accepted_tokens"] = accepted_token_count;
+    return stats;
+  }
+
   bool IsDone() const {
     return generator_->IsDone();
   }
@@ -264,6 +313,8 @@ struct PyGenerator {
     generator_->SetActiveAdapter(adapters, adapter_name.c_str());
   }
 
+  operator OgaGenerator&() { return *generator_; }
+
  private:
   std::unique_ptr<OgaGenerator> generator_;
 };
@@ -363,7 +414,10 @@ PYBIND11_MODULE(onnxruntime_genai, m) {
       .def(pybind11::init([](const OgaModel& model) { return OgaTokenizer::Create(model); }))
       .def("encode", [](const OgaTokenizer& t, std::string s) -> pybind11::array_t<int32_t> {
         auto sequences = OgaSequences::Create();
-        t.Encode(s.c_str(), *sequences);
+        {
+          pybind11::gil_scoped_release release;
+          t.Encode(s.c_str(), *sequences);
+        }
         return ToPython(sequences->Get(0));
       })
       .def("to_token_id", &OgaTokenizer::ToTokenId)
@@ -373,6 +427,7 @@ PYBIND11_MODULE(onnxruntime_genai, m) {
         std::vector<const char*> c_strings;
         for (const auto& s : strings)
           c_strings.push_back(s.c_str());
+        pybind11::gil_scoped_release release;
         return t.EncodeBatch(c_strings.data(), c_strings.size()); })
       .def("decode_batch", [](const OgaTokenizer& t, const OgaTensor& tokens) {
         std::vector<std::string> strings;
@@ -419,7 +474,29 @@ PYBIND11_MODULE(onnxruntime_genai, m) {
       .def_property_readonly("type", [](const OgaModel& model) -> std::string { return model.GetType().p_; })
       .def_property_readonly(
           "device_type", [](const OgaModel& model) -> std::string { return model.GetDeviceType().p_; }, "The device type the model is running on")
-      .def("create_multimodal_processor", [](const OgaModel& model) { return OgaMultiModalProcessor::Create(model); });
+      .def("create_multimodal_processor", [](const OgaModel& model) { return OgaMultiModalProcessor::Create(model); })
+      .def("get_thread_pool_stats", [](const OgaModel& model) {
+        size_t thread_count, queued, max_queued, executed, stolen;
+        model.GetThreadPoolStats(thread_count, queued, max_queued, executed, stolen);
+        pybind11::dict stats;
+        stats["threads"] = thread_count;
+        stats["queued"] = queued;
+        stats["max_queued"] = max_queued;
+        stats["executed"] = executed;
+        stats["stolen"] = stolen;
+        return stats;
+      })
+      .def("get_kv_block_pool_stats", [](const OgaModel& model) {
+        size_t block_bytes, blocks_in_use, max_blocks_in_use, bytes_allocated, blocks_copied;
+        model.GetKeyValueBlockPoolStats(block_bytes, blocks_in_use, max_blocks_in_use, bytes_allocated, blocks_copied);
+        pybind11::dict stats;
+        stats["block_bytes"] = block_bytes;
+        stats["blocks_in_use"] = blocks_in_use;
+        stats["max_blocks_in_use"] = max_blocks_in_use;
+        stats["bytes_allocated"] = bytes_allocated;
+        stats["blocks_copied"] = blocks_copied;
+        return stats;
+      });
 
   pybind11::class_<PyGenerator>(m, "Generator")
       .def(pybind11::init<const OgaModel&, PyGeneratorParams&>())
@@ -434,10 +511,39 @@ PYBIND11_MODULE(onnxruntime_genai, m) {
       .def("set_logits", &PyGenerator::SetLogits)
       .def("generate_next_token", &PyGenerator::GenerateNextToken)
       .def("rewind_to", &PyGenerator::RewindTo)
+      .def("set_draft_model", &PyGenerator::SetDraftModel, pybind11::arg("draft_model"), pybind11::arg("num_draft_tokens") = 4)
+      .def("speculate_next_tokens", &PyGenerator::SpeculateNextTokens)
+      .def("get_speculative_stats", &PyGenerator::GetSpeculativeStats)
       .def("get_next_tokens", &PyGenerator::GetNextTokens)
       .def("get_sequence", &PyGenerator::GetSequence)
       .def("set_active_adapter", &PyGenerator::SetActiveAdapter);
 
+  pybind11::class_<OgaPrefixCache>(m, "PrefixCache")
+      .def(pybind11::init([](const OgaModel& model, size_t max_bytes) { return OgaPrefixCache::Create(model, max_bytes); }))
+      .def("add", [](OgaPrefixCache& prefix_cache, PyGenerator& generator) { prefix_cache.Add(generator); })
+      .def("append_tokens", [](OgaPrefixCache& prefix_cache, PyGenerator& generator, pybind11::array_t<int32_t> input_ids) {
+        auto input_ids_span = ToSpan(input_ids);
+        pybind11::gil_scoped_release release;
+        return prefix_cache.AppendTokens(generator, input_ids_span);
+      });
+
+  pybind11::class_<OgaEngine>(m, "Engine")
+      .def(pybind11::init([](const OgaModel& model, PyGeneratorParams& params) { return OgaEngine::Create(model, params); }))
+      .def("submit", [](OgaEngine& engine, PyGeneratorParams& params, pybind11::array_t<int32_t> input_ids) { return engine.Submit(params, ToSpan(input_ids)); })
+      .def("cancel", &OgaEngine::Cancel)
+      .def("has_pending_requests", &OgaEngine::HasPendingRequests)
+      .def("step", [](OgaEngine& engine) {
+        size_t token_count;
+        {
+          pybind11::gil_scoped_release release;
+          token_count = engine.Step();
+        }
+        std::vector<std::tuple<int64_t, int32_t, bool>> tokens(token_count);
+        for (size_t i = 0; i < token_count; i++)
+          engine.GetToken(i, std::get<0>(tokens[i]), std::get<1>(tokens[i]), std::get<2>(tokens[i]));
+        return tokens;
+      });
+
   pybind11::class_<OgaImages>(m, "Images")
       .def_static("open", [](pybind11::args image_paths) {
         std::vector<std::string> image_paths_string;
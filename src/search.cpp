@@ -3,30 +3,64 @@
 #include "search.h"
 #include "beam_search_scorer.h"
 #include "cpu/interface.h"
+#include "models/model.h"
 #include <queue>
 #include <algorithm>
 #include <limits>
 
 namespace Generators {
 
+namespace {
+
+// Rows with less work than this in total are handled on the calling thread, as handing them out would cost more
+constexpr size_t MinParallelWork = 1 << 16;
+
+}  // namespace
+
 Search_Cpu::Search_Cpu(const GeneratorParams& params)
     : Search{params},
       cpu_device_{*GetCpuInterface()} {
   auto batch_beam_size = params.BatchBeamSize();
 
   sequence_lengths_ = cpu_device_.Allocate<int32_t>(batch_beam_size);
+
+  // Rows are spread across the model's pool. The calling thread works on the rows too, so a pool of its own (for the
+  // internal benchmarks, that have no model) needs one thread less than the rows
+  if (batch_beam_size > 1) {
+    if (params.model)
+      thread_pool_ = params.model->GetThreadPool();
+    else
+      thread_pool_ = std::make_shared<ThreadPool>(std::min<size_t>(batch_beam_size, std::max(1U, std::thread::hardware_concurrency())) - 1);
+  }
+}
+
+void Search_Cpu::ForEachRow(size_t count, size_t row_cost, const std::function<void(size_t)>& func) {
+  if (thread_pool_ && count * row_cost >= MinParallelWork) {
+    thread_pool_->Compute(count, func);
+    return;
+  }
+  for (size_t row = 0; row < count; row++)
+    func(row);
 }
 
 GreedySearch_Cpu::GreedySearch_Cpu(const GeneratorParams& params)
-    : Search_Cpu(params) {
-  if (params_->search.random_seed != -1)
-    gen_.seed(params_->search.random_seed);
-  else {
-    std::random_device rd;
-    std::array<uint32_t, decltype(gen_)::state_size> data;
-    std::generate(std::begin(data), std::end(data), std::ref(rd));
-    std::seed_seq seq(data.begin(), data.end());
-    gen_.seed(seq);
+    : Search_Cpu(params),
+      gens_(params.search.batch_size),
+      top_p_indices_(params.search.batch_size) {
+  // Batch entry 0 is seeded with random_seed itself, so a batch of one samples as it did with a single stream
+  for (size_t batch_id = 0; batch_id < gens_.size(); batch_id++) {
+    if (params_->search.random_seed == -1) {
+      std::random_device rd;
+      std::array<uint32_t, std::mt19937::state_size> data;
+      std::generate(std::begin(data), std::end(data), std::ref(rd));
+      std::seed_seq seq(data.begin(), data.end());
+      gens_[batch_id].seed(seq);
+    } else if (batch_id == 0) {
+      gens_[batch_id].seed(params_->search.random_seed);
+    } else {
+      std::seed_seq seq{static_cast<uint32_t>(params_->search.random_seed), static_cast<uint32_t>(batch_id)};
+      gens_[batch_id].seed(seq);
+    }
   }
 
   next_tokens_ptr_ = cpu_device_.Allocate<int32_t>(params.search.batch_size);
@@ -144,22 +178,17 @@ void BeamSearch_Cpu::SelectTop() {
 
 void GreedySearch_Cpu::SelectTop() {
   // next_tokens = torch.argmax(scores, dim=-1)
-  for (size_t batch_id = 0; batch_id < params_->search.batch_size; batch_id++) {
-    if (PadIfAlreadyEOS(batch_id)) {
-      continue;
-    }
-
-    std::span<float> const scores = next_token_scores_.CpuSpan().subspan(batch_id * params_->config.model.vocab_size, params_->config.model.vocab_size);
-    auto const token = static_cast<int32_t>(std::distance(scores.begin(), std::max_element(scores.begin(), scores.end())));
-    SetNextToken(batch_id, token);
-  }
-
-  AppendNextTokensToSequences();
+  auto const all_scores = next_token_scores_.CpuSpan();
+  SetNextTokens(params_->config.model.vocab_size, [this, all_scores](size_t batch_id) {
+    std::span<float> const scores = all_scores.subspan(batch_id * params_->config.model.vocab_size, params_->config.model.vocab_size);
+    return static_cast<int32_t>(std::distance(scores.begin(), std::max_element(scores.begin(), scores.end())));
+  });
 }
 
 void GreedySearch_Cpu::SampleTopK(int k, float temperature) {
-  for (size_t batch_id = 0; batch_id < params_->search.batch_size; batch_id++) {
-    std::span<float> const scores = next_token_scores_.CpuSpan().subspan(batch_id * params_->config.model.vocab_size, params_->config.model.vocab_size);
+  auto const all_scores = next_token_scores_.CpuSpan();
+  SetNextTokens(params_->config.model.vocab_size, [this, all_scores, k, temperature](size_t batch_id) {
+    std::span<float> const scores = all_scores.subspan(batch_id * params_->config.model.vocab_size, params_->config.model.vocab_size);
     // Find the top K scores
     std::vector<int> indices(scores.size());
     std::iota(indices.begin(), indices.end(), 0);
@@ -170,47 +199,114 @@ void GreedySearch_Cpu::SampleTopK(int k, float temperature) {
     // Sample a token from the top K
     Softmax(top_k_scores, temperature);
     std::discrete_distribution<> dis(top_k_scores.begin(), top_k_scores.end());
-    SetNextToken(batch_id, indices[dis(gen_)]);
-  }
-  AppendNextTokensToSequences();
+    return indices[dis(gens_[batch_id])];
+  });
 }
 
-void GreedySearch_Cpu::SampleTopP(float p, float temperature) {
-  std::uniform_real_distribution<float> dis(0, p);
-  for (size_t batch_id = 0; batch_id < params_->search.batch_size; batch_id++) {
-    if (PadIfAlreadyEOS(batch_id)) {
-      continue;
+void GreedySearch_Cpu::SetTopK(DeviceSpan<float> logits, DeviceSpan<int64_t> indices) {
+  top_k_logits_ = logits;
+  if (!top_k_logits_.empty())
+    top_k_logits_.CopyDeviceToCpu();
+  top_k_indices_ = indices;
+  top_k_indices_.CopyDeviceToCpu();
+}
+
+void GreedySearch_Cpu::SampleFromTopK(int k, float p, float temperature) {
+  auto const indices = top_k_indices_.CpuSpan();
+  const int model_k = static_cast<int>(indices.size() / params_->search.batch_size);
+  if (k > model_k)
+    throw std::runtime_error("top_k (" + std::to_string(k) + ") is larger than the " + std::to_string(model_k) +
+                             " tokens returned by the TopK or ArgMax head of the model");
+  // The top k of the model are sorted, so the first k of them are the top k for any smaller k
+  if (k <= 0)
+    k = model_k;
+
+  auto const all_top_k_logits = top_k_logits_.empty() ? std::span<float>{} : top_k_logits_.CpuSpan();
+  SetNextTokens(k, [&](size_t batch_id) {
+    std::span<const int64_t> const top_k_indices = indices.subspan(batch_id * model_k, k);
+    if (k == 1 || temperature == 0 || top_k_logits_.empty())
+      return static_cast<int32_t>(top_k_indices[0]);
+
+    std::span<const float> const top_k_logits = all_top_k_logits.subspan(batch_id * model_k, k);
+    std::vector<float> top_k_scores(top_k_logits.begin(), top_k_logits.end());
+    Softmax(top_k_scores, temperature);
+    // Keep the smallest set of tokens whose cumulative probability reaches p
+    size_t count = top_k_scores.size();
+    if (p > 0.0f && p < 1.0f) {
+      float cumulative = 0.0f;
+      for (count = 0; count < top_k_scores.size() && cumulative < p; count++)
+        cumulative += top_k_scores[count];
     }
-    std::span<float> const scores = next_token_scores_.CpuSpan().subspan(batch_id * params_->config.model.vocab_size, params_->config.model.vocab_size);
+    std::discrete_distribution<> dis(top_k_scores.begin(), top_k_scores.begin() + count);
+    return static_cast<int32_t>(top_k_indices[dis(gens_[batch_id])]);
+  });
+}
+
+void GreedySearch_Cpu::SampleTopP(float p, float temperature) {
+  auto const all_scores = next_token_scores_.CpuSpan();
+  SetNextTokens(params_->config.model.vocab_size, [this, all_scores, p, temperature](size_t batch_id) {
+    std::uniform_real_distribution<float> dis(0, p);
+    std::span<float> const scores = all_scores.subspan(batch_id * params_->config.model.vocab_size, params_->config.model.vocab_size);
     Softmax(scores, temperature);
-    // Sort an array of indices into the scores
-    std::vector<int32_t> indices(scores.size());
-    std::iota(indices.begin(), indices.end(), 0);
-    std::sort(indices.begin(), indices.end(), [scores = scores.data()](int32_t i, int32_t j) { return scores[i] > scores[j]; });
     // Sample a probability threshold
-    float threshold = dis(gen_);
-    int32_t token = 0;
-    // Find the first token where the cumulative probability exceeds the threshold
-    for (int i = 0; i < scores.size(); i++) {
-      threshold -= scores[indices[i]];
-      if (threshold > 0) {
-        continue;
+    return FindTopPToken(scores, dis(gens_[batch_id]), top_p_indices_[batch_id]);
+  });
+}
+
+int32_t GreedySearch_Cpu::FindTopPToken(std::span<const float> probabilities, float threshold, std::vector<int32_t>& candidates) {
+  // At most 1/cutoff tokens have a probability of at least cutoff, so the candidates stay few while the cutoff is high
+  constexpr float initial_cutoff = 1.0f / 1024;
+  constexpr float cutoff_step = 16.0f;
+  constexpr float min_cutoff_x_vocab_size = 4.0f;  // Below this, the candidates could be a quarter of the vocabulary
+
+  const size_t vocab_size = probabilities.size();
+  // Ties go to the lower token id, so the candidates sort in the same order as they do within the whole vocabulary
+  auto by_probability = [probabilities = probabilities.data()](int32_t i, int32_t j) {
+    return probabilities[i] > probabilities[j] || (probabilities[i] == probabilities[j] && i < j);
+  };
+  auto find_token = [&]() -> int32_t {
+    float remaining = threshold;
+    for (int32_t index : candidates) {
+      remaining -= probabilities[index];
+      if (remaining <= 0)
+        return index;
+    }
+    return -1;
+  };
+
+  // The tokens with at least the cutoff probability are the first ones in sorted order, so when they hold enough
+  // probability only they are sorted. Otherwise the cutoff is lowered
+  for (float cutoff = initial_cutoff; cutoff * vocab_size > min_cutoff_x_vocab_size; cutoff /= cutoff_step) {
+    candidates.clear();
+    float candidate_probability = 0.0f;
+    for (size_t i = 0; i < vocab_size; i++) {
+      if (probabilities[i] >= cutoff) {
+        candidates.push_back(static_cast<int32_t>(i));
+        candidate_probability += probabilities[i];
       }
-      token = indices[i];
-      break;
     }
-    SetNextToken(batch_id, token);
+    if (candidate_probability < threshold)
+      continue;
+
+    std::sort(candidates.begin(), candidates.end(), by_probability);
+    if (int32_t token = find_token(); token >= 0)
+      return token;
   }
-  AppendNextTokensToSequences();
+
+  // The nucleus holds much of the vocabulary (or the vocabulary is small), so sort all of it
+  candidates.resize(vocab_size);
+  std::iota(candidates.begin(), candidates.end(), 0);
+  std::sort(candidates.begin(), candidates.end(), by_probability);
+  int32_t token = find_token();
+  return token >= 0 ? token : 0;
 }
 
 void GreedySearch_Cpu::SampleTopKTopP(int k, float p, float temperature) {
-  // For numerical stability, we use 0.9999999f not 1.0f to avoid zero probabilities.
-  std::uniform_real_distribution<float> dis(0, 0.999999f);
-  for (size_t batch_id = 0; batch_id < params_->search.batch_size; batch_id++) {
-    if (PadIfAlreadyEOS(batch_id))
-      continue;
-    std::span<float> const scores = next_token_scores_.CpuSpan().subspan(batch_id * params_->config.model.vocab_size, params_->config.model.vocab_size);
+  auto const all_scores = next_token_scores_.CpuSpan();
+  SetNextTokens(params_->config.model.vocab_size, [this, all_scores, k, p, temperature](size_t batch_id) {
+    // For numerical stability, we use 0.9999999f not 1.0f to avoid zero probabilities.
+    std::uniform_real_distribution<float> dis(0, 0.999999f);
+    std::span<float> const scores = all_scores.subspan(batch_id * params_->config.model.vocab_size, params_->config.model.vocab_size);
     // Find the top K scores
     std::vector<int> indices(scores.size());
     std::iota(indices.begin(), indices.end(), 0);
@@ -236,7 +332,7 @@ void GreedySearch_Cpu::SampleTopKTopP(int k, float p, float temperature) {
     }
     SoftmaxWithMax(scores_top_k_filtering, temperature, scores_top_k_filtering[0]);
     // Sample a probability threshold
-    threshold = dis(gen_);
+    threshold = dis(gens_[batch_id]);
     int32_t token = indices[k - 1];
     // Find the first token where the cumulative probability exceeds the threshold
     for (int i = 0; i < k - 1; i++) {
@@ -247,9 +343,8 @@ void GreedySearch_Cpu::SampleTopKTopP(int k, float p, float temperature) {
       token = indices[i];
       break;
     }
-    SetNextToken(batch_id, token);
-  }
-  AppendNextTokensToSequences();
+    return token;
+  });
 }
 
 bool GreedySearch_Cpu::PadIfAlreadyEOS(size_t batch_id) {
@@ -274,6 +369,22 @@ void GreedySearch_Cpu::SetNextToken(size_t batch_id, int32_t token) {
   }
 }
 
+void GreedySearch_Cpu::SetNextTokens(size_t row_cost, const std::function<int32_t(size_t)>& pick) {
+  ForEachRow(params_->search.batch_size, row_cost, [&](size_t batch_id) {
+    if (!eos_seen_[batch_id])
+      next_tokens_[batch_id] = pick(batch_id);
+  });
+
+  // Done on this thread, as it counts the batch entries that are done
+  for (size_t batch_id = 0; batch_id < params_->search.batch_size; batch_id++) {
+    if (PadIfAlreadyEOS(batch_id)) {
+      continue;
+    }
+    SetNextToken(batch_id, next_tokens_[batch_id]);
+  }
+  AppendNextTokensToSequences();
+}
+
 void GreedySearch_Cpu::AppendNextTokensToSequences() {
   // Append next token to each sequence.
   auto sequences_span = sequences_.GetSequences().CpuSpan();
@@ -285,6 +396,15 @@ void GreedySearch_Cpu::AppendNextTokensToSequences() {
   }
   sequences_.GetSequences().CopyCpuToDevice();
 
+  if (token_counts_) {
+    for (int i = 0; i < batch_beam_size; i++)
+      token_counts_->Add(i, next_tokens[i]);
+  }
+  if (ngram_index_) {
+    for (int i = 0; i < batch_beam_size; i++)
+      ngram_index_->Add(i, sequences_span.subspan(i * sequences_.max_length_, current_length + 1));
+  }
+
   sequences_.AfterAppendNextTokens(next_tokens_ptr_, batch_beam_size);
 
   if (sequences_.GetSequenceLength() == params_->search.max_length) {
@@ -322,6 +442,23 @@ void GreedySearch_Cpu::RewindTo(size_t index) {
     }
   } else
     memset(next_tokens_.data(), 0, next_tokens_.size_bytes());
+
+  if (token_counts_) {
+    if (index == 0)
+      token_counts_->Clear();
+    else {
+      auto sequences = sequences_.GetSequences().Span();
+      const size_t length = static_cast<size_t>(sequences_.GetSequenceLength());
+      for (int i = 0; i < params_->BatchBeamSize(); i++)
+        token_counts_->Remove(i, sequences.subspan(i * sequences_.max_length_ + index, length - index));
+    }
+  }
+  if (ngram_index_) {
+    auto sequences = sequences_.GetSequences().Span();
+    const size_t length = static_cast<size_t>(sequences_.GetSequenceLength());
+    for (int i = 0; i < params_->BatchBeamSize(); i++)
+      ngram_index_->RewindTo(i, sequences.subspan(i * sequences_.max_length_, length), index);
+  }
   sequences_.RewindTo(index);
 }
 
@@ -341,6 +478,9 @@ void BeamSearch_Cpu::AppendTokens(DeviceSpan<int32_t>& next_tokens) {
     std::span<const int32_t> source = next_tokens_cpu.subspan((i / params_->search.num_beams) * tokens_count_per_batch, tokens_count_per_batch);
     copy(source, target);
   }
+  // The sequences were replaced, the counts and n-grams are built again from them when needed
+  token_counts_.reset();
+  ngram_index_.reset();
   sequences_.AfterAppendNextTokens(next_tokens, params_->search.batch_size);  // next_tokens is not expanded
 }
 
@@ -371,6 +511,17 @@ void BeamSearch_Cpu::AppendNextTokensToSequences() {
     // Append next token to each beam.
     sequences_next_span[i * max_length + current_length] = batch_beam_next_tokens[i];
   }
+
+  if (token_counts_) {
+    token_counts_->Reorder(batch_beam_indices);
+    for (ptrdiff_t i = 0; i < batch_beam_size; i++)
+      token_counts_->Add(i, batch_beam_next_tokens[i]);
+  }
+  if (ngram_index_) {
+    ngram_index_->Reorder(batch_beam_indices);
+    for (ptrdiff_t i = 0; i < batch_beam_size; i++)
+      ngram_index_->Add(i, sequences_next_span.subspan(i * max_length, current_length + 1));
+  }
   auto next_tokens_device = beam_scorer_->GetNextTokens();
   sequences_.GetNextSequences().CopyCpuToDevice();
   sequences_.AfterAppendNextTokens(next_tokens_device, params_->BatchBeamSize());
@@ -411,37 +562,126 @@ void Search_Cpu::ApplyMinLength(int min_length) {
     return;
   }
 
-  const int batch_beam_size = params_->BatchBeamSize();
-  for (int i = 0; i < batch_beam_size; i++) {
-    std::span<float> const beam_token_scores = GetScores(i);
-    for (auto token_id : params_->config.model.eos_token_id)
+  const auto& eos_token_ids = params_->config.model.eos_token_id;
+  ForEachRow(params_->BatchBeamSize(), eos_token_ids.size(), [&](size_t i) {
+    std::span<float> const beam_token_scores = GetScores(static_cast<int>(i));
+    for (auto token_id : eos_token_ids)
       beam_token_scores[token_id] = std::numeric_limits<float>::lowest();
+  });
+}
+
+TokenCounts& Search_Cpu::GetTokenCounts() {
+  if (!token_counts_) {
+    token_counts_ = std::make_unique<TokenCounts>(params_->BatchBeamSize(), params_->config.model.vocab_size);
+    auto sequences = sequences_.GetSequences().CopyDeviceToCpu();
+    const size_t length = static_cast<size_t>(sequences_.GetSequenceLength());
+    for (int i = 0; i < params_->BatchBeamSize(); i++) {
+      for (int32_t token : sequences.subspan(i * sequences_.max_length_, length))
+        token_counts_->Add(i, token);
+    }
   }
+  return *token_counts_;
+}
+
+NgramIndex& Search_Cpu::GetNgramIndex(int ngram_size) {
+  if (!ngram_index_) {
+    ngram_index_ = std::make_unique<NgramIndex>(params_->BatchBeamSize(), ngram_size);
+    auto sequences = sequences_.GetSequences().CopyDeviceToCpu();
+    const size_t length = static_cast<size_t>(sequences_.GetSequenceLength());
+    for (int i = 0; i < params_->BatchBeamSize(); i++) {
+      for (size_t j = 1; j <= length; j++)
+        ngram_index_->Add(i, sequences.subspan(i * sequences_.max_length_, j));
+    }
+  }
+  return *ngram_index_;
 }
 
 void Search_Cpu::ApplyRepetitionPenalty(float penalty) {
   if (penalty == 1.0f)
     return;
 
-  const int batch_beam_size = params_->BatchBeamSize();
-  for (int i = 0; i < batch_beam_size; i++) {
-    std::span<float> const beam_token_scores = GetScores(i);
-    std::span<const int32_t> const sequence = sequences_.GetSequence(i).CopyDeviceToCpu();
+  const auto& token_counts = GetTokenCounts();
+  ForEachRow(params_->BatchBeamSize(), sequences_.GetSequenceLength(), [&](size_t i) {
+    std::span<float> const beam_token_scores = GetScores(static_cast<int>(i));
 
-    // Find unique word IDs in sequence.
-    std::unordered_set<int32_t> unique_word_ids;
-    for (const auto& word_id : sequence) {
-      unique_word_ids.insert(word_id);
-    }
-
-    for (const int32_t word_id : unique_word_ids) {
+    for (const int32_t word_id : token_counts.GetTokens(i)) {
       float const score = beam_token_scores[word_id];
 
       // If score < 0, then repetition penalty > 1.0 has to multiplied to reduce the previous token probability,
       // This assumes that scores are either positive (like ctrl) or negative (like GPT-2), but not a mixture.
       beam_token_scores[word_id] = (score < 0 ? score * penalty : score / penalty);
     }
+  });
+}
+
+void Search_Cpu::ApplyPresenceAndFrequencyPenalties(float presence_penalty, float frequency_penalty) {
+  if (presence_penalty == 0.0f && frequency_penalty == 0.0f)
+    return;
+
+  const auto& token_counts = GetTokenCounts();
+  ForEachRow(params_->BatchBeamSize(), sequences_.GetSequenceLength(), [&](size_t i) {
+    std::span<float> const beam_token_scores = GetScores(static_cast<int>(i));
+    for (const int32_t token : token_counts.GetTokens(i))
+      beam_token_scores[token] -= presence_penalty + frequency_penalty * static_cast<float>(token_counts.GetCount(i, token));
+  });
+}
+
+void Search_Cpu::ApplyNoRepeatNgram(int no_repeat_ngram_size) {
+  if (no_repeat_ngram_size <= 0)
+    return;
+
+  // A lookup per row, too little work to hand the rows out to the thread pool
+  const auto& ngram_index = GetNgramIndex(no_repeat_ngram_size);
+  auto sequences = sequences_.GetSequences().Span();
+  const size_t length = static_cast<size_t>(sequences_.GetSequenceLength());
+  for (int i = 0; i < params_->BatchBeamSize(); i++) {
+    std::span<float> const beam_token_scores = GetScores(i);
+    ngram_index.ForEachBannedToken(i, sequences.subspan(i * sequences_.max_length_, length), [&](int32_t token) {
+      beam_token_scores[token] = std::numeric_limits<float>::lowest();
+    });
+  }
+}
+
+void GenerateNextTokens(Search& search) {
+  auto& options = search.params_->search;
+  search.ApplyMinLength(options.min_length);
+  search.ApplyRepetitionPenalty(options.repetition_penalty);
+  search.ApplyPresenceAndFrequencyPenalties(options.presence_penalty, options.frequency_penalty);
+  search.ApplyNoRepeatNgram(options.no_repeat_ngram_size);
+
+  if (g_log.enabled && g_log.generate_next_token) {
+    auto& stream = Log("generate_next_token");
+    stream << SGR::Fg_Green << "do_sample: " << SGR::Reset << options.do_sample << ' '
+           << SGR::Fg_Green << "top_k: " << SGR::Reset << options.top_k << ' '
+           << SGR::Fg_Green << "top_p: " << SGR::Reset << options.top_p << ' '
+           << SGR::Fg_Green << "temperature: " << SGR::Reset << options.temperature << ' '
+           << SGR::Fg_Cyan << "sequence length: " << SGR::Reset << search.GetSequenceLength()
+           << std::endl;
+  }
+
+  if (!options.do_sample || options.top_k == 1 || options.temperature == 0) {
+    search.SelectTop();
+    return;
+  }
+
+  // The user explicitly called TopK_TopP on a beam search
+  if (options.num_beams != 1)
+    throw std::runtime_error("TopK and TopP cannot be used with a beam search");
+
+  // Sanity checks
+  if (options.top_p < 0.0f || options.top_p > 1.0f)
+    throw std::runtime_error("top_p must be between 0.0 and 1.0");
+  if (options.top_k < 0)
+    throw std::runtime_error("top_k must be 0 or greater");
+
+  if (options.top_p > 0.0f && options.top_p < 1.0f && options.top_k > 1) {
+    search.SampleTopKTopP(options.top_k, options.top_p, options.temperature);
+  } else if (options.top_k > 1) {
+    search.SampleTopK(options.top_k, options.temperature);
+  } else {
+    assert(options.top_k == 0);
+    search.SampleTopP(options.top_p, options.temperature);
   }
 }
 
-}  // namespace Generators
\ No newline at end of file
+}  // namespace Generators
@@ -1,6 +1,9 @@
 #include "sequences.h"
+#include "token_counts.h"
+#include "ngram_index.h"
 #include <random>
 #include "beam_search_scorer.h"
+#include "models/threadpool.h"
 #pragma once
 
 namespace Generators {
@@ -25,9 +28,19 @@ struct Search : LeakChecked<Search> {
   virtual void SampleTopK(int /*k*/, float /*temperature*/) { assert(false); }
   virtual void SampleTopKTopP(int /*k*/, float /*p*/, float /*temperature*/) { assert(false); }
 
+  // For models with an in-graph TopK or ArgMax head, which return the top k logits (none for ArgMax) and their token ids
+  virtual void SetTopK(DeviceSpan<float> /*logits*/, DeviceSpan<int64_t> /*indices*/) {
+    throw std::runtime_error("Models with a TopK or ArgMax head are only supported by the CPU greedy search");
+  }
+  virtual void SampleFromTopK(int /*k*/, float /*p*/, float /*temperature*/) { assert(false); }
+
   // Scoring features
   virtual void ApplyMinLength(int min_length) = 0;
   virtual void ApplyRepetitionPenalty(float penalty) = 0;
+  // Subtracts presence_penalty from the score of each token in the sequence, and frequency_penalty times its count
+  virtual void ApplyPresenceAndFrequencyPenalties(float presence_penalty, float frequency_penalty) = 0;
+  // Bans the tokens that would repeat an n-gram of the sequence, for n = no_repeat_ngram_size (0 means no ban)
+  virtual void ApplyNoRepeatNgram(int no_repeat_ngram_size) = 0;
 
   // Set user input tokens
   virtual void AppendTokens(DeviceSpan<int32_t>& next_tokens) { assert(false); };
@@ -49,9 +62,20 @@ struct Search_Cpu : Search {
 
   void ApplyMinLength(int min_length) override;
   void ApplyRepetitionPenalty(float penalty) override;
+  void ApplyPresenceAndFrequencyPenalties(float presence_penalty, float frequency_penalty) override;
+  void ApplyNoRepeatNgram(int no_repeat_ngram_size) override;
 
   std::span<float> GetScores(int batch_beam_index);
 
+  // Counts of the tokens in the sequences, built from them on first use and kept up to date from then on
+  TokenCounts& GetTokenCounts();
+  // Index of the n-grams in the sequences, built and kept up to date the same way
+  NgramIndex& GetNgramIndex(int ngram_size);
+
+  // Calls func(row) for each row in [0, count), spread across the thread pool when the rows cost enough work (about
+  // 'row_cost' elements each) to make up for handing them out
+  void ForEachRow(size_t count, size_t row_cost, const std::function<void(size_t)>& func);
+
   DeviceInterface& cpu_device_;
 
   DeviceSpan<int32_t> sequence_lengths_;  // shape (beam_size*batch_size)
@@ -61,6 +85,11 @@ struct Search_Cpu : Search {
   DeviceSpan<float> next_token_scores_;  // shape (beam_size*batch_size, vocab_size)
 
   bool done_{};
+
+  std::shared_ptr<ThreadPool> thread_pool_;  // Set when there is more than one row to work on
+
+  std::unique_ptr<TokenCounts> token_counts_;  // Only when a penalty needs them, see GetTokenCounts
+  std::unique_ptr<NgramIndex> ngram_index_;    // Only with no_repeat_ngram_size, see GetNgramIndex
 };
 
 struct GreedySearch_Cpu : Search_Cpu {
@@ -74,16 +103,25 @@ struct GreedySearch_Cpu : Search_Cpu {
   void SampleTopP(float p, float temperature) override;
   void SampleTopKTopP(int /*k*/, float /*p*/, float /*temperature*/) override;
 
+  void SetTopK(DeviceSpan<float> logits, DeviceSpan<int64_t> indices) override;
+  void SampleFromTopK(int k, float p, float temperature) override;
+
   // Used by continuous decoding search.
   void AppendTokens(DeviceSpan<int32_t>& next_tokens) override;
   void RewindTo(size_t index) override;
 
  protected:
   void SetNextToken(size_t batch_id, int32_t token);
+  // Sets the next token of each batch entry that has not seen EOS to pick(batch_id), which is called across the rows in
+  // parallel (see ForEachRow for row_cost), and appends the tokens to the sequences
+  void SetNextTokens(size_t row_cost, const std::function<int32_t(size_t)>& pick);
   void AppendNextTokensToSequences();
 
   bool PadIfAlreadyEOS(size_t batch_id);
 
+  // Returns the first token, in order of decreasing probability, where the cumulative probability reaches 'threshold'
+  int32_t FindTopPToken(std::span<const float> probabilities, float threshold, std::vector<int32_t>& candidates);
+
   DeviceSpan<int32_t> next_tokens_ptr_;
   std::unique_ptr<int32_t[]> temp_topk_buffer_;
 
@@ -91,7 +129,14 @@ struct GreedySearch_Cpu : Search_Cpu {
   std::unique_ptr<bool[]> eos_seen_buffer_;
   int not_done_count_{params_->search.batch_size};  // When zero, every batch entry is done (starts at batch_size_)
 
-  std::mt19937 gen_;
+  // A random number stream per batch entry, so the samples don't depend on which thread handles which row
+  std::vector<std::mt19937> gens_;
+
+  // Candidate tokens of FindTopPToken for each batch entry, kept between tokens to avoid reallocating them
+  std::vector<std::vector<int32_t>> top_p_indices_;
+
+  DeviceSpan<float> top_k_logits_;     // shape (batch_size, k), empty for an ArgMax head
+  DeviceSpan<int64_t> top_k_indices_;  // shape (batch_size, k)
 };
 
 struct BeamSearch_Cpu : Search_Cpu {
@@ -121,4 +166,7 @@ struct BeamSearch_Cpu : Search_Cpu {
   std::unique_ptr<BeamSearchScorer> beam_scorer_;
 };
 
-}  // namespace Generators
\ No newline at end of file
+// Applies the min_length, repetition_penalty and sampling search options to the logits set on the search, then picks the next tokens
+void GenerateNextTokens(Search& search);
+
+}  // namespace Generators
@@ -0,0 +1,289 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+
+#include <limits>
+#include "generators.h"
+#include "search.h"
+#include "models/model.h"
+#include "speculative.h"
+
+namespace Generators {
+
+namespace {
+
+bool IsGreedy(const Config::Search& options) {
+  return !options.do_sample || options.top_k == 1 || options.temperature == 0;
+}
+
+// The distribution the search samples from: softmax(logits / temperature), limited to the top_k tokens and then to the
+// smallest set of tokens whose cumulative probability reaches top_p
+void ComputeProbabilities(std::span<const float> logits, const Config::Search& options, std::vector<float>& probabilities) {
+  probabilities.resize(logits.size());
+  const float max = *std::max_element(logits.begin(), logits.end());
+  for (size_t i = 0; i < logits.size(); i++)
+    probabilities[i] = std::exp((logits[i] - max) / options.temperature);
+
+  if (options.top_k > 1 && static_cast<size_t>(options.top_k) < probabilities.size()) {
+    std::vector<float> sorted(probabilities);
+    std::nth_element(sorted.begin(), sorted.begin() + options.top_k - 1, sorted.end(), std::greater<float>());
+    const float threshold = sorted[options.top_k - 1];
+    for (auto& probability : probabilities)
+      if (probability < threshold)
+        probability = 0.0f;
+  }
+
+  float sum = std::accumulate(probabilities.begin(), probabilities.end(), 0.0f);
+  if (options.top_p > 0.0f && options.top_p < 1.0f) {
+    std::vector<int32_t> indices(probabilities.size());
+    std::iota(indices.begin(), indices.end(), 0);
+    std::sort(indices.begin(), indices.end(), [&](int32_t a, int32_t b) { return probabilities[a] > probabilities[b]; });
+    float cumulative = 0.0f;
+    size_t count = 0;
+    while (count < indices.size() && cumulative < options.top_p * sum)
+      cumulative += probabilities[indices[count++]];
+    for (size_t i = count; i < indices.size(); i++)
+      probabilities[indices[i]] = 0.0f;
+    sum = cumulative;
+  }
+
+  for (auto& probability : probabilities)
+    probability /= sum;
+}
+
+// Each user of random numbers gets its own stream, so that the draft tokens and the tests accepting them are independent
+void Seed(std::mt19937& random, int random_seed, uint32_t stream) {
+  if (random_seed == -1) {
+    random.seed(std::random_device{}());
+    return;
+  }
+  std::seed_seq seed{static_cast<uint32_t>(random_seed), stream};
+  random.seed(seed);
+}
+
+int32_t Sample(std::span<const float> probabilities, std::mt19937& random) {
+  std::discrete_distribution<int32_t> distribution(probabilities.begin(), probabilities.end());
+  return distribution(random);
+}
+
+}  // namespace
+
+DraftModelProposer::DraftModelProposer(const Model& draft_model, const GeneratorParams& params)
+    : vocab_size_{static_cast<size_t>(params.config.model.vocab_size)} {
+  Seed(random_, params.search.random_seed, 1);
+  auto draft_params = CreateGeneratorParams(draft_model);
+  draft_params->search = params.search;
+  draft_ = CreateGenerator(draft_model, *draft_params);
+}
+
+void DraftModelProposer::Propose(std::span<const int32_t> sequence, size_t max_count, std::vector<int32_t>& tokens, std::vector<float>& probabilities) {
+  auto& options = draft_->search_->params_->search;
+
+  // Rewind the draft model to where it last agreed with the sequence and run the rest, which is at least the pending token
+  auto draft_sequence = draft_->GetSequence(0).CopyDeviceToCpu();
+  const size_t common_length = std::min<size_t>(std::mismatch(draft_sequence.begin(), draft_sequence.end(), sequence.begin(), sequence.end()).first - draft_sequence.begin(),
+                                                sequence.size() - 1);
+  if (common_length < draft_sequence.size())
+    draft_->RewindToLength(common_length);
+  draft_->AppendTokens(cpu_span<const int32_t>(sequence.subspan(common_length)));
+
+  for (size_t i = 0; i < max_count; i++) {
+    auto logits = draft_->GetLogits().CopyDeviceToCpu();
+    int32_t token;
+    if (IsGreedy(options))
+      token = static_cast<int32_t>(std::max_element(logits.begin(), logits.end()) - logits.begin());
+    else {
+      ComputeProbabilities(logits, options, draft_probabilities_);
+      token = Sample(draft_probabilities_, random_);
+    }
+    // The vocabularies of the models can differ in padding, tokens past the model's vocabulary can't be proposed
+    if (static_cast<size_t>(token) >= vocab_size_)
+      break;
+    if (!IsGreedy(options)) {
+      const size_t count = std::min(vocab_size_, draft_probabilities_.size());
+      probabilities.resize(probabilities.size() + vocab_size_);
+      std::copy_n(draft_probabilities_.begin(), count, probabilities.end() - vocab_size_);
+    }
+    tokens.push_back(token);
+    if (i + 1 < max_count)
+      draft_->AppendTokens(cpu_span<const int32_t>(&tokens.back(), 1));
+  }
+}
+
+PromptLookupProposer::PromptLookupProposer(int max_ngram_size) {
+  if (max_ngram_size < 1)
+    throw std::runtime_error("prompt_lookup_max_ngram_size must be 1 or greater, is " + std::to_string(max_ngram_size));
+  max_ngram_size_ = max_ngram_size;
+}
+
+void PromptLookupProposer::Propose(std::span<const int32_t> sequence, size_t max_count, std::vector<int32_t>& tokens, std::vector<float>& /*probabilities*/) {
+  const size_t length = sequence.size();
+  for (size_t ngram_size = std::min(max_ngram_size_, length - 1); ngram_size > 0; ngram_size--) {
+    auto ngram = sequence.subspan(length - ngram_size);
+    // Search backwards, as the most recent occurrence is the most likely to continue the same way
+    for (size_t end = length - 1; end >= ngram_size; end--) {
+      if (!std::equal(ngram.begin(), ngram.end(), sequence.begin() + (end - ngram_size)))
+        continue;
+      const size_t count = std::min(max_count, length - end);
+      tokens.assign(sequence.begin() + end, sequence.begin() + end + count);
+      return;
+    }
+  }
+}
+
+Speculator::Speculator(Generator& generator, std::unique_ptr<DraftProposer> proposer, int draft_token_count)
+    : generator_{generator},
+      proposer_{std::move(proposer)},
+      draft_token_count_{draft_token_count},
+      sample_{!IsGreedy(generator.search_->params_->search)} {
+  auto& params = *generator_.search_->params_;
+  if (params.BatchBeamSize() != 1)
+    throw std::runtime_error("Speculative decoding requires a batch_size and num_beams of 1");
+  if (draft_token_count_ < 1)
+    throw std::runtime_error("The number of draft tokens must be 1 or greater, is " + std::to_string(draft_token_count_));
+  if (generator_.guidance_logits_processor_)
+    throw std::runtime_error("Speculative decoding is not supported with guidance");
+
+  Seed(random_, params.search.random_seed, 0);
+  search_logits_ = params.p_device->Allocate<float>(params.config.model.vocab_size);
+}
+
+std::span<const int32_t> Speculator::GenerateNextTokens() {
+  auto& search = *generator_.search_;
+  auto& options = search.params_->search;
+  tokens_.clear();
+
+  // The first token is picked the standard way, from the logits of the last run
+  if (generator_.last_action_ != Generator::Action::generated) {
+    generator_.GenerateNextToken();
+    tokens_.push_back(search.GetNextTokens().CopyDeviceToCpu()[0]);
+    if (search.IsDone())
+      return tokens_;
+  }
+
+  auto sequence = generator_.GetSequence(0).CopyDeviceToCpu();
+  const size_t length = sequence.size();  // Including the pending token, which the model hasn't run yet
+  const size_t room = options.max_length - length;
+  const size_t max_count = room > 1 ? std::min<size_t>(draft_token_count_, room - 1) : 0;  // Leaves room for the token after the draft tokens
+  draft_tokens_.clear();
+  draft_probabilities_.clear();
+  if (max_count > 0)
+    proposer_->Propose(sequence, max_count, draft_tokens_, draft_probabilities_);
+  if (draft_tokens_.size() > max_count)
+    draft_tokens_.resize(max_count);
+  if (draft_tokens_.empty()) {
+    generator_.GenerateNextToken();
+    tokens_.push_back(search.GetNextTokens().CopyDeviceToCpu()[0]);
+    return tokens_;
+  }
+
+  RunDraftTokens(draft_tokens_);
+  stats_.step_count++;
+  stats_.draft_token_count += draft_tokens_.size();
+
+  // The search picks the token following each draft token in turn, with the same min_length and penalties
+  const size_t vocab_size = search.params_->config.model.vocab_size;
+  for (size_t i = 0; i <= draft_tokens_.size(); i++) {
+    const bool is_draft = i < draft_tokens_.size();
+    const int32_t draft_token = is_draft ? draft_tokens_[i] : -1;
+
+    auto row = std::span<const float>(logits_).subspan(i * vocab_size, vocab_size);
+    std::copy(row.begin(), row.end(), search_logits_.CpuSpan().begin());
+    search_logits_.CopyCpuToDevice();
+    search.SetLogits(search_logits_);
+    search.ApplyMinLength(options.min_length);
+    search.ApplyRepetitionPenalty(options.repetition_penalty);
+    search.ApplyPresenceAndFrequencyPenalties(options.presence_penalty, options.frequency_penalty);
+    search.ApplyNoRepeatNgram(options.no_repeat_ngram_size);
+
+    int32_t token;
+    if (!sample_) {
+      search.SelectTop();
+      token = search.GetNextTokens().CopyDeviceToCpu()[0];
+    } else {
+      ComputeProbabilities(search.GetLogits().CopyDeviceToCpu(), options, probabilities_);
+      if (!is_draft)
+        token = Sample(probabilities_, random_);
+      else {
+        // A proposer without probabilities proposed the token with probability 1
+        const float* draft_probabilities = draft_probabilities_.empty() ? nullptr : draft_probabilities_.data() + i * vocab_size;
+        const float draft_probability = draft_probabilities ? draft_probabilities[draft_token] : 1.0f;
+        if (std::uniform_real_distribution<float>{}(random_) * draft_probability < probabilities_[draft_token])
+          token = draft_token;
+        else {
+          // Sample from the leftover distribution norm(max(0, p - q))
+          if (draft_probabilities) {
+            for (size_t j = 0; j < vocab_size; j++)
+              probabilities_[j] = std::max(probabilities_[j] - draft_probabilities[j], 0.0f);
+          } else
+            probabilities_[draft_token] = 0.0f;
+          const bool has_leftover = std::any_of(probabilities_.begin(), probabilities_.end(), [](float p) { return p > 0.0f; });
+          token = has_leftover ? Sample(probabilities_, random_) : draft_token;
+        }
+      }
+      AppendToken(token);
+    }
+
+    tokens_.push_back(token);
+    if (token == draft_token)
+      stats_.accepted_token_count++;
+    if (search.IsDone() || token != draft_token)
+      break;
+  }
+
+  // The model ran the pending token and every draft token. The last appended token is the new pending one, so the
+  // state is rewound to just before it.
+  const size_t run_length = length + draft_tokens_.size();
+  const size_t kept_length = search.GetSequenceLength() - 1;
+  if (kept_length < run_length)
+    generator_.state_->RewindTo(kept_length);
+  generator_.computed_logits_ = false;
+  generator_.last_action_ = Generator::Action::generated;
+  return tokens_;
+}
+
+void Speculator::RunDraftTokens(std::span<const int32_t> draft_tokens) {
+  auto& search = *generator_.search_;
+  auto& state = *generator_.state_;
+  const auto& model = *generator_.model_;
+
+  auto input_ids = search.params_->p_device->Allocate<int32_t>(draft_tokens.size() + 1);
+  auto input_ids_cpu = input_ids.CpuSpan();
+  input_ids_cpu[0] = search.GetNextTokens().CopyDeviceToCpu()[0];
+  std::copy(draft_tokens.begin(), draft_tokens.end(), input_ids_cpu.begin() + 1);
+  input_ids.CopyCpuToDevice();
+  state.Run(search.GetSequenceLength() + static_cast<int>(draft_tokens.size()), input_ids, search.GetNextIndices());
+
+  auto* output = state.GetOutput(model.config_->model.decoder.outputs.logits.c_str());
+  const size_t token_count = draft_tokens.size() + 1;
+  if (!output || output->GetTensorTypeAndShapeInfo()->GetShape()[1] != static_cast<int64_t>(token_count))
+    throw std::runtime_error("Speculative decoding requires a model that returns the logits of every input token");
+
+  const size_t element_count = token_count * search.params_->config.model.vocab_size;
+  auto logits = ByteWrapTensor(*model.p_device_inputs_, *output).CopyDeviceToCpu();
+  logits_.resize(element_count);
+  switch (output->GetTensorTypeAndShapeInfo()->GetElementType()) {
+    case Ort::TypeToTensorType<float>:
+      std::memcpy(logits_.data(), logits.data(), element_count * sizeof(float));
+      break;
+    case Ort::TypeToTensorType<Ort::Float16_t>: {
+      auto* values = reinterpret_cast<const uint16_t*>(logits.data());
+      for (size_t i = 0; i < element_count; i++)
+        logits_[i] = Float16ToFloat32(values[i]);
+      break;
+    }
+    default:
+      throw std::runtime_error("Speculative decoding requires float or float16 logits");
+  }
+}
+
+void Speculator::AppendToken(int32_t token) {
+  // Selecting the token lets the search append it, so it tracks the EOS and max_length as for the tokens it picks
+  auto logits = generator_.search_->GetLogits();
+  auto logits_cpu = logits.CpuSpan();
+  std::fill(logits_cpu.begin(), logits_cpu.end(), std::numeric_limits<float>::lowest());
+  logits_cpu[token] = 0.0f;
+  logits.CopyCpuToDevice();
+  generator_.search_->SelectTop();
+}
+
+}  // namespace Generators
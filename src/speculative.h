@@ -0,0 +1,84 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+#pragma once
+
+#include <random>
+
+namespace Generators {
+
+// Proposes the tokens that likely follow a sequence, for the Speculator to verify
+struct DraftProposer {
+  virtual ~DraftProposer() = default;
+
+  // Proposes up to max_count tokens to follow 'sequence'. When sampling, proposers that sample their tokens also store the
+  // distribution each token was sampled from in 'probabilities' (vocab_size floats per token). Deterministic proposers
+  // leave it empty.
+  virtual void Propose(std::span<const int32_t> sequence, size_t max_count, std::vector<int32_t>& tokens, std::vector<float>& probabilities) = 0;
+};
+
+// Proposes tokens by running a smaller draft model that shares the tokenizer of the model
+struct DraftModelProposer : DraftProposer {
+  DraftModelProposer(const Model& draft_model, const GeneratorParams& params);
+
+  void Propose(std::span<const int32_t> sequence, size_t max_count, std::vector<int32_t>& tokens, std::vector<float>& probabilities) override;
+
+ private:
+  std::unique_ptr<Generator> draft_;  // Holds the tokens the draft model has run, it never has a token pending
+  size_t vocab_size_;                 // Of the model, which the probabilities are stored for
+  std::mt19937 random_;
+  std::vector<float> draft_probabilities_;
+};
+
+// Proposes the tokens that followed the last earlier occurrence of the n-gram ending the sequence, trying the longest
+// n-gram first. Needs no draft model, and works well when the output copies spans of the prompt (code edits, quotes
+// from a retrieved context)
+struct PromptLookupProposer : DraftProposer {
+  PromptLookupProposer(int max_ngram_size);
+
+  void Propose(std::span<const int32_t> sequence, size_t max_count, std::vector<int32_t>& tokens, std::vector<float>& probabilities) override;
+
+ private:
+  size_t max_ngram_size_;
+};
+
+struct SpeculativeStats {
+  size_t step_count{};            // Number of verification runs of the model
+  size_t draft_token_count{};     // Number of proposed tokens
+  size_t accepted_token_count{};  // Number of proposed tokens that were kept
+};
+
+// Speculative decoding: a proposer guesses the next tokens, the model runs over all of them at once, and the guesses are
+// kept up to the first one the search would not have picked (which is replaced by the token it would have picked). The
+// rejected tokens are rewound. Greedy search keeps a guess when it is the top token. Sampling keeps a guess with
+// probability min(1, p/q) and otherwise samples from the leftover distribution norm(max(0, p - q)), where p is the
+// distribution of the model and q the one the guess was sampled from, so the tokens follow the same distribution as
+// without speculation.
+// Requires a batch_size and num_beams of 1, and a model that returns the logits of every input token.
+struct Speculator {
+  Speculator(Generator& generator, std::unique_ptr<DraftProposer> proposer, int draft_token_count);
+
+  // Appends one or more tokens to the generator and returns them. The last one is pending, as after GenerateNextToken
+  std::span<const int32_t> GenerateNextTokens();
+
+  const SpeculativeStats& GetStats() const { return stats_; }
+
+ private:
+  void RunDraftTokens(std::span<const int32_t> draft_tokens);  // Runs the pending token & the draft tokens, sets logits_
+  void AppendToken(int32_t token);                             // Appends a token picked here through the search
+
+  Generator& generator_;
+  std::unique_ptr<DraftProposer> proposer_;
+  int draft_token_count_;
+  bool sample_;
+  std::mt19937 random_;
+
+  std::vector<int32_t> tokens_;  // Tokens appended by the last GenerateNextTokens
+  std::vector<int32_t> draft_tokens_;
+  std::vector<float> draft_probabilities_;
+  std::vector<float> probabilities_;
+  std::vector<float> logits_;  // Logits of the pending token and of each draft token, [draft_tokens + 1, vocab_size]
+  DeviceSpan<float> search_logits_;
+  SpeculativeStats stats_;
+};
+
+}  // namespace Generators
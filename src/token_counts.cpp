@@ -0,0 +1,66 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+
+#include "generators.h"
+#include "token_counts.h"
+
+namespace Generators {
+
+TokenCounts::TokenCounts(size_t row_count, size_t vocab_size)
+    : vocab_size_{vocab_size},
+      counts_(row_count * vocab_size),
+      tokens_(row_count) {
+}
+
+void TokenCounts::Add(size_t row, int32_t token) {
+  assert(token >= 0 && static_cast<size_t>(token) < vocab_size_);
+  if (counts_[row * vocab_size_ + token]++ == 0)
+    tokens_[row].push_back(token);
+}
+
+void TokenCounts::Remove(size_t row, std::span<const int32_t> tokens) {
+  auto* counts = counts_.data() + row * vocab_size_;
+  for (int32_t token : tokens) {
+    assert(counts[token] > 0);
+    counts[token]--;
+  }
+
+  // Tokens that are gone are dropped from the list in one pass, rather than searched for one by one
+  auto& row_tokens = tokens_[row];
+  row_tokens.erase(std::remove_if(row_tokens.begin(), row_tokens.end(), [counts](int32_t token) { return counts[token] == 0; }),
+                   row_tokens.end());
+}
+
+void TokenCounts::Clear() {
+  for (size_t row = 0; row < tokens_.size(); row++) {
+    for (int32_t token : tokens_[row])
+      counts_[row * vocab_size_ + token] = 0;
+    tokens_[row].clear();
+  }
+}
+
+void TokenCounts::Reorder(std::span<const int32_t> source_rows) {
+  assert(source_rows.size() == tokens_.size());
+  if (next_counts_.empty()) {
+    next_counts_.resize(counts_.size());
+    next_tokens_.resize(tokens_.size());
+  }
+
+  // Only the counts of the tokens listed are ever non zero, so a row is copied in O(distinct tokens)
+  for (size_t row = 0; row < source_rows.size(); row++) {
+    auto* next_counts = next_counts_.data() + row * vocab_size_;
+    for (int32_t token : next_tokens_[row])
+      next_counts[token] = 0;
+
+    const size_t source_row = static_cast<size_t>(source_rows[row]);
+    const auto* counts = counts_.data() + source_row * vocab_size_;
+    next_tokens_[row] = tokens_[source_row];
+    for (int32_t token : next_tokens_[row])
+      next_counts[token] = counts[token];
+  }
+
+  std::swap(counts_, next_counts_);
+  std::swap(tokens_, next_tokens_);
+}
+
+}  // namespace Generators
@@ -0,0 +1,33 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+#pragma once
+
+namespace Generators {
+
+// How many times each token appears in each sequence of a search. It is kept up to date as tokens are appended, rewound
+// and reordered by beam search, so the penalties that depend on the tokens so far (repetition, presence, frequency) cost
+// O(distinct tokens) per step instead of a pass over the whole sequence.
+struct TokenCounts {
+  TokenCounts(size_t row_count, size_t vocab_size);
+
+  void Add(size_t row, int32_t token);
+  void Remove(size_t row, std::span<const int32_t> tokens);  // Removes one occurrence of each of the tokens
+  void Clear();
+
+  // Makes each row i a copy of row source_rows[i], as beam search does with the sequences
+  void Reorder(std::span<const int32_t> source_rows);
+
+  std::span<const int32_t> GetTokens(size_t row) const { return tokens_[row]; }  // The distinct tokens of the row
+  int32_t GetCount(size_t row, int32_t token) const { return counts_[row * vocab_size_ + token]; }
+
+ private:
+  size_t vocab_size_;
+  std::vector<int32_t> counts_;               // shape (row_count, vocab_size)
+  std::vector<std::vector<int32_t>> tokens_;  // Tokens with a count above zero, for each row
+
+  // Where Reorder builds the rows before swapping them in, allocated by the first Reorder
+  std::vector<int32_t> next_counts_;
+  std::vector<std::vector<int32_t>> next_tokens_;
+};
+
+}  // namespace Generators
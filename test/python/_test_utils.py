@@ -133,6 +133,29 @@ def download_model(model_name, input_path, output_path, precision, device, one_l
     run_subprocess(command).check_returncode()
 
 
+def build_model(input_path, output_path, precision, device, cache_dir, extra_options=None, capture=False):
+    # python -m onnxruntime_genai.models.builder -i <input_path> -o <output_path> -p <precision> -e <device> -c <cache_dir>
+    command = [
+        sys.executable,
+        "-m",
+        "onnxruntime_genai.models.builder",
+        "-i",
+        input_path,
+        "-o",
+        output_path,
+        "-p",
+        precision,
+        "-e",
+        device,
+        "-c",
+        cache_dir,
+    ]
+    if extra_options:
+        command += ["--extra_options"] + [f"{key}={value}" for key, value in extra_options.items()]
+
+    return run_subprocess(command, capture=capture)
+
+
 def download_models(download_path, precision, device, log):
     log.debug(f"Downloading models to {download_path} with precision {precision} and device {device}")
 
@@ -3,6 +3,7 @@
 
 import functools
 import os
+import shutil
 import sys
 
 import pytest
@@ -83,3 +84,31 @@ def path_for_model(request):
 @pytest.fixture
 def test_data_path(request):
     return request.config.getoption("--test_models")
+
+
+@pytest.fixture(scope="session")
+def tiny_llama_path(request, tmp_path_factory):
+    # A randomly initialized Llama checkpoint that is small enough to build with each model builder option in seconds
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+
+    path = tmp_path_factory.mktemp("tiny-llama")
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=1000,
+        hidden_size=64,
+        intermediate_size=176,  # Not a multiple of the int4 block size, so the last block of down_proj is padded
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        tie_word_embeddings=False,
+    )
+    # Sharded like large checkpoints, so that streaming reads the weights through the safetensors index
+    transformers.LlamaForCausalLM(config).save_pretrained(path, max_shard_size="200KB")
+
+    # The model builder copies the tokenizer to the output folder, so borrow the one of the tiny GPT-2 test model
+    tokenizer_path = os.path.join(request.config.getoption("--test_models"), "hf-internal-testing", "tiny-random-gpt2-fp32")
+    for filename in ("tokenizer.json", "tokenizer_config.json", "vocab.json"):
+        shutil.copy(os.path.join(tokenizer_path, filename), path)
+    return os.fspath(path)
@@ -0,0 +1,215 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License
+
+from __future__ import annotations
+
+import glob
+import json
+import os
+import types
+
+import numpy as np
+import onnx
+import onnxruntime
+import pytest
+from _test_utils import build_model
+from onnx import TensorProto, helper, numpy_helper
+
+
+def build(tiny_llama_path, tmp_path, name, precision="fp32", **extra_options):
+    output_path = os.fspath(tmp_path / name)
+    cache_dir = extra_options.pop("cache_dir", os.fspath(tmp_path / f"{name}-cache"))
+    build_model(tiny_llama_path, output_path, precision, "cpu", cache_dir, extra_options)
+    return output_path
+
+
+def run_decoder(model_path, input_ids):
+    # Run the prompt through the decoder with an empty past
+    session = onnxruntime.InferenceSession(os.path.join(model_path, "model.onnx"), providers=["CPUExecutionProvider"])
+    batch_size, sequence_length = input_ids.shape
+    dtypes = {"tensor(float)": np.float32, "tensor(float16)": np.float16, "tensor(int8)": np.int8, "tensor(int32)": np.int32, "tensor(int64)": np.int64}
+    feeds = {}
+    for value in session.get_inputs():
+        if value.name == "input_ids":
+            feeds[value.name] = input_ids
+        elif value.name == "attention_mask":
+            feeds[value.name] = np.ones((batch_size, sequence_length), dtype=np.int64)
+        elif value.name == "position_ids":
+            feeds[value.name] = np.tile(np.arange(sequence_length, dtype=np.int64), (batch_size, 1))
+        else:
+            shape = [dim if isinstance(dim, int) else batch_size if dim == "batch_size" else 0 for dim in value.shape]
+            feeds[value.name] = np.zeros(shape, dtype=dtypes[value.type])
+    return session.run(["logits"], feeds)[0]
+
+
+def assert_same_model(expected_path, actual_path):
+    expected = onnx.load(os.path.join(expected_path, "model.onnx"))
+    actual = onnx.load(os.path.join(actual_path, "model.onnx"))
+    assert sorted((node.op_type, node.name) for node in expected.graph.node) == sorted((node.op_type, node.name) for node in actual.graph.node)
+
+    expected_initializers = {initializer.name: numpy_helper.to_array(initializer) for initializer in expected.graph.initializer}
+    actual_initializers = {initializer.name: numpy_helper.to_array(initializer) for initializer in actual.graph.initializer}
+    assert expected_initializers.keys() == actual_initializers.keys()
+    for name, value in expected_initializers.items():
+        np.testing.assert_array_equal(actual_initializers[name], value, err_msg=name)
+
+    input_ids = np.random.default_rng(0).integers(0, 1000, size=(2, 8), dtype=np.int64)
+    np.testing.assert_array_equal(run_decoder(actual_path, input_ids), run_decoder(expected_path, input_ids))
+
+
+@pytest.mark.parametrize("precision", ["fp32", "int4"])
+def test_streaming(tiny_llama_path, tmp_path, precision):
+    expected = build(tiny_llama_path, tmp_path, "default", precision)
+    actual = build(tiny_llama_path, tmp_path, "streaming", precision, streaming="true")
+    assert_same_model(expected, actual)
+
+
+@pytest.mark.parametrize("streaming", ["false", "true"])
+def test_parallel_layers(tiny_llama_path, tmp_path, streaming):
+    expected = build(tiny_llama_path, tmp_path, "serial", "int4", streaming=streaming)
+    actual = build(tiny_llama_path, tmp_path, "parallel", "int4", streaming=streaming, parallel_layers=2)
+    assert_same_model(expected, actual)
+
+
+def test_layer_cache(tiny_llama_path, tmp_path):
+    expected = build(tiny_llama_path, tmp_path, "default", "int4")
+
+    # The second build with the same weights and settings reuses every decoder layer of the first
+    cache_dir = os.fspath(tmp_path / "cache")
+    first = build(tiny_llama_path, tmp_path, "first", "int4", layer_cache="true", cache_dir=cache_dir)
+    output_path = os.fspath(tmp_path / "second")
+    completed_process = build_model(tiny_llama_path, output_path, "int4", "cpu", cache_dir, {"layer_cache": "true"}, capture=True)
+    assert completed_process.stdout.decode().count("Using cached decoder layer") == 3
+
+    assert_same_model(expected, first)
+    assert_same_model(expected, output_path)
+
+
+def test_sharded_external_data(tiny_llama_path, tmp_path):
+    expected = build(tiny_llama_path, tmp_path, "single", "fp32")
+    actual = build(tiny_llama_path, tmp_path, "sharded", "fp32", max_shard_size=0.0002, save_threads=4, align_external_data=4096)
+
+    # About 1 MB of weights in shards of at most 200 KB (or a single larger initializer), listed in the index
+    shards = sorted(glob.glob(os.path.join(actual, "model.onnx-*-of-*.data")))
+    assert len(shards) > 1
+    assert not os.path.exists(os.path.join(actual, "model.onnx.data"))
+    with open(os.path.join(actual, "model.onnx.data.index.json")) as f:
+        index = json.load(f)
+    assert index["shards"] == {os.path.basename(shard): os.path.getsize(shard) for shard in shards}
+
+    # Each initializer starts at an aligned offset in its shard
+    model = onnx.load(os.path.join(actual, "model.onnx"), load_external_data=False)
+    for initializer in model.graph.initializer:
+        if initializer.data_location == TensorProto.EXTERNAL:
+            external_data = {entry.key: entry.value for entry in initializer.external_data}
+            assert int(external_data.get("offset", 0)) % 4096 == 0
+            assert index["weight_map"][initializer.name]["file"] == external_data["location"]
+
+    assert_same_model(expected, actual)
+
+
+def unpack_int4(packed, count):
+    # Two 4-bit values per byte, low nibble first, dropping the padding after the first 'count' values
+    values = np.stack([packed & 0xF, packed >> 4], axis=-1).reshape(*packed.shape[:-1], -1)
+    return values[..., :count]
+
+
+@pytest.mark.parametrize("is_symmetric", [True, False])
+@pytest.mark.parametrize("in_features", [64, 80])
+def test_int4_quantization_matches_matmul_nbits_quantizer(is_symmetric, in_features):
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from onnxruntime.quantization.matmul_nbits_quantizer import MatMulNBitsQuantizer
+    from onnxruntime_genai.models.builder import Model
+
+    out_features, block_size = 48, 32
+    k_blocks = (in_features + block_size - 1) // block_size
+
+    # Weights stored in fp16 hit the ties and halfway cases of the rounding often, and the first block of row 1 ties
+    # its largest and smallest values
+    weight = np.random.default_rng(0).standard_normal((out_features, in_features)).astype(np.float16).astype(np.float32)
+    weight[1, :block_size] = np.linspace(-1, 1, block_size)
+
+    # Quantize the weight of a single MatMul with MatMulNBitsQuantizer, as the builder does at the end for other algorithms
+    graph = helper.make_graph(
+        [helper.make_node("MatMul", ["A", "weight"], ["Y"], name="MatMul")],
+        "main_graph",
+        [helper.make_tensor_value_info("A", TensorProto.FLOAT, [1, in_features])],
+        [helper.make_tensor_value_info("Y", TensorProto.FLOAT, [1, out_features])],
+        [numpy_helper.from_array(np.ascontiguousarray(weight.T), "weight")],
+    )
+    quant = MatMulNBitsQuantizer(
+        helper.make_model(graph, opset_imports=[helper.make_operatorsetid("", 21)]),
+        block_size=block_size,
+        is_symmetric=is_symmetric,
+        accuracy_level=4,
+        op_types_to_quantize=("MatMul",),
+    )
+    quant.process()
+    node = next(node for node in quant.model.model.graph.node if node.op_type == "MatMulNBits")
+    initializers = {initializer.name: numpy_helper.to_array(initializer) for initializer in quant.model.model.graph.initializer}
+
+    builder = types.SimpleNamespace(quant_attrs={"int4": {"block_size": block_size, "is_symmetric": is_symmetric}})
+    quantized = Model.make_int4_quantized_weights(builder, types.SimpleNamespace(weight=torch.from_numpy(weight)))
+
+    assert (quantized.in_features, quantized.out_features) == (in_features, out_features)
+    np.testing.assert_array_equal(quantized.scales.numpy(), initializers[node.input[2]].reshape(-1))
+    np.testing.assert_array_equal(
+        unpack_int4(quantized.qweight.numpy(), block_size).reshape(out_features, -1)[:, :in_features],
+        unpack_int4(initializers[node.input[1]], block_size).reshape(out_features, -1)[:, :in_features],
+    )
+    if is_symmetric:
+        assert len(node.input) == 3 and getattr(quantized, "qzeros", None) is None
+    else:
+        np.testing.assert_array_equal(
+            unpack_int4(quantized.qzeros.numpy().reshape(out_features, -1), k_blocks),
+            unpack_int4(initializers[node.input[3]].reshape(out_features, -1), k_blocks),
+        )
+
+
+def make_gguf_weight(gguf, tensor_type, weight):
+    # The K-quants have no quantize in gguf's NumPy code, so Q4_K super-blocks are packed from random bytes with
+    # finite fp16 d and dmin instead. Any bytes are a valid Q4_K block.
+    if tensor_type != gguf.GGMLQuantizationType.Q4_K:
+        return gguf.quants.quantize(weight, tensor_type)
+    rng = np.random.default_rng(1)
+    blocks = rng.integers(0, 256, size=(weight.shape[0], weight.shape[1] // 256, 144), dtype=np.uint8)
+    blocks[:, :, 0:4] = (rng.random((weight.shape[0], weight.shape[1] // 256, 2)) / 16).astype(np.float16).view(np.uint8)
+    return blocks.reshape(weight.shape[0], -1)
+
+
+@pytest.mark.parametrize("tensor_type", ["Q4_0", "Q4_1", "Q4_K", "Q8_0"])
+def test_gguf_quantized_weight(tensor_type):
+    gguf = pytest.importorskip("gguf")
+    pytest.importorskip("torch")
+    from onnxruntime_genai.models.gguf_model import GGUFModel, GGUFQuantizedTensor, GGUFTensorModule
+
+    tensor_type = gguf.GGMLQuantizationType[tensor_type]
+    out_features, in_features = 4, 512
+    weight = np.random.default_rng(0).standard_normal((out_features, in_features)).astype(np.float32)
+    weight[0, :32] = 0.5  # A constant block, which has a scale of 0 in Q4_1
+    data = make_gguf_weight(gguf, tensor_type, weight)
+    expected = gguf.quants.dequantize(data, tensor_type).reshape(out_features, in_features)
+
+    # The unpacked blocks of 32 values dequantize to the same weight as gguf, with the default `MatMulNBits`
+    # zero point of 8 or 128 when there is no offset
+    values, scales, offsets, bits = GGUFQuantizedTensor(data, tensor_type, [out_features, in_features]).unpack()
+    assert values.shape == (out_features, in_features // 32, 32) and scales.shape == values.shape[:2]
+    assert values.min() >= 0 and values.max() < 2**bits
+    if offsets is None:
+        offsets = -(2 ** (bits - 1)) * scales
+    unpacked = values * scales[..., None] + offsets[..., None]
+    np.testing.assert_allclose(unpacked.reshape(out_features, in_features), expected, rtol=1e-6, atol=1e-6)
+
+    # The `MatMulNBits` weights packed from them dequantize to the same weight as well
+    module = GGUFTensorModule()
+    module.weight = GGUFQuantizedTensor(data, tensor_type, [out_features, in_features])
+    GGUFModel.load_quantized_weight(types.SimpleNamespace(use_matmul_nbits=True), module, use_matmul_nbits=True)
+    assert (module.in_features, module.out_features, module.bits, module.group_size) == (in_features, out_features, bits, 32)
+
+    qweight = module.qweight.numpy()
+    if bits == 4:
+        qweight = unpack_int4(qweight, 32)
+    zero_points = np.full(out_features * in_features // 32, 2 ** (bits - 1), dtype=np.float32) if module.qzeros is None else module.qzeros.numpy()
+    dequantized = (qweight.reshape(-1, 32) - zero_points[:, None]) * module.scales.numpy()[:, None]
+    np.testing.assert_allclose(dequantized.reshape(out_features, in_features), expected, rtol=1e-5, atol=1e-5)
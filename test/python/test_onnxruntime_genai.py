@@ -31,6 +31,7 @@ def run_onnxruntime_genai_api_tests(
         "pytest",
         "-sv",
         "test_onnxruntime_genai_api.py",
+        "test_model_builder.py",
         "--test_models",
         test_models,
     ]
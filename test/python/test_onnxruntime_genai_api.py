@@ -3,6 +3,7 @@
 
 from __future__ import annotations
 
+import json
 import os
 import sys
 import sysconfig
@@ -14,6 +15,7 @@ import onnxruntime
 import numpy as np
 import onnxruntime_genai as og
 import pytest
+from _test_utils import build_model
 
 if not sysconfig.get_platform().endswith("arm64"):
     # Skip importing onnx if running on ARM64
@@ -171,6 +173,39 @@ def test_greedy_search(test_data_path, relative_model_path):
         assert np.array_equal(expected_sequence[i], generator.get_sequence(i))
 
 
+def test_read_only_views(test_data_path):
+    model_path = os.fspath(Path(test_data_path) / "hf-internal-testing" / "tiny-random-gpt2-fp32")
+    model = og.Model(model_path)
+
+    search_params = og.GeneratorParams(model)
+    search_params.set_search_options(do_sample=False, max_length=10, batch_size=1)
+
+    generator = og.Generator(model, search_params)
+    generator.append_tokens(np.array([[0, 0, 195, 731]], dtype=np.int32))
+    logits = generator.get_logits()
+    sequence = generator.get_sequence(0)
+
+    assert not logits.flags.writeable
+    with pytest.raises(ValueError):
+        logits[0] = 0
+    owned = logits.copy()
+    owned[0] = 0
+    assert owned.flags.writeable
+
+    # The sequence and next tokens are snapshots, which later steps don't change
+    expected_logits = logits.copy()
+    generator.generate_next_token()
+    next_tokens = generator.get_next_tokens()
+    expected_next_tokens = next_tokens.copy()
+    generator.rewind_to(2)
+    generator.append_tokens(np.array([[1, 2]], dtype=np.int32))
+    generator.generate_next_token()
+    del generator
+    assert np.array_equal(sequence, [0, 0, 195, 731])
+    assert np.array_equal(next_tokens, expected_next_tokens)
+    assert np.array_equal(logits, expected_logits)
+
+
 @pytest.mark.parametrize(
     "relative_model_path",
     (
@@ -278,6 +313,66 @@ def test_rewind(test_data_path, relative_model_path):
     assert np.array_equal(expected_sequence, generator.get_sequence(0))
 
 
+def test_presence_and_frequency_penalties(test_data_path):
+    model_path = os.fspath(Path(test_data_path) / "hf-internal-testing" / "tiny-random-gpt2-fp32")
+    model = og.Model(model_path)
+    prompt = np.array([[0, 0, 195, 731]], dtype=np.int32)
+
+    search_params = og.GeneratorParams(model)
+    search_params.set_search_options(do_sample=False, max_length=10, presence_penalty=1.0, frequency_penalty=100.0)
+
+    # Every token of the sequence is penalized, so the greedy search picks a new one each time
+    generator = og.Generator(model, search_params)
+    generator.append_tokens(prompt)
+    while not generator.is_done():
+        generator.generate_next_token()
+    sequence = generator.get_sequence(0).copy()
+    generated = list(sequence[prompt.shape[1]:])
+    assert len(set(generated)) == len(generated)
+    assert not set(generated) & set(prompt[0])
+
+    # The counts of the rewound tokens are dropped, so the same tokens follow
+    generator.rewind_to(5)
+    generator.append_tokens(np.array([sequence[5:6]], dtype=np.int32))
+    while not generator.is_done():
+        generator.generate_next_token()
+    assert np.array_equal(sequence, generator.get_sequence(0))
+
+
+@pytest.mark.parametrize("num_beams", [1, 4])
+def test_no_repeat_ngram_size(test_data_path, num_beams):
+    model_path = os.fspath(Path(test_data_path) / "hf-internal-testing" / "tiny-random-gpt2-fp32")
+    model = og.Model(model_path)
+    prompt = np.array([[0, 0, 195, 731]], dtype=np.int32)
+
+    search_params = og.GeneratorParams(model)
+    search_params.set_search_options(do_sample=False, max_length=20, num_beams=num_beams, num_return_sequences=num_beams, no_repeat_ngram_size=2)
+
+    def generate():
+        generator = og.Generator(model, search_params)
+        generator.append_tokens(prompt)
+        while not generator.is_done():
+            generator.generate_next_token()
+        return generator
+
+    # Without the option the greedy search repeats token 114 (see test_rewind). The prompt repeats (0, 0), which can't be
+    # helped, but no pair of tokens after it occurs twice
+    generator = generate()
+    for i in range(num_beams):
+        sequence = list(generator.get_sequence(i))
+        ngrams = [tuple(sequence[j : j + 2]) for j in range(1, len(sequence) - 1)]
+        assert len(set(ngrams)) == len(ngrams)
+
+    if num_beams == 1:
+        # The n-grams of the rewound tokens are dropped, so the same tokens follow
+        sequence = generator.get_sequence(0).copy()
+        generator.rewind_to(6)
+        generator.append_tokens(np.array([sequence[6:7]], dtype=np.int32))
+        while not generator.is_done():
+            generator.generate_next_token()
+        assert np.array_equal(sequence, generator.get_sequence(0))
+
+
 # Test Model Loading with No Chat Template
 
 @pytest.mark.skipif(
@@ -378,6 +473,299 @@ def test_tokenizer_stream(device, phi2_for):
 
         assert decoded_string == prompt
 
+
+@pytest.mark.skipif(
+    sysconfig.get_platform().endswith("arm64"),
+    reason="Model is not available on arm64.",
+)
+def test_paged_key_value_cache(phi2_for):
+    def generate(model, rewind):
+        params = og.GeneratorParams(model)
+        params.set_search_options(max_length=40)
+        generator = og.Generator(model, params)
+        generator.append_tokens(tokens)
+        while not generator.is_done():
+            generator.generate_next_token()
+        if rewind:
+            # Rewind into the middle of a block and regenerate the rest
+            generator.rewind_to(len(tokens) + 5)
+            while not generator.is_done():
+                generator.generate_next_token()
+        return list(generator.get_sequence(0))
+
+    model = og.Model(phi2_for("cpu"))
+    tokens = og.Tokenizer(model).encode("The quick brown fox jumps over the lazy dog.")
+    expected = generate(model, rewind=False)
+
+    config = og.Config(phi2_for("cpu"))
+    config.overlay('{"model": {"decoder": {"paged_key_value_cache": {"block_size": 4}}}}')
+    paged_model = og.Model(config)
+
+    assert generate(paged_model, rewind=False) == expected
+    assert generate(paged_model, rewind=True) == expected
+
+
+@pytest.mark.skipif(
+    sysconfig.get_platform().endswith("arm64"),
+    reason="Model is not available on arm64.",
+)
+def test_paged_key_value_cache_memory(phi2_for):
+    block_size = 4
+    config = og.Config(phi2_for("cpu"))
+    config.overlay(f'{{"model": {{"decoder": {{"paged_key_value_cache": {{"block_size": {block_size}}}}}}}}}')
+    model = og.Model(config)
+    tokens = og.Tokenizer(model).encode("The quick brown fox jumps over the lazy dog.")
+
+    def blocks_for(length):
+        return (length + block_size - 1) // block_size
+
+    def finish(generator):
+        while not generator.is_done():
+            generator.generate_next_token()
+        # The last token is appended to the sequence without being run, so it isn't in the cache
+        return len(generator.get_sequence(0)) - 1
+
+    assert model.get_kv_block_pool_stats()["bytes_allocated"] == 0
+
+    params = og.GeneratorParams(model)
+    params.set_search_options(max_length=40)
+    generator = og.Generator(model, params)
+    generator.append_tokens(tokens)
+    length = finish(generator)
+
+    # The cache is only as large as the positions it holds
+    stats = model.get_kv_block_pool_stats()
+    assert stats["blocks_in_use"] == blocks_for(length)
+    assert stats["max_blocks_in_use"] == blocks_for(length)
+    assert stats["bytes_allocated"] >= stats["blocks_in_use"] * stats["block_bytes"]
+    bytes_allocated = stats["bytes_allocated"]
+
+    # Rewinding drops the tail blocks right away, without copying any
+    generator.rewind_to(len(tokens) + 5)
+    stats = model.get_kv_block_pool_stats()
+    assert stats["blocks_in_use"] == blocks_for(len(tokens) + 5)
+    assert stats["blocks_copied"] == 0
+
+    # Regenerating reuses the released blocks
+    assert finish(generator) == length
+    stats = model.get_kv_block_pool_stats()
+    assert stats["blocks_in_use"] == blocks_for(length)
+    assert stats["max_blocks_in_use"] == blocks_for(length)
+    assert stats["bytes_allocated"] == bytes_allocated
+
+    # Once the generator is gone its chunks are freed, and the next generator allocates them again
+    del generator
+    stats = model.get_kv_block_pool_stats()
+    assert stats["blocks_in_use"] == 0
+    assert stats["bytes_allocated"] == 0
+
+    generator = og.Generator(model, params)
+    generator.append_tokens(tokens)
+    assert finish(generator) == length
+    stats = model.get_kv_block_pool_stats()
+    assert stats["max_blocks_in_use"] == blocks_for(length)
+    assert stats["bytes_allocated"] == bytes_allocated
+    assert stats["blocks_copied"] == 0
+
+
+@pytest.mark.skipif(
+    sysconfig.get_platform().endswith("arm64"),
+    reason="Model is not available on arm64.",
+)
+def test_prefix_cache(phi2_for):
+    config = og.Config(phi2_for("cpu"))
+    config.overlay('{"model": {"decoder": {"paged_key_value_cache": {"block_size": 4}}}}')
+    model = og.Model(config)
+    tokenizer = og.Tokenizer(model)
+
+    def create_generator():
+        params = og.GeneratorParams(model)
+        params.set_search_options(max_length=48)
+        return og.Generator(model, params)
+
+    def finish(generator):
+        while not generator.is_done():
+            generator.generate_next_token()
+        return list(generator.get_sequence(0))
+
+    system_prompt = tokenizer.encode("You are a helpful assistant. Answer briefly.")
+    prompts = [np.concatenate([system_prompt, tokenizer.encode(question)]) for question in ("What is 2 + 2?", "Name a color.")]
+
+    expected = []
+    for prompt in prompts:
+        generator = create_generator()
+        generator.append_tokens(prompt)
+        expected.append(finish(generator))
+
+    prefix_cache = og.PrefixCache(model, 64 * 1024 * 1024)
+    generator = create_generator()
+    assert prefix_cache.append_tokens(generator, system_prompt) == 0
+    prefix_cache.add(generator)
+
+    # Both generators share the cached blocks, and write to copies of the partially filled last block
+    generators = [create_generator() for _ in prompts]
+    for generator, prompt in zip(generators, prompts):
+        assert prefix_cache.append_tokens(generator, prompt) == len(system_prompt)
+    assert [finish(generator) for generator in generators] == expected
+    assert model.get_kv_block_pool_stats()["blocks_copied"] == (2 if len(system_prompt) % 4 else 0)
+
+
+@pytest.mark.skipif(
+    sysconfig.get_platform().endswith("arm64"),
+    reason="Model is not available on arm64.",
+)
+def test_speculative_decoding(phi2_for):
+    model = og.Model(phi2_for("cpu"))
+    draft_model = og.Model(phi2_for("cpu"))
+    tokenizer = og.Tokenizer(model)
+    prompt = tokenizer.encode("def print_prime(n):")
+
+    params = og.GeneratorParams(model)
+    params.set_search_options(max_length=40)
+    generator = og.Generator(model, params)
+    generator.append_tokens(prompt)
+    while not generator.is_done():
+        generator.generate_next_token()
+    expected = list(generator.get_sequence(0))
+
+    # The draft model is the model itself, so it proposes the tokens the model picks
+    generator = og.Generator(model, params)
+    generator.set_draft_model(draft_model, num_draft_tokens=4)
+    generator.append_tokens(prompt)
+    tokens = list(prompt)
+    while not generator.is_done():
+        tokens.extend(generator.speculate_next_tokens())
+    assert tokens == expected
+    assert list(generator.get_sequence(0)) == expected
+
+    stats = generator.get_speculative_stats()
+    assert stats["steps"] > 0
+    assert 0 < stats["accepted_tokens"] <= stats["draft_tokens"]
+
+    # Sampling keeps the sequence consistent with the tokens returned
+    params.set_search_options(do_sample=True, temperature=0.7, top_k=20, random_seed=1)
+    generator = og.Generator(model, params)
+    generator.set_draft_model(draft_model, num_draft_tokens=3)
+    generator.append_tokens(prompt)
+    tokens = list(prompt)
+    while not generator.is_done():
+        tokens.extend(generator.speculate_next_tokens())
+    assert tokens == list(generator.get_sequence(0))
+    assert len(tokens) <= 40
+
+
+@pytest.mark.skipif(
+    sysconfig.get_platform().endswith("arm64"),
+    reason="Model is not available on arm64.",
+)
+def test_prompt_lookup_decoding(phi2_for):
+    model = og.Model(phi2_for("cpu"))
+    tokenizer = og.Tokenizer(model)
+    prompt = tokenizer.encode("Repeat this sentence: the quick brown fox jumps over the lazy dog. Sentence:")
+
+    def generate(**search_options):
+        params = og.GeneratorParams(model)
+        params.set_search_options(max_length=48, **search_options)
+        generator = og.Generator(model, params)
+        generator.append_tokens(prompt)
+        tokens = list(prompt)
+        while not generator.is_done():
+            if search_options:
+                tokens.extend(generator.speculate_next_tokens())
+            else:
+                generator.generate_next_token()
+                tokens.extend(generator.get_next_tokens())
+        assert tokens == list(generator.get_sequence(0))
+        return tokens, generator
+
+    expected, _ = generate()
+    tokens, generator = generate(prompt_lookup_num_tokens=5, prompt_lookup_max_ngram_size=2)
+    assert tokens == expected
+
+    stats = generator.get_speculative_stats()
+    assert stats["steps"] > 0
+    assert stats["accepted_tokens"] <= stats["draft_tokens"]
+
+    # Without a draft model or prompt lookup there is nothing to propose tokens
+    params = og.GeneratorParams(model)
+    params.set_search_options(max_length=48)
+    generator = og.Generator(model, params)
+    generator.append_tokens(prompt)
+    with pytest.raises(RuntimeError):
+        generator.speculate_next_tokens()
+
+
+@pytest.mark.skipif(
+    sysconfig.get_platform().endswith("arm64"),
+    reason="Model is not available on arm64.",
+)
+def test_engine(phi2_for):
+    model = og.Model(phi2_for("cpu"))
+    tokenizer = og.Tokenizer(model)
+    prompts = ["This is a test.", "Rats are awesome pets!", "The quick brown fox jumps over the lazy dog."]
+    max_lengths = [20, 14, 25]
+
+    expected = []
+    for prompt, max_length in zip(prompts, max_lengths):
+        params = og.GeneratorParams(model)
+        params.set_search_options(max_length=max_length)
+        generator = og.Generator(model, params)
+        tokens = tokenizer.encode(prompt)
+        generator.append_tokens(tokens)
+        while not generator.is_done():
+            generator.generate_next_token()
+        expected.append(list(generator.get_sequence(0)[len(tokens):]))
+
+    # Two batch entries for three requests, so the last one joins when the shortest one finishes
+    engine_params = og.GeneratorParams(model)
+    engine_params.set_search_options(batch_size=2, max_length=32)
+    engine = og.Engine(model, engine_params)
+
+    request_ids = []
+    for prompt, max_length in zip(prompts, max_lengths):
+        params = og.GeneratorParams(model)
+        params.set_search_options(max_length=max_length)
+        request_ids.append(engine.submit(params, tokenizer.encode(prompt)))
+
+    generated = {request_id: [] for request_id in request_ids}
+    while engine.has_pending_requests():
+        for request_id, token, _ in engine.step():
+            generated[request_id].append(token)
+
+    assert [generated[request_id] for request_id in request_ids] == expected
+
+
+@pytest.mark.skipif(
+    sysconfig.get_platform().endswith("arm64"),
+    reason="Model is not available on arm64.",
+)
+@pytest.mark.parametrize("device", devices)
+def test_async_stream(device, phi2_for):
+    import asyncio
+
+    model = og.Model(phi2_for(device))
+    tokenizer = og.Tokenizer(model)
+    tokens = tokenizer.encode("This is a test.")
+
+    params = og.GeneratorParams(model)
+    params.set_search_options(max_length=20)  # To run faster
+
+    generator = og.Generator(model, params)
+    generator.append_tokens(tokens)
+    while not generator.is_done():
+        generator.generate_next_token()
+    expected = tokenizer.decode(generator.get_sequence(0)[len(tokens):])
+
+    async def generate(count):
+        async def collect():
+            return "".join([text async for text in og.stream(model, params, tokens, tokenizer)])
+
+        # Run several streams concurrently in one event loop
+        return await asyncio.gather(*[collect() for _ in range(count)])
+
+    assert asyncio.run(generate(3)) == [expected] * 3
+
+
 @pytest.mark.skipif(
     sysconfig.get_platform().endswith("arm64"),
     reason="Model is not available on arm64.",
@@ -406,6 +794,33 @@ def test_batching(device, phi2_for):
     for i in range(len(prompts)):
         print(tokenizer.decode(generator.get_sequence(0)))
 
+
+@pytest.mark.skipif(
+    sysconfig.get_platform().endswith("arm64"),
+    reason="Model is not available on arm64.",
+)
+def test_thread_pool_stats(phi2_for):
+    config = og.Config(phi2_for("cpu"))
+    config.overlay('{"model": {"thread_pool_size": 2}}')
+    model = og.Model(config)
+    tokenizer = og.Tokenizer(model)
+
+    prompts = ["This is a test.", "Rats are awesome pets!", "The quick brown fox jumps over the lazy dog."]
+    params = og.GeneratorParams(model)
+    params.set_search_options(max_length=20, batch_size=len(prompts))
+
+    # The batch rows are searched on the model's pool
+    generator = og.Generator(model, params)
+    generator.append_tokens(tokenizer.encode_batch(prompts))
+    while not generator.is_done():
+        generator.generate_next_token()
+
+    stats = model.get_thread_pool_stats()
+    assert stats["threads"] == 2
+    assert stats["max_queued"] > 0
+    assert stats["executed"] > 0
+
+
 @pytest.mark.skipif(
     sysconfig.get_platform().endswith("arm64"),
     reason="Model is not available on arm64.",
@@ -546,6 +961,96 @@ def test_get_output(test_data_path, relative_model_path):
     )
 
 
+def test_last_token_logits(tiny_llama_path, tmp_path):
+    def generate(model):
+        params = og.GeneratorParams(model)
+        params.set_search_options(max_length=24, batch_size=len(prompts))
+        generator = og.Generator(model, params)
+        generator.append_tokens(prompts)
+        logits = []
+        while not generator.is_done():
+            logits.append(generator.get_logits())
+            generator.generate_next_token()
+        return logits, [list(generator.get_sequence(i)) for i in range(len(prompts))]
+
+    # The first prompt is padded with the pad token (2, the eos token of the checkpoint)
+    prompts = np.array([[2, 2, 5, 6, 7, 8], [11, 12, 13, 14, 15, 16]], dtype=np.int32)
+    model_path = os.fspath(tmp_path / "model")
+    build_model(tiny_llama_path, model_path, "fp32", "cpu", os.fspath(tmp_path / "cache"))
+    expected_logits, expected_sequences = generate(og.Model(model_path))
+
+    # The builder gathers the last token of each sequence before the LM head
+    last_token_path = os.fspath(tmp_path / "last_token")
+    build_model(tiny_llama_path, last_token_path, "fp32", "cpu", os.fspath(tmp_path / "cache"), {"last_token_logits": "true"})
+    with open(os.path.join(last_token_path, "genai_config.json")) as f:
+        assert json.load(f)["model"]["decoder"]["inputs"]["last_token_indices"] == "last_token_indices"
+    last_token_logits, last_token_sequences = generate(og.Model(last_token_path))
+
+    # The logits used for the prompt and for each generated token are the same
+    assert len(last_token_logits) == len(expected_logits)
+    for actual, expected in zip(last_token_logits, expected_logits):
+        assert np.allclose(actual, expected, atol=1e-4)
+    assert last_token_sequences == expected_sequences
+
+
+def test_kv_cache_int8(tiny_llama_path, tmp_path):
+    def generate(model, rewind):
+        params = og.GeneratorParams(model)
+        params.set_search_options(max_length=40)
+        generator = og.Generator(model, params)
+        generator.append_tokens(tokens)
+        logits = []
+        while not generator.is_done():
+            logits.append(generator.get_logits())
+            generator.generate_next_token()
+        if rewind:
+            generator.rewind_to(len(tokens) + 5)
+            while not generator.is_done():
+                generator.generate_next_token()
+        return logits, list(generator.get_sequence(0))
+
+    tokens = np.array([5, 6, 7, 8, 9, 10, 11, 12], dtype=np.int32)
+    model_path = os.fspath(tmp_path / "model")
+    build_model(tiny_llama_path, model_path, "fp32", "cpu", os.fspath(tmp_path / "cache"))
+    expected_logits, expected_sequence = generate(og.Model(model_path), rewind=False)
+
+    # The builder quantizes the new positions of each present and dequantizes the past, and names the scales in the config
+    int8_path = os.fspath(tmp_path / "kv_cache_int8")
+    build_model(tiny_llama_path, int8_path, "fp32", "cpu", os.fspath(tmp_path / "cache"), {"kv_cache_int8": "true"})
+    with open(os.path.join(int8_path, "genai_config.json")) as f:
+        config = json.load(f)
+    assert config["model"]["decoder"]["inputs"]["past_key_scale_names"] == "past_key_values.%d.key_scale"
+    assert config["model"]["decoder"]["outputs"]["present_value_scale_names"] == "present.%d.value_scale"
+    assert not config["search"]["past_present_share_buffer"]
+
+    int8_model = og.Model(int8_path)
+
+    # Feed the int8 model the tokens of the float one, so each step sees the same sequence. The prompt has no past, so its
+    # logits are the same, the logits of later steps are off by the int8 rounding of the past
+    params = og.GeneratorParams(int8_model)
+    params.set_search_options(max_length=40)
+    generator = og.Generator(int8_model, params)
+    generator.append_tokens(tokens)
+    int8_logits = [generator.get_logits()]
+    for token in expected_sequence[len(tokens) : -1]:
+        generator.append_tokens(np.array([token], dtype=np.int32))
+        int8_logits.append(generator.get_logits())
+    assert len(int8_logits) == len(expected_logits)
+    assert np.allclose(int8_logits[0], expected_logits[0], atol=1e-3)
+    for actual, expected in zip(int8_logits, expected_logits):
+        assert np.abs(actual - expected).max() <= 0.05 * np.abs(expected).max()
+
+    # Rewinding keeps the int8 past and its scales, so greedy search picks the same tokens again
+    _, int8_sequence = generate(int8_model, rewind=False)
+    assert generate(int8_model, rewind=True)[1] == int8_sequence
+
+    # The Engine runs part of the batch in shared buffers, which the int8 cache doesn't have
+    engine_params = og.GeneratorParams(int8_model)
+    engine_params.set_search_options(batch_size=2, max_length=32)
+    with pytest.raises(RuntimeError, match="kv_cache_int8"):
+        og.Engine(int8_model, engine_params)
+
+
 @pytest.mark.skipif(
     sysconfig.get_platform().endswith("arm64"),
     reason="Model is not available on arm64.",
@@ -32,9 +32,9 @@ struct SamplingBenchmark {
     for (int i = 0; i < batch_size_; i++)
       input_ids.push_back(i);
 
-    const int vocab_size = 32000;
+    const int vocab_size = vocab_size_;
     auto config = OgaConfig::Create(MODEL_PATH "hf-internal-testing/tiny-random-gpt2-fp32");
-    config->Overlay(R"({ "model": { "vocab_size" : 32000 } })");
+    config->Overlay((R"({ "model": { "vocab_size" : )" + std::to_string(vocab_size) + " } }").c_str());
     config->ClearProviders();
     if (strcmp(device_type_, "cpu"))
       config->AppendProvider(device_type_);
@@ -93,6 +93,7 @@ struct SamplingBenchmark {
 
   BenchmarkFunction benchmark_function_;
   int batch_size_{1};
+  int vocab_size_{32000};
   const char* device_type_{"cpu"};
 };
 
@@ -115,9 +116,11 @@ struct BenchmarkParams {
   const char* device_type;
   int batch_size;
   BenchmarkFunction benchmark_function;
+  int vocab_size{32000};
 
   std::string Name() const {
-    return std::string() + device_type + "_BatchSize_" + std::to_string(batch_size) + "_" + BenchmarkFunctionToString(benchmark_function);
+    return std::string() + device_type + "_BatchSize_" + std::to_string(batch_size) + "_" + BenchmarkFunctionToString(benchmark_function) +
+           "_VocabSize_" + std::to_string(vocab_size);
   }
 };
 
@@ -129,13 +132,20 @@ TEST_P(SamplingBenchmarkTest, RunBenchmark) {
   benchmark.device_type_ = params.device_type;
   benchmark.benchmark_function_ = params.benchmark_function;
   benchmark.batch_size_ = params.batch_size;
+  benchmark.vocab_size_ = params.vocab_size;
   benchmark.Run();
 }
 
 auto benchmark_values = ::testing::Values(
     BenchmarkParams{"cpu", 1, BenchmarkFunction::TopP},
     BenchmarkParams{"cpu", 1, BenchmarkFunction::TopK},
-    BenchmarkParams{"cpu", 1, BenchmarkFunction::TopKTopP}
+    BenchmarkParams{"cpu", 1, BenchmarkFunction::TopKTopP},
+    // Vocabulary sizes of recent models (Llama 3, Qwen 2, Gemma 3), where a full sort of the vocabulary dominates top p
+    BenchmarkParams{"cpu", 1, BenchmarkFunction::TopP, 128256},
+    BenchmarkParams{"cpu", 1, BenchmarkFunction::TopP, 151936},
+    BenchmarkParams{"cpu", 1, BenchmarkFunction::TopP, 262144},
+    BenchmarkParams{"cpu", 8, BenchmarkFunction::TopP, 32000},
+    BenchmarkParams{"cpu", 8, BenchmarkFunction::TopP, 151936}
 #if USE_CUDA
     ,
     BenchmarkParams{"cuda", 1, BenchmarkFunction::TopP},
@@ -284,6 +284,279 @@ TEST(SamplingTests, RandomizedSamplingTopPAndKCpu) {
   }
 }
 
+TEST(SamplingTests, SeededBatchSamplingTopPCpu) {
+  // A large enough batch that the rows are sampled on several threads
+  const int batch_size = 16;
+  const int vocab_size = 32000;
+
+  auto config = OgaConfig::Create(MODEL_PATH "hf-internal-testing/tiny-random-gpt2-fp32");
+  config->Overlay(R"({ "model": { "vocab_size" : 32000 } })");
+  auto model = OgaModel::Create(*config);
+
+  std::vector<float> logits_cpu(vocab_size * batch_size);
+  std::mt19937 engine(1);
+  std::uniform_real_distribution<float> dist(0.0f, 1.0f);
+  for (auto& logit : logits_cpu)
+    logit = dist(engine);
+
+  auto generate = [&](int rows) {
+    auto params = OgaGeneratorParams::Create(*model);
+    params->SetSearchOption("max_length", 10);
+    params->SetSearchOptionBool("do_sample", true);
+    params->SetSearchOption("top_p", 0.95f);
+    params->SetSearchOption("random_seed", 42);
+    params->SetSearchOption("batch_size", rows);
+
+    auto generator = OgaGenerator::Create(*model, *params);
+    generator->SetLogits(*OgaTensor::Create(logits_cpu.data(), std::array<int64_t, 2>{rows, vocab_size}));
+    generator->GenerateNextToken();
+    auto next_tokens = generator->GetNextTokens();
+    return std::vector<int32_t>(next_tokens.begin(), next_tokens.end());
+  };
+
+  // Each row has its own random number stream, so the tokens don't depend on the threads or the batch size
+  auto next_tokens = generate(batch_size);
+  EXPECT_EQ(next_tokens, generate(batch_size));
+  EXPECT_EQ(next_tokens[0], generate(1)[0]);
+}
+
+TEST(SamplingTests, TopPMatchesFullSortCpu) {
+  const int batch_size = 3;
+  const int vocab_size = 32000;
+  const int random_seed = 7;
+
+  auto config = OgaConfig::Create(MODEL_PATH "hf-internal-testing/tiny-random-gpt2-fp32");
+  config->Overlay(R"({ "model": { "vocab_size" : 32000 } })");
+  auto model = OgaModel::Create(*config);
+
+  // The token sampled by sorting the whole vocabulary, with ties going to the lower token id. Each row has its own
+  // random number stream, seeded as the search seeds it
+  auto full_sort_token = [&](std::span<const float> logits, int row, float p) {
+    std::mt19937 engine;
+    if (row == 0) {
+      engine.seed(random_seed);
+    } else {
+      std::seed_seq seq{static_cast<uint32_t>(random_seed), static_cast<uint32_t>(row)};
+      engine.seed(seq);
+    }
+    std::uniform_real_distribution<float> dis(0, p);
+    float threshold = dis(engine);
+
+    std::vector<float> probabilities(logits.begin(), logits.end());
+    Softmax(probabilities, 1.0f);
+    std::vector<int32_t> indices(vocab_size);
+    std::iota(indices.begin(), indices.end(), 0);
+    std::stable_sort(indices.begin(), indices.end(), [&](int32_t i, int32_t j) { return probabilities[i] > probabilities[j]; });
+    for (int32_t index : indices) {
+      threshold -= probabilities[index];
+      if (threshold <= 0)
+        return index;
+    }
+    return 0;
+  };
+
+  auto check = [&](const std::vector<float>& logits_cpu, float p) {
+    auto params = OgaGeneratorParams::Create(*model);
+    params->SetSearchOption("max_length", 10);
+    params->SetSearchOptionBool("do_sample", true);
+    params->SetSearchOption("top_p", p);
+    params->SetSearchOption("random_seed", random_seed);
+    params->SetSearchOption("batch_size", batch_size);
+
+    auto generator = OgaGenerator::Create(*model, *params);
+    generator->SetLogits(*OgaTensor::Create(logits_cpu.data(), std::array<int64_t, 2>{batch_size, vocab_size}));
+    generator->GenerateNextToken();
+    auto next_tokens = generator->GetNextTokens();
+    for (int b = 0; b < batch_size; b++) {
+      std::span<const float> logits{logits_cpu.data() + b * vocab_size, static_cast<size_t>(vocab_size)};
+      EXPECT_EQ(next_tokens[b], full_sort_token(logits, b, p)) << "row " << b << ", top_p " << p;
+    }
+  };
+
+  std::mt19937 engine(3);
+  std::vector<float> logits_cpu(vocab_size * batch_size);
+  for (float p : {0.3f, 0.9f, 1.0f}) {
+    // Peaked, so only the few large tokens are sorted
+    CreateRandomLogits(logits_cpu.data(), 10, vocab_size, batch_size, engine);
+    check(logits_cpu, p);
+
+    // Flat, so the whole vocabulary is sorted
+    std::uniform_real_distribution<float> dist(0.0f, 1.0f);
+    for (auto& logit : logits_cpu)
+      logit = dist(engine);
+    check(logits_cpu, p);
+
+    // Ties, among both the large tokens and the rest of the vocabulary
+    std::uniform_int_distribution<> small_dist(0, 3);
+    for (auto& logit : logits_cpu)
+      logit = static_cast<float>(small_dist(engine));
+    std::uniform_int_distribution<> token_dist(0, vocab_size - 1);
+    for (int b = 0; b < batch_size; b++) {
+      for (int i = 0; i < 20; i++)
+        logits_cpu[token_dist(engine) + b * vocab_size] = 12.0f;
+    }
+    check(logits_cpu, p);
+  }
+}
+
+TEST(SamplingTests, PresenceAndFrequencyPenaltiesCpu) {
+  // Each token in the sequence loses 0.15 (presence) plus 0.2 per occurrence (frequency)
+  std::vector<float> logits_cpu{0.0f, 1.0f, 0.9f, 0.8f, 0.5f};
+  std::vector<int32_t> expected_sequence{1, 2, 3, 1, 2, 4};
+
+  auto config = OgaConfig::Create(MODEL_PATH "hf-internal-testing/tiny-random-gpt2-fp32");
+  config->Overlay(R"({ "model": { "vocab_size" : 5 } })");
+
+  auto model = OgaModel::Create(*config);
+  auto params = OgaGeneratorParams::Create(*model);
+  params->SetSearchOption("max_length", 10);
+  params->SetSearchOption("presence_penalty", 0.15f);
+  params->SetSearchOption("frequency_penalty", 0.2f);
+
+  auto generator = OgaGenerator::Create(*model, *params);
+  for (size_t i = 0; i < expected_sequence.size(); i++) {
+    generator->SetLogits(*OgaTensor::Create(logits_cpu.data(), std::array<int64_t, 2>{1LL, 5LL}));
+    generator->GenerateNextToken();
+  }
+
+  auto sequence = generator->GetSequence(0);
+  EXPECT_EQ(std::vector<int32_t>(sequence.begin(), sequence.end()), expected_sequence);
+}
+
+TEST(SamplingTests, NoRepeatNgramCpu) {
+  // Token 1 is the top one, unless it would repeat a pair of tokens
+  std::vector<float> logits_cpu{0.0f, 1.0f, 0.9f, 0.8f, 0.7f};
+  std::vector<int32_t> expected_sequence{1, 1, 2, 1, 3, 1, 4};
+
+  auto config = OgaConfig::Create(MODEL_PATH "hf-internal-testing/tiny-random-gpt2-fp32");
+  config->Overlay(R"({ "model": { "vocab_size" : 5 } })");
+
+  auto model = OgaModel::Create(*config);
+  auto params = OgaGeneratorParams::Create(*model);
+  params->SetSearchOption("max_length", 10);
+  params->SetSearchOption("no_repeat_ngram_size", 2);
+
+  auto generator = OgaGenerator::Create(*model, *params);
+  for (size_t i = 0; i < expected_sequence.size(); i++) {
+    generator->SetLogits(*OgaTensor::Create(logits_cpu.data(), std::array<int64_t, 2>{1LL, 5LL}));
+    generator->GenerateNextToken();
+  }
+
+  auto sequence = generator->GetSequence(0);
+  EXPECT_EQ(std::vector<int32_t>(sequence.begin(), sequence.end()), expected_sequence);
+}
+
+// The model returns the same top 4 tokens {5, 3, 9, 2} with logits {2, 1, 0, -1} for every sequence at every step
+// (see test_models/create_top_k_head_model.py)
+static std::vector<int32_t> GenerateWithTopKHead(OgaGeneratorParams& params, OgaModel& model, int batch_size) {
+  std::vector<int32_t> input_ids(batch_size * 2, 1);
+  params.SetSearchOption("max_length", 62);
+  params.SetSearchOption("batch_size", batch_size);
+
+  auto generator = OgaGenerator::Create(model, params);
+  generator->AppendTokens(input_ids);
+  std::vector<int32_t> tokens;
+  while (!generator->IsDone()) {
+    generator->GenerateNextToken();
+    auto next_tokens = generator->GetNextTokens();
+    tokens.insert(tokens.end(), next_tokens.begin(), next_tokens.end());
+  }
+  return tokens;
+}
+
+TEST(SamplingTests, TopKHeadGreedyCpu) {
+  auto model = OgaModel::Create(MODEL_PATH "top-k-head");
+  auto params = OgaGeneratorParams::Create(*model);
+  params->SetSearchOption("top_k", 8);  // Not used by greedy search, so it can be larger than the model's k
+
+  for (int32_t token : GenerateWithTopKHead(*params, *model, 2))
+    EXPECT_EQ(token, 5);
+}
+
+TEST(SamplingTests, TopKHeadTopKCpu) {
+  auto model = OgaModel::Create(MODEL_PATH "top-k-head");
+  auto params = OgaGeneratorParams::Create(*model);
+  params->SetSearchOptionBool("do_sample", true);
+  params->SetSearchOption("top_k", 2);
+  params->SetSearchOption("random_seed", 42);
+
+  // Only the first 2 of the model's top 4 are sampled, and both of them are
+  auto tokens = GenerateWithTopKHead(*params, *model, 2);
+  for (int32_t token : tokens)
+    EXPECT_TRUE(token == 5 || token == 3);
+  EXPECT_NE(std::find(tokens.begin(), tokens.end(), 5), tokens.end());
+  EXPECT_NE(std::find(tokens.begin(), tokens.end(), 3), tokens.end());
+
+  // A top_k of 0 samples from all of the model's top k
+  params->SetSearchOption("top_k", 0);
+  tokens = GenerateWithTopKHead(*params, *model, 2);
+  for (int32_t token : tokens)
+    EXPECT_TRUE(token == 5 || token == 3 || token == 9 || token == 2);
+  EXPECT_NE(std::find(tokens.begin(), tokens.end(), 9), tokens.end());
+}
+
+TEST(SamplingTests, TopKHeadTopPCpu) {
+  auto model = OgaModel::Create(MODEL_PATH "top-k-head");
+  auto params = OgaGeneratorParams::Create(*model);
+  params->SetSearchOptionBool("do_sample", true);
+  params->SetSearchOption("random_seed", 42);
+
+  // The probabilities of the top 4 are {0.64, 0.24, 0.09, 0.03}, so a top_p of 0.5 keeps one token and 0.8 keeps two
+  params->SetSearchOption("top_p", 0.5f);
+  for (int32_t token : GenerateWithTopKHead(*params, *model, 2))
+    EXPECT_EQ(token, 5);
+
+  params->SetSearchOption("top_p", 0.8f);
+  auto tokens = GenerateWithTopKHead(*params, *model, 2);
+  for (int32_t token : tokens)
+    EXPECT_TRUE(token == 5 || token == 3);
+  EXPECT_NE(std::find(tokens.begin(), tokens.end(), 3), tokens.end());
+}
+
+TEST(SamplingTests, TopKHeadTopKTooLargeCpu) {
+  auto model = OgaModel::Create(MODEL_PATH "top-k-head");
+  auto params = OgaGeneratorParams::Create(*model);
+  params->SetSearchOptionBool("do_sample", true);
+  params->SetSearchOption("top_k", 5);
+  params->SetSearchOption("max_length", 10);
+
+  // The model only returns its top 4 tokens, so it can't sample from the top 5
+  auto generator = OgaGenerator::Create(*model, *params);
+  std::vector<int32_t> input_ids{1, 1};
+  generator->AppendTokens(input_ids);
+  EXPECT_THROW(generator->GenerateNextToken(), std::runtime_error);
+}
+
+TEST(SamplingTests, TopKHeadGetLogitsCpu) {
+  auto model = OgaModel::Create(MODEL_PATH "top-k-head");
+  auto params = OgaGeneratorParams::Create(*model);
+  params->SetSearchOption("max_length", 10);
+  params->SetSearchOption("batch_size", 2);
+
+  // The model has no logits output, so only its top k are available
+  auto generator = OgaGenerator::Create(*model, *params);
+  std::vector<int32_t> input_ids{1, 1, 1, 1};
+  generator->AppendTokens(input_ids);
+  EXPECT_THROW(generator->GetLogits(), std::runtime_error);
+
+  auto top_k_logits = generator->GetOutput("top_k_logits");
+  auto top_k_indices = generator->GetOutput("top_k_indices");
+  EXPECT_EQ(top_k_logits->Shape(), (std::vector<int64_t>{2, 1, 4}));
+  EXPECT_EQ(top_k_indices->Shape(), (std::vector<int64_t>{2, 1, 4}));
+  const auto* logits = static_cast<float*>(top_k_logits->Data());
+  const auto* indices = static_cast<int64_t*>(top_k_indices->Data());
+  const std::array<float, 4> expected_logits{2.0f, 1.0f, 0.0f, -1.0f};
+  const std::array<int64_t, 4> expected_indices{5, 3, 9, 2};
+  for (int i = 0; i < 8; i++) {
+    EXPECT_EQ(logits[i], expected_logits[i % 4]);
+    EXPECT_EQ(indices[i], expected_indices[i % 4]);
+  }
+
+  // Generating still works after the failed call
+  generator->GenerateNextToken();
+  EXPECT_EQ(generator->GetNextTokens()[0], 5);
+}
+
 #if USE_CUDA
 TEST(SamplingTests, BatchedSamplingTopPCuda) {
   std::vector<int32_t> input_ids{0, 1, 2, 3};
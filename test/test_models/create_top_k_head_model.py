@@ -0,0 +1,109 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation.  All rights reserved.
+# Licensed under the MIT License.  See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""
+Create a tiny decoder with an in-graph TopK head (as made by the model builder with top_k_head=K) to test
+how the runtime samples from the top k tokens of a model.
+
+Whatever the input, the model returns the same top 4 tokens for each sequence:
+
+    top_k_indices = [5, 3, 9, 2]
+    top_k_logits  = [2.0, 1.0, 0.0, -1.0]
+
+Its one layer key-value cache is the input ids appended to the past (num_key_value_heads = head_size = 1).
+
+Example usage:
+    python create_top_k_head_model.py --output top-k-head
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+
+TOP_K_INDICES = [5, 3, 9, 2]
+TOP_K_LOGITS = [2.0, 1.0, 0.0, -1.0]
+
+
+def make_model():
+    k = len(TOP_K_INDICES)
+    inputs = [
+        helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch_size", "sequence_length"]),
+        helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch_size", "total_sequence_length"]),
+        helper.make_tensor_value_info("last_token_indices", TensorProto.INT64, ["batch_size"]),
+        helper.make_tensor_value_info("past_key_values.0.key", TensorProto.FLOAT, ["batch_size", 1, "past_sequence_length", 1]),
+        helper.make_tensor_value_info("past_key_values.0.value", TensorProto.FLOAT, ["batch_size", 1, "past_sequence_length", 1]),
+    ]
+    outputs = [
+        helper.make_tensor_value_info("top_k_logits", TensorProto.FLOAT, ["batch_size", 1, k]),
+        helper.make_tensor_value_info("top_k_indices", TensorProto.INT64, ["batch_size", 1, k]),
+        helper.make_tensor_value_info("present.0.key", TensorProto.FLOAT, ["batch_size", 1, "total_sequence_length", 1]),
+        helper.make_tensor_value_info("present.0.value", TensorProto.FLOAT, ["batch_size", 1, "total_sequence_length", 1]),
+    ]
+    initializers = [
+        numpy_helper.from_array(np.array([1, 3], dtype=np.int64), "cache_axes"),
+        numpy_helper.from_array(np.array([1, 2], dtype=np.int64), "head_axes"),
+        numpy_helper.from_array(np.array(0, dtype=np.int64), "zero"),
+        numpy_helper.from_array(np.array(TOP_K_INDICES, dtype=np.int64).reshape(1, 1, k), "indices"),
+        numpy_helper.from_array(np.array(TOP_K_LOGITS, dtype=np.float32).reshape(1, 1, k), "logits"),
+    ]
+    nodes = [
+        # Key-value cache: append the input ids to the past
+        helper.make_node("Unsqueeze", ["input_ids", "cache_axes"], ["input_ids_4d"]),
+        helper.make_node("Cast", ["input_ids_4d"], ["input_ids_4d_float"], to=TensorProto.FLOAT),
+        helper.make_node("Concat", ["past_key_values.0.key", "input_ids_4d_float"], ["present.0.key"], axis=2),
+        helper.make_node("Concat", ["past_key_values.0.value", "input_ids_4d_float"], ["present.0.value"], axis=2),
+        # TopK head: broadcast the same top k to each sequence
+        helper.make_node("Unsqueeze", ["last_token_indices", "head_axes"], ["last_token_indices_3d"]),
+        helper.make_node("Mul", ["last_token_indices_3d", "zero"], ["zeros"]),
+        helper.make_node("Add", ["zeros", "indices"], ["top_k_indices"]),
+        helper.make_node("Cast", ["zeros"], ["zeros_float"], to=TensorProto.FLOAT),
+        helper.make_node("Add", ["zeros_float", "logits"], ["top_k_logits"]),
+    ]
+    graph = helper.make_graph(nodes, "main_graph", inputs, outputs, initializers)
+    return helper.make_model(graph, opset_imports=[helper.make_operatorsetid("", 17)], ir_version=8, producer_name="onnxruntime-genai")
+
+
+def make_genai_config():
+    return {
+        "model": {
+            "type": "llama",
+            "bos_token_id": 1,
+            "eos_token_id": 0,
+            "pad_token_id": 0,
+            "vocab_size": 16,
+            "context_length": 64,
+            "decoder": {
+                "filename": "model.onnx",
+                "hidden_size": 1,
+                "head_size": 1,
+                "num_attention_heads": 1,
+                "num_key_value_heads": 1,
+                "num_hidden_layers": 1,
+            },
+        },
+        "search": {"max_length": 64},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", type=str, default="top-k-head", help="Folder to save the model and its genai_config.json in")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    model = make_model()
+    onnx.checker.check_model(model)
+    onnx.save_model(model, os.path.join(args.output, "model.onnx"))
+    with open(os.path.join(args.output, "genai_config.json"), "w") as f:
+        json.dump(make_genai_config(), f, indent=4)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+// Copyright (c) Microsoft Corporation. All rights reserved.
+// Licensed under the MIT License.
+
+#include "models/threadpool.h"
+
+#include <atomic>
+#include <stdexcept>
+#include <vector>
+
+#include <gtest/gtest.h>
+
+namespace Generators::test {
+
+TEST(ThreadPoolTest, SubmitThenWait) {
+  constexpr size_t num_work_items = 64;
+
+  std::atomic<size_t> work_counter = 0;
+  ThreadPool pool{4};
+
+  std::vector<std::future<void>> futures;
+  for (size_t i = 0; i < num_work_items; ++i) {
+    futures.push_back(pool.Submit([&work_counter]() { ++work_counter; }));
+  }
+  for (auto& future : futures) {
+    future.get();
+  }
+
+  EXPECT_EQ(work_counter, num_work_items);
+
+  const auto stats = pool.GetStats();
+  EXPECT_EQ(stats.thread_count, 4);
+  EXPECT_EQ(stats.queued, 0);
+  EXPECT_GE(stats.max_queued, 1);
+  EXPECT_EQ(stats.executed, num_work_items);
+}
+
+TEST(ThreadPoolTest, ComputeFromSubmittedTasks) {
+  // Each task waits on a Compute of its own, which must finish even with every pool thread busy
+  constexpr size_t num_tasks = 16, count = 32;
+
+  std::atomic<size_t> sum = 0;
+  ThreadPool pool{2};
+
+  std::vector<std::future<void>> futures;
+  for (size_t i = 0; i < num_tasks; ++i) {
+    futures.push_back(pool.Submit([&]() { pool.Compute(count, [&sum](size_t j) { sum += j; }); }));
+  }
+  for (auto& future : futures) {
+    future.get();
+  }
+
+  EXPECT_EQ(sum, num_tasks * count * (count - 1) / 2);
+}
+
+TEST(ThreadPoolTest, ComputeWithoutThreads) {
+  std::vector<size_t> indices;
+  ThreadPool pool{0};
+  pool.Compute(8, [&indices](size_t i) { indices.push_back(i); });
+  pool.Submit([&indices]() { indices.push_back(8); }).get();
+
+  EXPECT_EQ(indices, (std::vector<size_t>{0, 1, 2, 3, 4, 5, 6, 7, 8}));
+}
+
+TEST(ThreadPoolTest, Exceptions) {
+  ThreadPool pool{3};
+
+  EXPECT_THROW(pool.Compute(16, [](size_t i) { if (i == 11) throw std::runtime_error("compute"); }), std::runtime_error);
+  EXPECT_THROW(pool.Submit([]() { throw std::runtime_error("submit"); }).get(), std::runtime_error);
+
+  // The pool keeps working afterwards
+  std::atomic<size_t> work_counter = 0;
+  pool.Compute(16, [&work_counter](size_t) { ++work_counter; });
+  EXPECT_EQ(work_counter, 16);
+}
+
+}  // namespace Generators::test